@@ -0,0 +1,59 @@
+"""
+Runs the benchmark suite against the recorded fixtures and the local stub gateway, and saves the results under
+benchmarks/results/<name>-<commit>.json so runs on different commits can be compared.
+
+Usage: python -m benchmarks [parse] [ids] [icam] [ingest] [pipeline] [shards] [--quick] [--compare OLD.json]
+"""
+import argparse
+
+from benchmarks import bench_icam, bench_ids, bench_ingest, bench_parse, bench_pipeline, bench_shards, results
+
+SUITES = ('parse', 'ids', 'icam', 'ingest', 'pipeline', 'shards')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmarks', description='Offline benchmarks of the fetchScript')
+    parser.add_argument('suites', nargs='*', metavar='suite', help='{} (default: all)'.format(', '.join(SUITES)))
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a quick check')
+    parser.add_argument('--name', default='suite', help='prefix of the results file')
+    parser.add_argument('--compare', metavar='OLD', help='compare the results with a previous results file')
+    args = parser.parse_args()
+    suites = args.suites or SUITES
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error('unknown suites: {}'.format(', '.join(sorted(unknown))))
+
+    suite_results = {}
+    if 'parse' in suites:
+        print('# parse')
+        suite_results['parse'] = bench_parse.run(seconds=0.2 if args.quick else 1.0,
+                                                  articles=2000 if args.quick else 20000)
+        bench_parse.report(suite_results['parse'])
+    if 'ids' in suites:
+        print('# ids')
+        suite_results['ids'] = bench_ids.run(ids=100000 if args.quick else 1000000)
+        bench_ids.report(suite_results['ids'])
+    if 'icam' in suites:
+        print('# icam')
+        suite_results['icam'] = bench_icam.run(articles=1000 if args.quick else 5000)
+        bench_icam.report(suite_results['icam'])
+    if 'ingest' in suites:
+        print('# ingest')
+        suite_results['ingest'] = bench_ingest.run(sizes=(1000,) if args.quick else (1000, 10000, 100000))
+        bench_ingest.report(suite_results['ingest'])
+    if 'pipeline' in suites:
+        print('# pipeline')
+        suite_results['pipeline'] = bench_pipeline.run(articles=500 if args.quick else 2000)
+    if 'shards' in suites:
+        print('# shards')
+        suite_results['shards'] = bench_shards.run(articles=2000 if args.quick else 20000)
+        bench_shards.report(suite_results['shards'])
+
+    path = results.save(args.name, suite_results)
+    print('saved to', path)
+    if args.compare:
+        results.compare(args.compare, path)
+
+
+if __name__ == '__main__':
+    main()
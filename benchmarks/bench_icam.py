@@ -0,0 +1,76 @@
+"""
+ICAM client throughput against the stub gateway:
+- list: Icam.iter_articles() over `articles` articles, paged and fetched concurrently
+- post: Icam.post_articles_bulk() of `articles` new articles
+
+Usage: python -m benchmarks.bench_icam [--articles 5000] [--latency 0.02] [--save]
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from benchmarks import results
+from benchmarks.stub_server import StubServer
+from fetch_script.icam import Icam
+
+
+def fake_article(i):
+    return {'id': i + 1, 'repoArticleId': 32000000 + i, 'reviewState': 'Hold', 'repoDate': '2020-04-07',
+            'articleTitle': 'Stub article {}'.format(i), 'articleAbstract': 'Lorem ipsum dolor sit amet. ' * 40,
+            'articleJournal': 'Stub Journal', 'articleDate': '26-Mar-2020', 'fetchDate': '2020-04-07',
+            'srepo': {'id': 1}}
+
+
+def bench_list(articles, latency, page_size, page_workers):
+    with StubServer(latency=latency) as server:
+        server.articles = [fake_article(i) for i in range(articles)]
+        icam = Icam(server.url, 'user', 'user', page_size=page_size, page_workers=page_workers)
+        start = time.perf_counter()
+        listed = sum(1 for _ in icam.iter_articles())
+        elapsed = time.perf_counter() - start
+    assert listed == articles, listed
+    return {'seconds': elapsed, 'articles_per_s': articles / elapsed}
+
+
+def bench_post(articles, latency, max_in_flight):
+    new = [{k: v for k, v in fake_article(i).items() if k != 'id'} for i in range(articles)]
+    with StubServer(latency=latency, keep_articles=False) as server:
+        icam = Icam(server.url, 'user', 'user', max_in_flight=max_in_flight)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = icam.post_articles_bulk(new, 1)
+        elapsed = time.perf_counter() - start
+    assert len(report.created) == articles, report.summary()
+    return {'seconds': elapsed, 'articles_per_s': articles / elapsed}
+
+
+def run(articles=5000, latency=0.02):
+    return {
+        'list_serial': bench_list(articles, latency, page_size=100, page_workers=1),
+        'list': bench_list(articles, latency, page_size=100, page_workers=4),
+        'post_serial': bench_post(articles // 5, latency, max_in_flight=1),
+        'post': bench_post(articles, latency, max_in_flight=8),
+    }
+
+
+def report(icam_results):
+    for name, r in icam_results.items():
+        print('{:>12}: {:.2f}s ({:.0f} articles/s)'.format(name, r['seconds'], r['articles_per_s']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--articles', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the stub waits before each reply')
+    parser.add_argument('--save', action='store_true', help='save the results under benchmarks/results/')
+    args = parser.parse_args()
+
+    icam_results = run(args.articles, args.latency)
+    report(icam_results)
+    if args.save:
+        print('saved to', results.save('icam', {'icam': icam_results}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Id index of `ids` PubMed-like ids, an IdIndex against the set of ints it replaces:
+- build: time and memory (tracemalloc) to build each from a stream of ids
+- missing: ids of a 10k search result that are not in the index
+- repeated: find_repeated() over the ids with 1% duplicates, against a Counter
+- mmap: IdIndex.save() then load() of the index, and the missing ids on the mapped file
+
+Usage: python -m benchmarks.bench_ids [--ids 1000000] [--save]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+from benchmarks import results
+from fetch_script.idindex import IdIndex, find_repeated
+
+
+def measure(func):
+    """
+    :return: func's result, the seconds it took and the memory its result holds, in bytes (from a second call, since
+             tracemalloc slows allocations down)
+    """
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    kept = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return value, elapsed, size
+
+
+def run(ids=1000000, search=10000):
+    rng = random.Random(0)
+    id_list = [rng.randrange(1, 40000000) for _ in range(ids)]
+    id_list += id_list[:ids // 100]
+    candidates = [rng.randrange(1, 40000000) for _ in range(search)]
+
+    # Like the ids of an ICAM listing, every id is a new int object, that the set keeps and the index doesn't
+    index, index_seconds, index_bytes = measure(lambda: IdIndex(i + 0 for i in id_list))
+    id_set, set_seconds, set_bytes = measure(lambda: set(i + 0 for i in id_list))
+
+    index.missing(candidates[:100])  # Warm up
+    start = time.perf_counter()
+    new = index.missing(candidates)
+    missing = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = [i for i in candidates if i not in id_set]
+    set_missing = time.perf_counter() - start
+    assert new == expected, 'missing ids differ'
+
+    start = time.perf_counter()
+    repeated = find_repeated(iter(id_list))
+    repeated_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    counted = sorted(i for i, count in Counter(id_list).items() if count > 1)
+    counter_seconds = time.perf_counter() - start
+    assert list(repeated) == counted, 'repeated ids differ'
+
+    path = os.path.join(tempfile.mkdtemp(), 'ids.npy')
+    start = time.perf_counter()
+    index.save(path)
+    saved = time.perf_counter() - start
+    start = time.perf_counter()
+    mapped = IdIndex.load(path)
+    loaded = time.perf_counter() - start
+    start = time.perf_counter()
+    assert mapped.missing(candidates) == expected, 'mapped missing ids differ'
+    mapped_missing = time.perf_counter() - start
+    del mapped
+    file_bytes = os.path.getsize(path)
+    os.remove(path)
+
+    return {
+        'ids': len(index),
+        'index': {'build_seconds': index_seconds, 'bytes': index_bytes, 'missing_seconds': missing,
+                  'repeated_seconds': repeated_seconds},
+        'set': {'build_seconds': set_seconds, 'bytes': set_bytes, 'missing_seconds': set_missing,
+                'repeated_seconds': counter_seconds},
+        'mmap': {'save_seconds': saved, 'load_seconds': loaded, 'missing_seconds': mapped_missing,
+                 'file_bytes': file_bytes},
+    }
+
+
+def report(id_results):
+    print('{} ids'.format(id_results['ids']))
+    for name in ('index', 'set'):
+        r = id_results[name]
+        print('{:>6}: {:.2f}s to build, {:.1f} MB, missing {:.1f}ms, repeated ids {:.2f}s'.format(
+            name, r['build_seconds'], r['bytes'] / 1024 ** 2, r['missing_seconds'] * 1000, r['repeated_seconds']))
+    r = id_results['mmap']
+    print('  mmap: {:.1f} MB file, saved in {:.3f}s, loaded in {:.4f}s, missing {:.1f}ms'.format(
+        r['file_bytes'] / 1024 ** 2, r['save_seconds'], r['load_seconds'], r['missing_seconds'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ids', type=int, default=1000000)
+    parser.add_argument('--save', action='store_true', help='save the results under benchmarks/results/')
+    args = parser.parse_args()
+
+    id_results = run(args.ids)
+    report(id_results)
+    if args.save:
+        print('saved to', results.save('ids', {'ids': id_results}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+End-to-end ingest of 1k/10k/100k articles: ESearch, EFetch of the recorded fixtures, parse and POST to the stub
+gateway, through the same fetch_articles_pubmed() as a real run.
+
+Each size runs in a fresh process, with the stub in another one, so the memory high-water mark (peak RSS) is the
+ingest's own. The stub has no rate limit, so neither has the client here.
+
+Usage: python -m benchmarks.bench_ingest [--sizes 1000 10000 100000] [--latency 0] [--save]
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import resource
+import sys
+import time
+
+from benchmarks import results
+from benchmarks.stub_server import FIXTURES, StubServer
+
+
+def serve(conn, latency):
+    with StubServer(latency=latency, fixtures=FIXTURES, keep_articles=False) as server:
+        conn.send(server.url)
+        conn.recv()  # Until the ingest is done
+        conn.send(server.posted)
+
+
+def ingest(conn, url, size):
+    from benchmarks.bench_pipeline import point_pubmed_at
+    from fetch_script import pubmed
+    from fetch_script.__main__ import fetch_articles_pubmed
+    from fetch_script.icam import Icam
+
+    point_pubmed_at(url)
+    pubmed.limiter = pubmed.RateLimiter(10 ** 6)
+    icam = Icam(url, 'user', 'user')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fetch_articles_pubmed(icam, size, 'covid+19')
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    conn.send({'seconds': elapsed, 'articles_per_s': size / elapsed, 'peak_rss_bytes': peak})
+
+
+def run_size(size, latency):
+    stub_conn, stub_child = multiprocessing.Pipe()
+    stub = multiprocessing.Process(target=serve, args=(stub_child, latency), daemon=True)
+    stub.start()
+    url = stub_conn.recv()
+
+    conn, child = multiprocessing.Pipe()
+    worker = multiprocessing.Process(target=ingest, args=(child, url, size))
+    worker.start()
+    result = conn.recv()
+    worker.join()
+
+    stub_conn.send('done')
+    posted = stub_conn.recv()
+    stub.join()
+    assert posted == size, (posted, size)
+    return result
+
+
+def run(sizes=(1000, 10000, 100000), latency=0.0):
+    return {str(size): run_size(size, latency) for size in sizes}
+
+
+def report(ingest_results):
+    for size, r in ingest_results.items():
+        print('{:>7} articles: {:.2f}s ({:.0f} articles/s), peak RSS {:.1f} MB'.format(
+            size, r['seconds'], r['articles_per_s'], r['peak_rss_bytes'] / 1024 ** 2))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stub waits before each reply')
+    parser.add_argument('--save', action='store_true', help='save the results under benchmarks/results/')
+    args = parser.parse_args()
+
+    ingest_results = run(args.sizes, args.latency)
+    report(ingest_results)
+    if args.save:
+        print('saved to', results.save('ingest', {'ingest': ingest_results}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Parse throughput on the recorded EFetch replies in fixtures/, without any network:
+- single: lxml.html.fromstring + parse_article on a one-article reply, like get_single_article()
+- stream: iter_articles() over a reply with `batch` copies of the article, like get_articles_batch()
+- stringify_children and get_date on the article's abstract and publication date nodes
+- parallel: `articles` articles of all the fixtures, parsed in this process vs on a ParsePool of N workers
+
+Usage: python -m benchmarks.bench_parse [--seconds 1] [--batch 200] [--articles 20000] [--workers 2 4] [--save]
+"""
+import argparse
+import io
+import os
+import time
+
+from lxml import html
+
+from benchmarks import results
+from benchmarks.stub_server import FIXTURES, load_fixture, make_article_set
+from fetch_script import pubmed
+
+
+def rate(func, seconds, per_call=1):
+    """
+    Calls func repeatedly for about `seconds` seconds.
+
+    :return: How many items per second it processed (per_call items per call)
+    """
+    func()  # Warm up
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls * per_call / elapsed
+
+
+def bench_fixture(name, seconds, batch):
+    template = load_fixture(name)
+    single = make_article_set([1], [template])
+    many = make_article_set(range(batch), [template])
+    tree = html.fromstring(single)
+    abstracts = pubmed.XPATH_ABSTRACT(tree)
+    pubdate = pubmed.XPATH_OFFICIAL_DATE(tree)
+
+    return {
+        'bytes': len(single),
+        'single_per_s': rate(lambda: pubmed.parse_article(html.fromstring(single), 1), seconds),
+        'stream_per_s': rate(lambda: list(pubmed.iter_articles(io.BytesIO(many))), seconds, batch),
+        'stringify_children_per_s': rate(lambda: [pubmed.stringify_children(a) for a in abstracts], seconds,
+                                         len(abstracts)),
+        'get_date_per_s': rate(lambda: pubmed.get_date(pubdate), seconds),
+    }
+
+
+def bench_parallel(articles, workers, chunk_size=50, batch=1000):
+    raw = make_article_set(range(articles), [load_fixture(name) for name in FIXTURES])
+    raws = pubmed.RAW_ARTICLE.findall(raw)
+    batches = [raws[start:start + batch] for start in range(0, len(raws), batch)]
+
+    start = time.perf_counter()
+    expected = list(pubmed.iter_articles(io.BytesIO(raw)))
+    single = time.perf_counter() - start
+    parallel_results = {'cpus': os.cpu_count(), 'single_per_s': articles / single}
+
+    for count in workers:
+        pool = pubmed.ParsePool(count, chunk_size)
+        list(pool.parse([raws[:chunk_size]]))  # Start the workers
+        start = time.perf_counter()
+        parsed = list(pool.parse(batches))
+        elapsed = time.perf_counter() - start
+        pool.close()
+        assert parsed == expected, 'parallel parse differs'
+        parallel_results['workers_{}_per_s'.format(count)] = articles / elapsed
+    return parallel_results
+
+
+def run(seconds=1.0, batch=200, articles=20000, workers=(2, 4)):
+    parse_results = {name: bench_fixture(name, seconds, batch) for name in FIXTURES}
+    parse_results['parallel'] = bench_parallel(articles, workers)
+    return parse_results
+
+
+def report(parse_results):
+    print('{:<18} {:>8} {:>12} {:>12} {:>14} {:>12}'.format('fixture', 'bytes', 'single/s', 'stream/s',
+                                                           'stringify/s', 'get_date/s'))
+    for name, r in parse_results.items():
+        if name == 'parallel':
+            continue
+        print('{:<18} {:>8} {:>12.0f} {:>12.0f} {:>14.0f} {:>12.0f}'.format(
+            name, r['bytes'], r['single_per_s'], r['stream_per_s'], r['stringify_children_per_s'],
+            r['get_date_per_s']))
+    parallel = parse_results['parallel']
+    single = parallel['single_per_s']
+    print('parallel parse on {} cpus: 1 process {:.0f}/s'.format(parallel['cpus'], single) + ''.join(
+        ', {} workers {:.0f}/s (x{:.2f})'.format(key.split('_')[1], value, value / single)
+        for key, value in parallel.items() if key.startswith('workers_')))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=1.0, help='time spent on each measure')
+    parser.add_argument('--batch', type=int, default=200, help='articles per streamed reply')
+    parser.add_argument('--articles', type=int, default=20000, help='articles parsed by the parallel benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4], help='pool sizes to compare')
+    parser.add_argument('--save', action='store_true', help='save the results under benchmarks/results/')
+    args = parser.parse_args()
+
+    parse_results = run(args.seconds, args.batch, args.articles, args.workers)
+    report(parse_results)
+    if args.save:
+        print('saved to', results.save('parse', {'parse': parse_results}))
+
+
+if __name__ == '__main__':
+    main()
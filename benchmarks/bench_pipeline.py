@@ -0,0 +1,66 @@
+"""
+Compares the synchronous fetch_articles_pubmed run with the --async pipeline against the local stub server.
+
+Usage: python -m benchmarks.bench_pipeline [--articles 2000] [--latency 0.05] [--save]
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from benchmarks import results
+from benchmarks.stub_server import StubServer
+from fetch_script import pubmed
+from fetch_script.__main__ import fetch_articles_pubmed
+from fetch_script.icam import Icam
+from fetch_script.pipeline import Pipeline
+
+
+def point_pubmed_at(url):
+    pubmed.EUTILS_URL = url + 'entrez/eutils/'
+    pubmed.ESEARCH_URL = pubmed.EUTILS_URL + 'esearch.fcgi'
+    pubmed.EFETCH_URL = pubmed.EUTILS_URL + 'efetch.fcgi'
+
+
+def bench_sync(url, articles):
+    icam = Icam(url, 'user', 'user')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fetch_articles_pubmed(icam, articles, 'covid+19')
+    return time.perf_counter() - start
+
+
+def bench_async(url, articles):
+    icam = Icam(url, 'user', 'user')
+    start = time.perf_counter()
+    ids = pubmed.get_ids_list(articles, 'covid+19')
+    Pipeline(icam, icam.get_srepo_id('pubmed')).run(ids)
+    return time.perf_counter() - start
+
+
+def run(articles=2000, latency=0.05):
+    pipeline_results = {}
+    for name, bench in (('sync', bench_sync), ('async', bench_async)):
+        with StubServer(latency=latency) as server:
+            point_pubmed_at(server.url)
+            elapsed = bench(server.url, articles)
+            print('{:>6}: {} articles in {:.2f}s ({:.1f} articles/s), {} posted'.format(
+                name, articles, elapsed, articles / elapsed, server.posted))
+        pipeline_results[name] = {'seconds': elapsed, 'articles_per_s': articles / elapsed}
+    return pipeline_results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--articles', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stub waits before each reply')
+    parser.add_argument('--save', action='store_true', help='save the results under benchmarks/results/')
+    args = parser.parse_args()
+
+    pipeline_results = run(args.articles, args.latency)
+    if args.save:
+        print('saved to', results.save('pipeline', {'pipeline': pipeline_results}))
+
+
+if __name__ == '__main__':
+    main()
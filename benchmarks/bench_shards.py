@@ -0,0 +1,108 @@
+"""
+Sharded backfill of `articles` articles by 1, 2, 4... --worker processes sharing a lease store, against a stub
+gateway in another process (with `latency` seconds per reply, like the real services). Checks that every article is
+posted exactly once. With --remote, the workers lease over HTTP from a LeaseServer, like pods do from the coordinator.
+
+Usage: python -m benchmarks.bench_shards [--articles 20000] [--workers 1 2 4] [--latency 0.05] [--remote] [--save]
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+
+from benchmarks import results
+from benchmarks.stub_server import FIXTURES, StubServer
+
+
+def serve(conn, latency, articles):
+    with StubServer(latency=latency, history_count=articles, fixtures=FIXTURES, keep_articles=False) as server:
+        conn.send(server.url)
+        conn.recv()  # Until the workers are done
+        conn.send(server.posted)
+
+
+def work(url, store_path, shard_size, chunk_size):
+    from benchmarks.bench_pipeline import point_pubmed_at
+    from fetch_script import pubmed
+    from fetch_script.__main__ import work_shards
+    from fetch_script.icam import Icam
+    from fetch_script.shards import LeaseStore, RemoteLeaseStore
+    from fetch_script.state import StateStore
+
+    point_pubmed_at(url)
+    pubmed.limiter = pubmed.RateLimiter(10 ** 6)
+    store = RemoteLeaseStore(store_path) if store_path.startswith('http') else LeaseStore(store_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        work_shards(Icam(url, 'user', 'user'), StateStore(':memory:'), store, 'bench', 'covid+19', shard_size,
+                    chunk_size, lease_seconds=60)
+    store.close()
+
+
+def run_workers(workers, articles, latency, shard_size, chunk_size, remote=False):
+    from fetch_script.shards import LeaseServer, LeaseStore
+
+    stub_conn, stub_child = multiprocessing.Pipe()
+    stub = multiprocessing.Process(target=serve, args=(stub_child, latency, articles), daemon=True)
+    stub.start()
+    url = stub_conn.recv()
+    store_path = os.path.join(tempfile.mkdtemp(), 'shards.sqlite')
+    server = None
+    if remote:
+        server = LeaseServer(LeaseStore(store_path), '127.0.0.1', 0).start()
+        store_path = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    start = time.perf_counter()
+    processes = [multiprocessing.Process(target=work, args=(url, store_path, shard_size, chunk_size))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+        server.store.close()
+
+    stub_conn.send('done')
+    posted = stub_conn.recv()
+    stub.join()
+    assert posted == articles, (posted, articles)
+    return {'seconds': elapsed, 'articles_per_s': articles / elapsed}
+
+
+def run(articles=20000, workers=(1, 2, 4), latency=0.05, shard_size=1000, chunk_size=200, remote=False):
+    return {'cpus': os.cpu_count(), 'remote': remote,
+            **{'workers_{}'.format(count): run_workers(count, articles, latency, shard_size, chunk_size, remote)
+               for count in workers}}
+
+
+def report(shard_results):
+    single = next(r['articles_per_s'] for key, r in shard_results.items() if key.startswith('workers_'))
+    print('sharded backfill on {} cpus{}:'.format(shard_results['cpus'],
+                                                   ', leasing over http' if shard_results.get('remote') else ''))
+    for key, r in shard_results.items():
+        if key.startswith('workers_'):
+            print('{:>3} workers: {:.2f}s ({:.0f} articles/s, x{:.2f})'.format(
+                key.split('_')[1], r['seconds'], r['articles_per_s'], r['articles_per_s'] / single))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--articles', type=int, default=20000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to compare')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stub waits before each reply')
+    parser.add_argument('--remote', action='store_true', help='lease from a LeaseServer instead of the SQLite file')
+    parser.add_argument('--save', action='store_true', help='save the results under benchmarks/results/')
+    args = parser.parse_args()
+
+    shard_results = run(args.articles, args.workers, args.latency, remote=args.remote)
+    report(shard_results)
+    if args.save:
+        print('saved to', results.save('shards', {'shards': shard_results}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Saves benchmark results with the commit they ran on, and compares two result files.
+
+Usage: python -m benchmarks.results OLD.json NEW.json
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def git_commit():
+    """
+    :return: The short hash of HEAD, with a '-dirty' suffix when there are uncommitted changes
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', 'fetch_script', 'benchmarks'], cwd=root)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def environment():
+    return {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def save(name, results):
+    """
+    Writes the results to results/<name>-<commit>.json.
+
+    :return: The path of the file
+    """
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    env = environment()
+    path = os.path.join(RESULTS_DIR, '{}-{}.json'.format(name, env['commit']))
+    with open(path, 'w') as f:
+        json.dump({'environment': env, 'results': results}, f, indent=2, sort_keys=True)
+    return path
+
+
+def flatten(results, prefix=''):
+    """
+    :return: A dict with every number in the nested results, keyed by its path, ex: 'parse.small.single_per_s'
+    """
+    flat = {}
+    for key, value in results.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(old_path, new_path):
+    """
+    Prints every result found in both files, with the change from old to new.
+    Keys ending in _per_s are better when higher, the rest (seconds, bytes) when lower.
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('{} ({}) -> {} ({})'.format(old['environment']['commit'], old['environment']['date'],
+                                      new['environment']['commit'], new['environment']['date']))
+    old_flat, new_flat = flatten(old['results']), flatten(new['results'])
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        before, after = old_flat[key], new_flat[key]
+        change = (after - before) / before * 100 if before else 0.0
+        better = change > 0 if key.endswith('_per_s') else change < 0
+        mark = '' if abs(change) < 5 else (' better' if better else ' WORSE')
+        print('{:<55} {:>14.4g} {:>14.4g} {:>+8.1f}%{}'.format(key, before, after, change, mark))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(__doc__.strip())
+        sys.exit(1)
+    compare(sys.argv[1], sys.argv[2])
@@ -0,0 +1,286 @@
+"""
+A local stand-in for NCBI's E-utilities and the ICAM gateway, so benchmarks never hit the real services.
+
+Every request sleeps `latency` seconds before replying, to mimic the network round-trip that dominates real runs.
+EFetch replies are built from a synthetic article, or from the recorded replies in fixtures/ (see load_fixture()).
+"""
+import base64
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ARTICLE_TEMPLATE = '''<PubmedArticle>
+    <MedlineCitation Status="MEDLINE" Owner="NLM">
+        <PMID Version="1">{pmid}</PMID>
+        <Article PubModel="Print-Electronic">
+            <Journal>
+                <JournalIssue CitedMedium="Internet">
+                    <PubDate><Year>2020</Year><Month>Mar</Month><Day>26</Day></PubDate>
+                </JournalIssue>
+                <Title>Stub Journal of Infectious Diseases</Title>
+            </Journal>
+            <ArticleTitle>Stub article {pmid} about COVID-19.</ArticleTitle>
+            <Abstract>
+                <AbstractText Label="BACKGROUND">{abstract}</AbstractText>
+            </Abstract>
+            <AuthorList CompleteYN="Y">
+                <Author ValidYN="Y"><LastName>Smith</LastName><ForeName>John</ForeName></Author>
+                <Author ValidYN="Y"><LastName>Doe</LastName><ForeName>Jane</ForeName></Author>
+            </AuthorList>
+        </Article>
+    </MedlineCitation>
+    <PubmedData>
+        <History>
+            <PubMedPubDate PubStatus="medline"><Year>2020</Year><Month>4</Month><Day>7</Day></PubMedPubDate>
+        </History>
+        <ArticleIdList>
+            <ArticleId IdType="pubmed">{pmid}</ArticleId>
+            <ArticleId IdType="doi">10.1000/stub.{pmid}</ArticleId>
+        </ArticleIdList>
+    </PubmedData>
+</PubmedArticle>
+'''
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+# Recorded EFetch replies, one article each, covering the shapes the parser has to deal with
+FIXTURES = ('small', 'large_abstract', 'multi_author', 'collective_author', 'non_ascii')
+
+
+def load_fixture(name):
+    """
+    :param name: One of FIXTURES
+    :return: The <PubmedArticle> of the recorded reply, as a template with a {pmid} placeholder for its PMID
+    """
+    with open(os.path.join(FIXTURES_DIR, name + '.xml'), encoding='utf-8') as f:
+        xml = f.read()
+    article = xml[xml.index('<PubmedArticle>'):xml.rindex('</PubmedArticle>') + len('</PubmedArticle>')]
+    pmid = re.search(r'<PMID[^>]*>(\d+)</PMID>', article).group(1)
+    return article.replace('{', '{{').replace('}', '}}').replace(pmid, '{pmid}') + '\n'
+
+
+def make_article_set(ids, templates=None):
+    """
+    :param ids: The PMIDs of the articles
+    :param templates: Article templates (see load_fixture()) to cycle through, default: the synthetic article
+    :return: The EFetch reply with the articles
+    """
+    if templates:
+        articles = ''.join(templates[pmid % len(templates)].format(pmid=pmid) for pmid in ids)
+    else:
+        abstract = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20
+        articles = ''.join(ARTICLE_TEMPLATE.format(pmid=pmid, abstract=abstract) for pmid in ids)
+    return '<?xml version="1.0" ?>\n<PubmedArticleSet>\n{}</PubmedArticleSet>\n'.format(articles).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer the reply so headers and body go out in one write (avoids Nagle/delayed-ACK stalls on keep-alive)
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _params(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                params.update(parse_qs(body.decode()))
+            else:
+                self.body = body
+        return url.path, {k: v[0] for k, v in params.items()}
+
+    def _reply(self, status, body=b'', content_type='application/json', headers=None):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _list_articles(self, path, params):
+        # Paginated like jHipster: page/size query parameters and a Link header with next/last/first/prev
+        page, size = int(params.get('page', 0)), int(params.get('size', 20))
+        articles = self.server.articles
+        last = max(0, (len(articles) - 1) // size)
+        url = 'http://{}:{}{}?page={{}}&size={}'.format(*self.server.server_address, path, size)
+        links = ['<{}>; rel="last"'.format(url.format(last)), '<{}>; rel="first"'.format(url.format(0))]
+        if page < last:
+            links.insert(0, '<{}>; rel="next"'.format(url.format(page + 1)))
+        if page > 0:
+            links.insert(0, '<{}>; rel="prev"'.format(url.format(page - 1)))
+        body = json.dumps(articles[page * size:(page + 1) * size]).encode()
+        self._reply(200, body, headers={'Link': ','.join(links), 'X-Total-Count': str(len(articles))})
+
+    def _entities(self, name, method):
+        entities = self.server.entities[name]
+        if method == 'GET':
+            self._reply(200, json.dumps(entities).encode())
+            return
+        with self.server.lock:
+            self.server.entity_id += 1
+            entity = dict(json.loads(self.body), id=self.server.entity_id)
+            entities.append(entity)
+        self._reply(201, json.dumps(entity).encode())
+
+    def _delete_entity(self, name, entity_id):
+        entities = self.server.entities[name]
+        entity_id = int(entity_id)
+        with self.server.lock:
+            # Like the foreign key on ICAM's database: a category with children can't be deleted
+            if any((e.get('parent') or {}).get('id') == entity_id for e in entities):
+                status = 400
+            else:
+                before = len(entities)
+                entities[:] = [e for e in entities if e['id'] != entity_id]
+                status = 204 if len(entities) != before else 404
+        self._reply(status)
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    def _route(self, method):
+        self.body = b''
+        path, params = self._params()
+        if path.endswith('esearch.fcgi') and params.get('usehistory') == 'y':
+            body = ('<eSearchResult><Count>{}</Count><RetMax>0</RetMax><RetStart>0</RetStart>'
+                    '<QueryKey>1</QueryKey><WebEnv>STUB_WEBENV</WebEnv><IdList></IdList></eSearchResult>')
+            self._reply(200, body.format(self.server.history_count).encode(), 'text/xml')
+        elif path.endswith('efetch.fcgi') and 'WebEnv' in params:
+            retstart, retmax = int(params['retstart']), int(params['retmax'])
+            end = min(retstart + retmax, self.server.history_count)
+            ids = range(self.server.first_pmid + retstart, self.server.first_pmid + end)
+            if params.get('rettype') == 'uilist':
+                self._reply(200, ''.join('{}\n'.format(i) for i in ids).encode(), 'text/plain')
+            else:
+                self._reply(200, make_article_set(ids, self.server.templates), 'text/xml')
+        elif path.endswith('esearch.fcgi'):
+            count = int(params.get('retmax', 20))
+            ids = ''.join('<Id>{}</Id>'.format(self.server.first_pmid + i) for i in range(count))
+            body = '<eSearchResult><Count>{0}</Count><RetMax>{0}</RetMax><IdList>{1}</IdList></eSearchResult>'
+            self._reply(200, body.format(count, ids).encode(), 'text/xml')
+        elif path.endswith('efetch.fcgi'):
+            ids = [int(i) for i in params['id'].split(',')]
+            self._reply(200, make_article_set(ids, self.server.templates), 'text/xml')
+        elif path.endswith('api/authenticate'):
+            self._reply(200, json.dumps({'id_token': self.server.issue_token()}).encode())
+        elif '/services/' in path and not self.server.token_is_valid(self.headers.get('Authorization', '')):
+            self._reply(401, b'{"title": "Unauthorized"}')
+        elif path.endswith('api/source-repos') and method == 'GET':
+            self._reply(200, json.dumps(self.server.repos).encode())
+        elif path.endswith('api/source-repos') and method == 'POST':
+            with self.server.lock:
+                repo = dict(json.loads(self.body), id=len(self.server.repos) + 1)
+                self.server.repos.append(repo)
+            self._reply(201, json.dumps(repo).encode())
+        elif path.rsplit('/', 1)[-1] in self.server.entities:
+            self._entities(path.rsplit('/', 1)[-1], method)
+        elif '/api/category-trees/' in path or '/api/article-types/' in path:
+            self._delete_entity(*path.rsplit('/', 2)[1:])
+        elif path.endswith('api/articles') and method == 'GET':
+            self._list_articles(path, params)
+        elif path.endswith('api/articles') and method == 'POST':
+            with self.server.lock:
+                self.server.posted += 1
+                article = json.loads(self.body)
+                article['id'] = self.server.posted
+                if self.server.keep_articles:
+                    self.server.articles.append(article)
+            self._reply(201, json.dumps(article).encode())
+        elif path.endswith('api/articles') and method == 'PUT':
+            article = json.loads(self.body)
+            with self.server.lock:
+                index = next((i for i, a in enumerate(self.server.articles) if a['id'] == article.get('id')), None)
+                if index is not None:
+                    self.server.articles[index] = article
+            self._reply(200 if index is not None else 404, json.dumps(article).encode())
+        elif '/api/articles/' in path and method == 'GET':
+            article_id = int(path.rsplit('/', 1)[1])
+            article = next((a for a in self.server.articles if a['id'] == article_id), None)
+            self._reply(200 if article else 404, json.dumps(article or {}).encode())
+        elif '/api/articles/' in path and method == 'DELETE':
+            article_id = int(path.rsplit('/', 1)[1])
+            with self.server.lock:
+                before = len(self.server.articles)
+                self.server.articles[:] = [a for a in self.server.articles if a['id'] != article_id]
+                found = len(self.server.articles) != before
+            self._reply(204 if found else 404)
+        else:
+            self._reply(404, b'{}')
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, first_pmid=32000000, history_count=5000, token_ttl=3600, fixtures=None,
+                 keep_articles=True):
+        """
+        :param fixtures: Names of the recorded replies (see FIXTURES) EFetch cycles through, default: synthetic
+        :param keep_articles: Whether posted articles are kept (and listed), turn off for big ingest benchmarks
+        """
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.templates = [load_fixture(name) for name in fixtures or ()]
+        self.keep_articles = keep_articles
+        self.first_pmid = first_pmid
+        self.history_count = history_count
+        self.token_ttl = token_ttl
+        self.auth_calls = 0
+        self.lock = threading.Lock()
+        self.posted = 0
+        self.articles = []
+        self.repos = [{'id': 1, 'itemName': 'pubmed', 'active': True}]
+        self.entities = {'article-types': [], 'category-trees': []}
+        self.entity_id = 0
+
+    def issue_token(self):
+        # Shaped like jHipster's JWT (unsigned, the stub doesn't check signatures)
+        with self.lock:
+            self.auth_calls += 1
+        claims = {'sub': 'user', 'exp': int(time.time() + self.token_ttl)}
+        payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+        return 'eyJhbGciOiJIUzUxMiJ9.{}.stub'.format(payload)
+
+    def token_is_valid(self, authorization):
+        try:
+            payload = authorization.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        except (IndexError, ValueError):
+            return False
+        return claims['exp'] > time.time()
+
+    def handle_error(self, request, client_address):
+        # Clients dropping their keep-alive connections at the end of a run is expected, not an error
+        if not issubclass(sys.exc_info()[0], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -1,52 +1,840 @@
+import argparse
 import configparser
+import cProfile
+import datetime
 import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 
-from fetch_script.icam import Icam
-from fetch_script import pubmed
+import requests
+
+from fetch_script.cache import ResponseCache
+from fetch_script.icam import BulkReport, Icam, article_srepo_id, content_hash, is_transient
+from fetch_script.metrics import configure_logs, echo, log, metrics, plain_out
+from fetch_script import outbox, pubmed
+from fetch_script.sessions import make_session
+from fetch_script.shards import LeaseServer, LeaseStore, RemoteLeaseStore, ShardFailed, ShardWorker
+from fetch_script.sources import PubMedSource, load_sources
+from fetch_script.sources.pubmed import MAX_INCREMENTAL_ARTICLES
+from fetch_script.state import StateStore
 
 
 # fetchScript utils function
 # -----------------------------------------------------
-def get_pubmed_new_article_ids(icam, pubmed_id_list):
-    print('looking for new articles')
-    icam_ids = icam.get_articles_pubmed_ids()
-    new_articles = list(set(pubmed_id_list) - set(icam_ids))
-    return new_articles
+def get_new_article_ids(icam, srepo, id_list, state=None):
+    echo(f'{srepo}: looking for new articles')
+    if state is not None:
+        new = state.filter_new(srepo, id_list)
+        # Articles in the outbox were already fetched, they are posted by the flush
+        queued = state.queued_ids(srepo, new) if outbox.enabled else ()
+        return [i for i in new if i not in queued]
+    icam_ids = icam.get_articles_repo_ids(icam.get_srepo_id(srepo))
+    return icam_ids.missing(id_list)
+
+
+def reconcile_state(icam, state, srepos, interval_hours, force=False):
+    """
+    The local index of known articles can drift from ICAM (articles deleted or posted by someone else), so every
+    interval_hours it is rebuilt from the full ICAM listing. Routine runs only look at the local index.
+    All the source repos due are rebuilt from a single listing. If the listing fails, the stored index is left as it
+    is and the reconcile is tried again on the next run.
+    """
+    now = time.time()
+    due = [srepo for srepo in srepos
+           if force or now - float(state.get(f'{srepo}.last_reconcile', 0)) >= interval_hours * 3600]
+    if not due:
+        return
+    echo('reconciling local state with icam:', ', '.join(due))
+    srepo_names = {icam.get_srepo_id(srepo): srepo for srepo in due}
+
+    def rows():
+        for article in icam.iter_articles():
+            srepo_id = article_srepo_id(article)
+            # Articles listed without their sourceRepo count for every source, so they are never imported twice
+            if srepo_id is None:
+                for srepo in due:
+                    yield srepo, article['repoArticleId'], None, None
+            elif srepo_id in srepo_names:
+                yield srepo_names[srepo_id], article['repoArticleId'], article['id'], content_hash(article)
+
+    try:
+        state.replace_articles(due, rows())
+    except (requests.RequestException, ValueError) as e:
+        echo(f'reconciling failed, keeping the local state as it is: {e!r}')
+        return
+    for srepo in due:
+        state.set(f'{srepo}.last_reconcile', now)
+        echo(f'{srepo}:', state.count_ids(srepo), 'articles on icam')
+
+
+def post_articles(icam, articles, srepo_id, state=None, srepo=None, results=None):
+    """
+    Posts the articles to ICAM concurrently, see Icam.post_articles_bulk().
+    With a state store, the articles posted are added to the known ids, with their ICAM id and content hash for
+    --update. With the outbox on, every batch of articles is stored in the outbox before being posted, and the
+    articles of the source repo still waiting there from previous runs are posted too.
+
+    :param results: A BulkReport the results are added to
+    :return: The repoArticleIds of the articles that are now on ICAM (created or already there)
+    """
+    if state is not None and outbox.enabled:
+        report = BulkReport()
+        articles = iter(articles)
+        flushing = True
+        while True:
+            batch = list(islice(articles, outbox.batch_size))
+            state.queue_articles(srepo, batch)
+            # Once ICAM is failing, the rest is only stored, for the next run
+            if flushing:
+                flushing = outbox.flush(icam, state, srepo, srepo_id, report)
+            if not batch:
+                break
+    else:
+        report = icam.post_articles_bulk(articles, srepo_id)
+        if state is not None:
+            state.add_ids(srepo, list(report.created) + report.duplicates)
+            state.set_hashes(srepo, ((entry, icam_id, report.hashes.get(entry))
+                                     for entry, icam_id in report.created.items()))
+    for entry, (status_code, body) in report.errors.items():
+        echo('problem posting {}: {} | {}'.format(entry, status_code, body))
+    echo('push report:', report.summary())
+    if state is not None and outbox.enabled:
+        waiting, dead = state.count_outbox().get(srepo, (0, 0))
+        if waiting or dead:
+            echo(f'outbox: {waiting} {srepo} articles waiting, {dead} dead letters')
+    if results is not None:
+        results.merge(report)
+    return list(report.created) + report.duplicates
+
+
+def count_failed(state, srepo, ids, posted_ids):
+    """
+    :return: How many of the ids are neither on ICAM now nor safe in the outbox
+    """
+    missing = set(ids) - set(posted_ids)
+    if missing and state is not None and outbox.enabled:
+        missing -= state.queued_ids(srepo, missing)
+    return len(missing)
+
+
+def flush_outbox(icam, state, retry_dead=False):
+    """
+    --flush: posts the articles waiting in the outbox of every source, without fetching anything.
+
+    :param retry_dead: Whether the dead letters get a new set of attempts first
+    """
+    if retry_dead:
+        echo('outbox:', state.requeue_dead(), 'dead letters requeued')
+    for srepo, (waiting, dead) in state.count_outbox().items():
+        echo(f'outbox: {waiting} {srepo} articles waiting, {dead} dead letters')
+        if waiting:
+            post_articles(icam, [], icam.get_srepo_id(srepo), state, srepo)
+    for srepo, entry, attempts, error in state.dead_letters():
+        echo(f'dead letter {srepo} {entry} after {attempts} attempts: {error}')
 
 
 # the actual job of the fetchScript
 # -----------------------------------------------------------------
-def fetch_articles_pubmed(icam, num_articles, search_term):
-    new_articles_ids = get_pubmed_new_article_ids(icam, pubmed.get_ids_list(num_articles, search_term))
+def fetch_articles(icam, source, state=None):
+    """
+    Imports the new articles of a source, see sources.Source.
+
+    :return: The number of articles now on ICAM that weren't before
+    """
+    start = time.perf_counter()
+    new_articles_ids = get_new_article_ids(icam, source.name, source.list_new_ids(state), state)
     new = len(new_articles_ids)
-    print(new, 'new articles!')
-    print('starting push!' if new else 'no new articles!')
-    for entry in new_articles_ids:
-        print(f'submitting pubmed id #{entry}')
-        r = icam.post_new_articles(pubmed.get_single_article(entry), icam.get_srepo_id('pubmed'))
-        # If we didn't get a 201 back, log the problem to console
-        if r.status_code != 201:
-            print('problem posting {}: {} | {}'.format(entry, r.status_code, r.json()))
-    print('no more articles to push!' if new else '')
+    echo(f'{source.name}:', new, 'new articles!')
+    echo('starting push!' if new else 'no new articles!')
+    waiting = state.count_outbox().get(source.name, (0, 0))[0] if state is not None and outbox.enabled else 0
+    if waiting:
+        echo(f'{source.name}: {waiting} articles waiting in the outbox')
+    srepo_id = icam.get_srepo_id(source.name) if new or waiting else None
+    articles = (source.to_icam_article(record) for record in source.fetch_batch(new_articles_ids))
+    posted_ids = post_articles(icam, articles, srepo_id, state, source.name) if new or waiting else []
+    echo('no more articles to push!' if new else '')
+    source.finish(state, count_failed(state, source.name, new_articles_ids, posted_ids))
+    report_source_run(source.name, new + waiting, len(posted_ids), time.perf_counter() - start)
+    return len(posted_ids)
 
 
-def main():
+def report_source_run(name, new, posted, elapsed):
+    metrics.inc('articles_posted_total', posted, source=name)
+    metrics.observe('run_seconds', elapsed, source=name)
+    rate = posted / elapsed if elapsed else 0.0
+    log('source_finished', f'{name}: {posted} of {new} new articles imported in {elapsed:.1f}s ({rate:.1f}/s)',
+        source=name, new=new, posted=posted, seconds=round(elapsed, 3), articles_per_second=round(rate, 2))
+
+
+def report_metrics(config):
+    """
+    Logs the per-stage timings of the run, and writes the Prometheus text file when [METRICS] prometheus_file is set
+    (ex: for node_exporter's textfile collector).
+    """
+    snapshot = metrics.snapshot()
+    stages = ['  {}: {count}, {sum:.3f}s, {mean:.4f}s, <={p95}s'.format(name, **h)
+              for name, h in snapshot['histograms'].items()]
+    log('run_finished', 'stages (count, total, mean, p95):\n' + '\n'.join(stages), **snapshot)
+    path = config.get('METRICS', 'prometheus_file', fallback=None)
+    if path:
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(metrics.prometheus())
+        os.replace(tmp, path)
+
+
+def fetch_articles_pubmed(icam, num_articles, search_term, state=None):
+    fetch_articles(icam, PubMedSource(num_articles, search_term), state)
+
+
+def fetch_all_sources(icam, sources, state=None):
+    """
+    Runs every source in its own worker, so a slow source doesn't hold up the others.
+    A source failing doesn't stop the others either.
+
+    :return: A dict with the number of articles imported from every source, or the exception it failed with
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(sources) or 1) as pool:
+        futures = {pool.submit(fetch_articles, icam, source, state): source for source in sources}
+        for future in as_completed(futures):
+            try:
+                results[futures[future].name] = future.result()
+            except Exception as e:
+                # todo: logging!
+                echo(f'{futures[future].name}: failed: {e!r}')
+                results[futures[future].name] = e
+    return results
+
+
+def fetch_articles_offline(icam, state=None):
+    """
+    Pushes the cached articles that are not on ICAM yet, without any request to NCBI. Only the entries of the regular
+    runs are pushed, the ones --update cached under a modification date are read back by --update.
+    Useful to re-ingest into a fresh ICAM, or to retry a failed push.
+    """
+    new_articles_ids = get_new_article_ids(icam, 'pubmed', pubmed.cache.pubmed_ids(), state)
+    new = len(new_articles_ids)
+    echo(new, 'cached articles missing from icam!')
+    if not new:
+        return
+    post_articles(icam, pubmed.get_articles_batch(new_articles_ids), icam.get_srepo_id('pubmed'), state, 'pubmed')
+
+
+def fetch_articles_pubmed_async(icam, num_articles, search_term, config, state=None):
+    # Imported here so aiohttp is only needed when running with --async
+    from fetch_script.pipeline import Pipeline
+
+    source = PubMedSource(num_articles, search_term)
+    new_articles_ids = get_new_article_ids(icam, 'pubmed', source.list_new_ids(state), state)
+    new = len(new_articles_ids)
+    echo(new, 'new articles!')
+    if not new:
+        echo('no new articles!')
+        source.finish(state, 0)
+        return
+
+    echo('starting async push!')
+    start = time.perf_counter()
+    srepo_id = icam.get_srepo_id('pubmed')
+    post_batch = None
+    if state is not None and outbox.enabled:
+        # The parsed articles go through the outbox, so the ones ICAM fails are retried by the next runs
+        def post_batch(articles):
+            return post_articles(icam, articles, srepo_id, state, 'pubmed')
+    pipeline = Pipeline(icam, srepo_id,
+                        fetch_concurrency=config.getint('ASYNC', 'fetch_concurrency', fallback=3),
+                        parse_workers=config.getint('ASYNC', 'parse_workers', fallback=2),
+                        post_concurrency=config.getint('ASYNC', 'post_concurrency', fallback=8),
+                        queue_size=config.getint('ASYNC', 'queue_size', fallback=100),
+                        batch_size=config.getint('ASYNC', 'batch_size', fallback=200),
+                        parse_executor=config.get('ASYNC', 'parse_executor', fallback='thread'),
+                        post_batch=post_batch)
+    try:
+        posted = pipeline.run(new_articles_ids)
+    finally:
+        # Even when a stage failed, what was posted is known
+        if state is not None:
+            state.add_ids('pubmed', pipeline.posted_ids)
+    report_source_run('pubmed', new, posted, time.perf_counter() - start)
+    source.finish(state, count_failed(state, 'pubmed', new_articles_ids, pipeline.posted_ids))
+
+
+def fetch_history_chunk(history, retstart, retmax):
+    """
+    Fetches a chunk of the search results kept on NCBI's history server (see pubmed.search_history()) and compares
+    the PMIDs of the chunk with the articles EFetch returned. EFetch returns some records in another form than
+    <PubmedArticle> (ex: the StatPearls chapters, as <PubmedBookArticle>): the PMIDs missing from the reply are asked
+    again by id, and the ones still missing have no article to import.
+
+    :param history: A dict with the 'webenv' and 'query_key' of the search
+    :return: The PMIDs of the chunk (fewer than retmax if the WebEnv expired), the article dicts and the PMIDs
+             without an article
+    :raises requests.RequestException: If NCBI still fails after the retries
+    """
+    ids = pubmed.get_history_ids(history['webenv'], history['query_key'], retstart, retmax)
+    articles = list(pubmed.get_history_batch(history['webenv'], history['query_key'], retstart, retmax))
+    fetched = {a['repoArticleId'] for a in articles}
+    missing = [i for i in ids if i not in fetched]
+    if missing:
+        articles.extend(pubmed.get_articles_batch(missing))
+        fetched = {a['repoArticleId'] for a in articles}
+        missing = [i for i in missing if i not in fetched]
+    return ids, articles, missing
+
+
+def harvest_backlog(icam, search_term, state, chunk_size):
+    """
+    Imports every article matching the search term, not just the latest ones: the ESearch results are kept on
+    NCBI's history server and fetched chunk_size at a time.
+
+    The offset of the last completed chunk is kept in the state store, so a crashed backfill resumes from there.
+    The WebEnv only lives a few hours, so the search is run again on every start; new papers only push the results
+    down, so resuming by offset may see some articles twice (skipped by the known index) but never misses any.
+    A chunk NCBI doesn't return in full, even after searching again, stops the backlog there until the next run; the
+    PMIDs EFetch has no <PubmedArticle> for (see fetch_history_chunk()) are skipped.
+    """
+    started = state.get('pubmed.backlog_started') or datetime.date.today().strftime('%Y/%m/%d')
+    state.set('pubmed.backlog_started', started)
+    retstart = int(state.get('pubmed.backlog_retstart', 0))
+    history = {}
+
+    def search():
+        history['count'], history['webenv'], history['query_key'] = pubmed.search_history(search_term)
+
+    def fetch(retstart):
+        try:
+            return fetch_history_chunk(history, retstart, chunk_size)
+        except requests.RequestException as e:
+            echo(f'backlog: fetching #{retstart} failed: {e!r}')
+            return [], [], []
+
+    search()
+    count = history['count']
+    echo(f'backlog: {count} articles on pubmed, resuming from #{retstart}' if retstart else
+         f'backlog: {count} articles on pubmed')
+    srepo_id = icam.get_srepo_id('pubmed')
+
+    while retstart < history['count']:
+        ids, articles, missing = fetch(retstart)
+        if len(ids) < min(chunk_size, history['count'] - retstart):
+            # The WebEnv only lives a few hours, NCBI then replies with an error instead of the IDs
+            search()
+            ids, articles, missing = fetch(retstart)
+            if len(ids) < min(chunk_size, history['count'] - retstart):
+                # Never checkpoint past articles that weren't fetched, the next run starts from this chunk again
+                echo(f'backlog: only {len(ids)} PMIDs fetched at #{retstart}, stopping there')
+                return
+        if missing:
+            # Fetching them again would never give an article, the checkpoint goes past them
+            echo(f'backlog: no article for {len(missing)} PMIDs at #{retstart}, skipping them:',
+                 ', '.join(map(str, missing)))
+        count = history['count']
+        new_ids = set(state.filter_new('pubmed', [a['repoArticleId'] for a in articles]))
+        posted_ids = post_articles(icam, (a for a in articles if a['repoArticleId'] in new_ids), srepo_id,
+                                   state, 'pubmed')
+        failed = count_failed(state, 'pubmed', new_ids, posted_ids)
+        if failed:
+            # Stop here so the failed articles are retried from this chunk on the next run
+            echo(f'backlog: {failed} articles failed, stopping at #{retstart}')
+            return
+        retstart += chunk_size
+        state.set('pubmed.backlog_retstart', retstart)
+        echo(f'backlog: {min(retstart, count)} of {count} done, {len(posted_ids)} new articles in this chunk')
+
+    # Done: routine runs go on from the day the backlog started
+    if not state.get('pubmed.last_edat'):
+        state.set('pubmed.last_edat', started)
+    state.set('pubmed.backlog_retstart', 0)
+    state.set('pubmed.backlog_started', '')
+    echo('backlog: finished!')
+
+
+def ensure_shard_job(store, job, search_term, shard_size):
+    """
+    :return: The sharded backfill job (see shards.LeaseStore.get_job()), created with the search pinned to today if
+             it doesn't exist yet
+    """
+    info = store.get_job(job)
+    if info is None:
+        maxdate = datetime.date.today().strftime('%Y/%m/%d')
+        count, _, _ = pubmed.search_history(search_term, maxdate)
+        info = store.create_job(job, search_term, maxdate, count, shard_size)
+        echo(f'shards: job {job}: {info["count"]} articles up to {info["maxdate"]}, '
+             f'{-(-info["count"] // info["shard_size"])} shards of {info["shard_size"]}')
+    return info
+
+
+def coordinate_shards(store, job, search_term, shard_size, interval=30, port=0, linger=60):
+    """
+    --coordinator: creates the sharded backfill job and reports its progress until every shard is done.
+    The workers do the work (see work_shards()). With a port, the coordinator also serves the lease store to workers
+    on other machines or pods (see shards.LeaseServer), and keeps serving linger seconds after the job finished,
+    for the workers still asking for a shard.
+    """
+    server = LeaseServer(store, port=port).start() if port else None
+    if server is not None:
+        echo(f'shards: serving the leases on port {port}')
+    info = ensure_shard_job(store, job, search_term, shard_size)
+    start, done_before = time.time(), store.progress(job)['articles']
+    while True:
+        progress = store.progress(job)
+        rate = (progress['articles'] - done_before) / max(time.time() - start, 1e-9)
+        log('shards_progress', 'shards: {done} done, {leased} leased, {expired} expired, {pending} pending, '
+                               '{articles} of {count} articles ({rate:.1f}/s), {rejected} rejected'.format(
+                                   rate=rate, **info, **progress),
+            job=job, rate=round(rate, 2), **progress)
+        if not progress['pending'] and not progress['leased'] and not progress['expired']:
+            break
+        time.sleep(interval)
+    for entry, shard, error in store.rejected(job):
+        echo(f'shards: {entry} (shard {shard}) rejected: {error}')
+    echo(f'shards: job {job} finished!')
+    if server is not None:
+        time.sleep(linger)
+        server.shutdown()
+
+
+def work_shards(icam, state, store, job, search_term, shard_size, chunk_size, lease_seconds):
+    """
+    --worker: leases shards of the backfill job and imports them chunk_size articles at a time, until no shard is
+    left, see shards.py. The job is created if the coordinator didn't already.
+
+    Every chunk posted is checkpointed in the lease store, so a crashed worker only leaves its current chunk to be
+    fetched again by the next owner of the shard. SIGTERM gives the shard back after the current chunk.
+    Articles ICAM rejects, and PMIDs EFetch returns no <PubmedArticle> for (see fetch_history_chunk()), are recorded
+    in the lease store and skipped; a transient failure (NCBI or ICAM down) gives the shard back, to be tried again
+    later.
+    """
+    info = ensure_shard_job(store, job, search_term, shard_size)
+    history = {}
+
+    def search():
+        history['count'], history['webenv'], history['query_key'] = pubmed.search_history(info['search_term'],
+                                                                                         info['maxdate'])
+        if history['count'] != info['count']:
+            echo(f'shards: the search now has {history["count"]} results instead of {info["count"]}, '
+                 f'records were added or removed up to {info["maxdate"]}')
+
+    def fetch(retstart, retmax):
+        try:
+            return fetch_history_chunk(history, retstart, retmax)
+        except requests.RequestException as e:
+            raise ShardFailed(f'fetching #{retstart} failed: {e!r}')
+
+    def work_shard(shard, checkpoint):
+        for retstart in range(shard['done_until'], shard['retend'], chunk_size):
+            retmax = min(chunk_size, shard['retend'] - retstart)
+            ids, articles, missing = fetch(retstart, retmax)
+            if len(ids) < retmax:
+                # The WebEnv only lives a few hours, NCBI then replies with an error instead of the IDs
+                search()
+                ids, articles, missing = fetch(retstart, retmax)
+                if len(ids) < min(retmax, history['count'] - retstart):
+                    raise ShardFailed(f'only {len(ids)} of {retmax} PMIDs fetched at #{retstart}')
+                if len(ids) < retmax:
+                    echo(f'shard {shard["shard"]}: only {len(ids)} of {retmax} PMIDs at #{retstart}, '
+                         f'the search has fewer results now')
+            if missing:
+                # Not a failure: fetching them again would never give an article
+                store.reject(job, shard['shard'], {pmid: 'no PubmedArticle in the EFetch reply' for pmid in missing})
+            new_ids = set(state.filter_new('pubmed', [a['repoArticleId'] for a in articles]))
+            report = BulkReport()
+            post_articles(icam, (a for a in articles if a['repoArticleId'] in new_ids), srepo_id, state, 'pubmed',
+                          report)
+            transient = [entry for entry, (status_code, _) in report.errors.items() if is_transient(status_code)]
+            if transient:
+                raise ShardFailed(f'{len(transient)} articles failed at #{retstart}')
+            if report.errors:
+                store.reject(job, shard['shard'], {entry: '{} | {}'.format(status_code, body)[:1000]
+                                                   for entry, (status_code, body) in report.errors.items()})
+            checkpoint(retstart + retmax)
+        echo(f'shard {shard["shard"]}: #{shard["retstart"]} to #{shard["retend"]} done')
+
+    search()
+    srepo_id = icam.get_srepo_id('pubmed')
+    worker = ShardWorker(store, job, lease_seconds)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    echo(f'shards: worker {worker.owner} started on job {job}')
+    completed = worker.run(work_shard)
+    echo(f'shards: worker {worker.owner} finished, {completed} shards completed')
+    return completed
+
+
+def update_articles(icam, search_term, state, days):
+    """
+    --update: keeps the articles already on ICAM in sync with PubMed's corrections (abstracts, DOIs, dates...).
+
+    Only the known articles PubMed modified (mdat) since the last update (or in the last `days` days) are fetched
+    again, and only the ones whose content hash differs from the one stored when they were posted (or reconciled)
+    are updated on ICAM. Articles without a stored ICAM id are skipped until the next reconcile.
+    The IDs of the modified articles are paged from NCBI's history server, however many there are; if any page
+    can't be fetched, the next update searches again from the same date.
+    """
+    today = datetime.date.today()
+    mindate = state.get('pubmed.last_mdat') or (today - datetime.timedelta(days=days)).strftime('%Y/%m/%d')
+    echo(f'update: searching pubmed for articles modified since {mindate}')
+    count, webenv, query_key = pubmed.search_history(search_term, mindate=mindate, datetype='mdat')
+    modified = []
+    for retstart in range(0, count, MAX_INCREMENTAL_ARTICLES):
+        try:
+            ids = pubmed.get_history_ids(webenv, query_key, retstart, MAX_INCREMENTAL_ARTICLES)
+        except requests.RequestException as e:
+            echo(f'update: fetching the modified ids from #{retstart} failed, stopping: {e!r}')
+            return
+        if len(ids) < min(MAX_INCREMENTAL_ARTICLES, count - retstart):
+            echo(f'update: only {len(ids)} modified ids fetched at #{retstart}, stopping')
+            return
+        modified.extend(ids)
+    new = set(state.filter_new('pubmed', modified))
+    known = [i for i in modified if i not in new]
+    stored = state.get_hashes('pubmed', known)
+    echo(f'update: {len(modified)} modified articles on pubmed, {len(known)} of them on icam')
+
+    # The run date as cache revision, so the new versions are downloaded instead of read from the cache
+    stamp = today.isoformat()
+    articles = pubmed.get_articles_batch(known, revisions={i: stamp for i in known})
+    skipped = []
+
+    def changes():
+        for article in articles:
+            icam_id, old_hash = stored.get(article['repoArticleId'], (None, None))
+            if icam_id is None:
+                skipped.append(article['repoArticleId'])
+            elif content_hash(article) != old_hash:
+                yield icam_id, article
+
+    report = icam.update_articles_bulk(changes())
+    for entry, (status_code, body) in report.errors.items():
+        echo('problem updating {}: {} | {}'.format(entry, status_code, body))
+    state.set_hashes('pubmed', ((entry, stored[entry][0], h)
+                                for entry, h in list(report.updated.items()) + list(report.unchanged.items())))
+    unchanged = len(known) - len(skipped) - len(report.updated) - len(report.unchanged) - len(report.errors)
+    echo(f'update report: {report.summary()}, {unchanged} with the same content'
+         + (f', {len(skipped)} without an icam id (run with --reconcile)' if skipped else ''))
+    if report.errors:
+        echo('update: next run will search again from the same date')
+    else:
+        state.set('pubmed.last_mdat', today.strftime('%Y/%m/%d'))
+
+
+def dedup_articles(icam, policy, apply, plan=None):
+    report = icam.dedup_articles(policy, dry_run=not apply, plan=plan)
+    duplicates = report['duplicates']
+    skipped = set(report['skipped'])
+    for (srepo_id, repo_article_id), (keep, delete) in duplicates.items():
+        echo(f'{repo_article_id} (srepo #{srepo_id}): keeping #{keep}, ' +
+             ('deleting' if apply else 'would delete') + f' {[i for i in delete if i not in skipped]}')
+    extra = sum(len(delete) for _, delete in duplicates.values())
+    echo(f'{len(duplicates)} duplicated articles, {extra} extra copies' +
+         (f', {len(report["failed"])} deletes failed' if apply else ' (dry run, use --apply to delete)'))
+    if report['skipped']:
+        echo(f'{len(report["skipped"])} extra copies were not in the last dry run, left for the next one:',
+             report['skipped'])
+
+
+def run_daemon(config, config_path):
+    """
+    --daemon: runs every source on its own interval in this process until SIGTERM, see daemon.Daemon.
+    The ICAM client, the http sessions and the state store are kept between runs, and rebuilt on SIGHUP only when
+    their config changed. Without a [STATE] file, the index of known articles is kept in memory.
+    """
+    from fetch_script.daemon import Daemon
+
+    pool_size = config.getint('HTTP', 'pool_size', fallback=10)
+    pubmed.configure_session(pool_size)
+    session = make_session(pool_size)
+    app = {'config': None, 'icam': None, 'sources': {}}
+    state = open_state(config) or StateStore(':memory:')
+
+    def configure():
+        new_config = read_config(config_path) if app['config'] is not None else config
+        configure_pubmed(new_config)
+        configure_outbox(new_config)
+        configure_logs(new_config.getboolean('METRICS', 'json_logs', fallback=False))
+        if app['config'] is None or dict(new_config['ICAM']) != dict(app['config']['ICAM']):
+            app['icam'] = make_icam(new_config, session)
+        app['sources'] = {source.name: source for source in load_sources(new_config)}
+        app['config'] = new_config
+        default = new_config.getfloat('DAEMON', 'interval_minutes', fallback=60)
+        return {name: new_config.getfloat(name.upper(), 'interval_minutes', fallback=default) * 60
+                for name in app['sources']}
+
+    def run_sources(names):
+        reconcile_state(app['icam'], state, names, app['config'].getfloat('STATE', 'reconcile_hours', fallback=24))
+        results = fetch_all_sources(app['icam'], [app['sources'][name] for name in names], state)
+        stats = pubmed.limiter.stats()
+        echo('pubmed: {requests} requests, {rate:.2f} requests/s, {throttle_wait:.1f}s throttled'.format(**stats))
+        return results
+
+    daemon = Daemon(configure, run_sources,
+                    health_host=config.get('DAEMON', 'health_host', fallback='0.0.0.0'),
+                    health_port=config.getint('DAEMON', 'health_port', fallback=9100))
+    try:
+        daemon.run()
+    finally:
+        state.close()
+
+
+def read_config(path):
     config = configparser.ConfigParser()
-    config.read(os.path.join(os.path.dirname(__file__), 'config.ini'))
+    config.read(path)
+    return config
+
+
+def configure_pubmed(config, offline=False, rate_share=1):
+    """
+    Sets up the E-utilities client, the parse workers and the response cache from the config.
+
+    :param rate_share: How many processes share NCBI's rate, see pubmed.configure_eutils()
+    :return: False if offline was asked without a cache to read from
+    """
+    pubmed.configure_eutils(api_key=config.get('PUBMED', 'api_key', fallback=None),
+                            tool=config.get('PUBMED', 'tool', fallback=None),
+                            email=config.get('PUBMED', 'email', fallback=None),
+                            retries=config.getint('PUBMED', 'max_retries', fallback=5),
+                            rate_share=rate_share)
+    pubmed.configure_parsing(config.getint('PUBMED', 'parse_workers', fallback=1),
+                             config.getint('PUBMED', 'parse_chunk_size', fallback=50))
+    if config.getboolean('CACHE', 'enabled', fallback=True):
+        cache_path = os.path.join(os.path.dirname(__file__), config.get('CACHE', 'path', fallback='cache'))
+        pubmed.configure_cache(ResponseCache(cache_path,
+                                             ttl=config.getfloat('CACHE', 'ttl_days', fallback=30) * 24 * 3600,
+                                             max_bytes=config.getint('CACHE', 'max_mb', fallback=1024) * 1024 ** 2),
+                               offline_only=offline)
+    else:
+        pubmed.configure_cache(None)
+        if offline:
+            return False
+    return True
+
+
+def make_icam(config, session):
+    return Icam(config['ICAM']['gateway_location'], config['ICAM']['user'], config['ICAM']['password'], session,
+                max_in_flight=config.getint('ICAM', 'max_in_flight', fallback=8),
+                post_retries=config.getint('ICAM', 'post_retries', fallback=3),
+                page_size=config.getint('ICAM', 'page_size', fallback=100),
+                page_workers=config.getint('ICAM', 'page_workers', fallback=4),
+                token_cache=config.get('ICAM', 'token_cache', fallback=None),
+                token_leeway=config.getint('ICAM', 'token_leeway', fallback=300))
+
 
-    gateway = config['ICAM']['gateway_location']
-    user = config['ICAM']['user']
-    password = config['ICAM']['password']
+def configure_outbox(config):
+    outbox.configure(config.getboolean('OUTBOX', 'enabled', fallback=True),
+                     config.getint('OUTBOX', 'batch_size', fallback=100),
+                     config.getint('OUTBOX', 'max_attempts', fallback=10),
+                     config.getfloat('OUTBOX', 'retry_minutes', fallback=5))
+
+
+def open_shards(config, url=None):
+    """
+    :param url: The url of the coordinator serving the leases (see coordinate_shards()), None to open the [SHARDS]
+                store file
+    :return: A LeaseStore or a RemoteLeaseStore
+    """
+    if url:
+        return RemoteLeaseStore(url)
+    path = os.path.join(os.path.dirname(__file__), config.get('SHARDS', 'store', fallback='shards/shards.sqlite'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return LeaseStore(path)
+
+
+def open_state(config):
+    """
+    :return: The StateStore set in [STATE], or None if it is disabled
+    """
+    if not config.getboolean('STATE', 'enabled', fallback=True):
+        return None
+    path = os.path.join(os.path.dirname(__file__), config.get('STATE', 'path', fallback='state/state.sqlite'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # The file used to sit in the package folder itself, where a volume can't be mounted
+    legacy = os.path.join(os.path.dirname(__file__), 'state.sqlite')
+    if not os.path.exists(path) and os.path.exists(legacy):
+        echo(f'moving the state store from {legacy} to {path}')
+        os.replace(legacy, path)
+    return StateStore(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='fetch_script', description='Gets new articles from PubMed into ICAM')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='run the concurrent asyncio fetch/parse/post pipeline (needs aiohttp)')
+    parser.add_argument('--backlog', action='store_true',
+                        help='import every article matching the search term, resuming an interrupted backlog')
+    parser.add_argument('--coordinator', action='store_true',
+                        help='split the backlog into [SHARDS] for --worker processes, and follow their progress')
+    parser.add_argument('--worker', nargs='?', const=True, metavar='URL',
+                        help='import shards of the backlog until none is left, leasing them from the [SHARDS] store '
+                             'or from the --coordinator at URL')
+    parser.add_argument('--dedup', action='store_true',
+                        help='report duplicated articles on ICAM instead of fetching, see --apply')
+    parser.add_argument('--apply', action='store_true',
+                        help='with --dedup, delete the duplicates (only the ones of the last dry run, if any)')
+    parser.add_argument('--provision', action='store_true',
+                        help='create the article types and category trees of the taxonomy file missing from ICAM')
+    parser.add_argument('--prune', action='store_true',
+                        help='with --provision, also delete the ones that are not in the file')
+    parser.add_argument('--offline', '--cache-only', dest='offline', action='store_true',
+                        help='never request NCBI, push the articles in the [CACHE] that are missing from ICAM')
+    parser.add_argument('--update', action='store_true',
+                        help='update the articles on ICAM that PubMed modified since the last update')
+    parser.add_argument('--flush', action='store_true',
+                        help='only post the articles waiting in the [OUTBOX], without fetching anything')
+    parser.add_argument('--retry-dead', action='store_true',
+                        help='with --flush, give the dead letters of the outbox a new set of attempts')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='rebuild the local index of known articles from ICAM before running')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, importing from every source on the intervals set in [DAEMON]')
+    parser.add_argument('--profile', nargs='?', const='fetch_script.prof', metavar='FILE',
+                        help='run under cProfile, print the hottest functions and save the stats to FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
+    config = read_config(config_path)
+    configure_logs(config.getboolean('METRICS', 'json_logs', fallback=False))
+
+    if args.profile:
+        profile_run(args, config, config_path)
+    else:
+        run(args, config, config_path)
+
+
+# Functions listed by --profile, by own time and by cumulative time
+PROFILE_TOP = 25
+
+
+def profile_run(args, config, config_path):
+    """
+    --profile: runs under cProfile, with a profiler in every thread since most of the work happens in the worker
+    pools, then prints the hottest functions of all threads together and saves the stats for snakeviz/pstats.
+    """
+    profilers = [cProfile.Profile()]
+
+    def profile_thread(*_):
+        # Called once by each new thread: swaps itself for a profiler of that thread
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ profiles every thread from the first profiler already
+            return
+        profilers.append(profiler)
+
+    threading.setprofile(profile_thread)
+    profilers[0].enable()
+    try:
+        run(args, config, config_path)
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(*profilers, stream=plain_out())
+        stats.dump_stats(args.profile)
+        echo(f'profile of {len(profilers)} threads saved to {args.profile}, hottest functions:')
+        stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+
+def run(args, config, config_path):
+    if args.daemon:
+        if args.offline or args.backlog or args.use_async or args.dedup or args.update or args.flush \
+                or args.provision or args.coordinator or args.worker:
+            echo('--daemon only works with the default mode')
+            return
+        run_daemon(config, config_path)
+        return
 
     num_articles = config.getint('PUBMED', 'num_articles')
     search_term = config['PUBMED']['search_term']
+    sources = load_sources(config)
+    # --offline, --backlog, --async, --update and the shards only work with PubMed
+    pubmed_only = args.offline or args.backlog or args.use_async or args.update or args.coordinator or args.worker
+
+    pool_size = config.getint('HTTP', 'pool_size', fallback=10)
+    pubmed.configure_session(pool_size)
+    workers = config.getint('SHARDS', 'workers', fallback=1) if args.worker else 1
+    if not configure_pubmed(config, offline=args.offline, rate_share=workers):
+        echo('--offline needs the [CACHE] to be enabled')
+        return
+
+    shard_job = (config.get('SHARDS', 'job', fallback='backlog'), search_term,
+                 config.getint('SHARDS', 'shard_size', fallback=10000))
+    if args.coordinator:
+        store = open_shards(config)
+        coordinate_shards(store, *shard_job, port=config.getint('SHARDS', 'port', fallback=0))
+        store.close()
+        return
+
+    configure_outbox(config)
+    if args.worker:
+        # A shard is checkpointed once its articles are on ICAM: articles left in this worker's outbox would be
+        # posted again by the next owner of the shard
+        outbox.configure(False)
+    icam = make_icam(config, make_session(pool_size))
+
+    if args.provision:
+        path = os.path.join(os.path.dirname(__file__), config.get('ICAM', 'taxonomy', fallback='taxonomy.json'))
+        icam.provision_taxonomy(path, prune=args.prune)
+        return
+
+    if args.dedup:
+        plan = os.path.join(os.path.dirname(__file__), config.get('ICAM', 'dedup_plan', fallback='dedup_plan.npy'))
+        dedup_articles(icam, config.get('ICAM', 'dedup_policy', fallback='oldest'), args.apply, plan)
+        return
 
-    icam = Icam(gateway, user, password)
+    state = open_state(config)
+    if state is not None:
+        reconcile_state(icam, state, ['pubmed'] if pubmed_only else [source.name for source in sources],
+                        config.getfloat('STATE', 'reconcile_hours', fallback=24), args.reconcile)
 
-    # UNCOMMENT HERE TO auto generate CategoryTrees and ArticleTypes
-    # icam.ctrees_testhook()
+    if args.worker:
+        if state is None:
+            echo('--worker needs the [STATE] store to be enabled')
+            return
+        url = args.worker if isinstance(args.worker, str) else config.get('SHARDS', 'url', fallback='')
+        store = open_shards(config, url)
+        work_shards(icam, state, store, *shard_job, config.getint('BACKLOG', 'chunk_size', fallback=1000),
+                    config.getfloat('SHARDS', 'lease_seconds', fallback=300))
+        store.close()
+    elif args.flush:
+        if state is None:
+            echo('--flush needs the [STATE] store to be enabled')
+            return
+        flush_outbox(icam, state, args.retry_dead)
+    elif args.update:
+        if state is None:
+            echo('--update needs the [STATE] store to be enabled')
+            return
+        update_articles(icam, search_term, state, config.getint('UPDATE', 'days', fallback=30))
+    elif args.offline:
+        if args.backlog or args.use_async:
+            echo('--offline only works with the default mode')
+            return
+        fetch_articles_offline(icam, state)
+    elif args.backlog:
+        if state is None:
+            echo('--backlog needs the [STATE] store to be enabled')
+            return
+        harvest_backlog(icam, search_term, state, config.getint('BACKLOG', 'chunk_size', fallback=1000))
+    elif args.use_async:
+        fetch_articles_pubmed_async(icam, num_articles, search_term, config, state)
+    else:
+        fetch_all_sources(icam, sources, state)
 
-    fetch_articles_pubmed(icam, num_articles, search_term)
+    stats = pubmed.limiter.stats()
+    echo('pubmed: {requests} requests, {rate:.2f} requests/s, {throttle_wait:.1f}s throttled'.format(**stats))
+    echo('pubmed cache: {hits} hits, {misses} misses, {size} bytes'.format(**pubmed.cache_stats()))
+    report_metrics(config)
 
 
 if __name__ == '__main__':
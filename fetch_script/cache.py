@@ -0,0 +1,115 @@
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    On-disk cache of raw EFetch XML, one gzip file per article, so re-running after a failed push or re-ingesting
+    into a fresh ICAM doesn't download the same articles again.
+
+    Files are named after the PubMed ID plus a hash of a revision stamp (ex: the article's modification date), so a
+    new revision of an article never reads an old one from the cache.
+    Entries expire ttl seconds after being stored, and when the cache grows past max_bytes the least recently used
+    entries are evicted (a file's atime is set explicitly on every hit, so it works on noatime mounts too).
+    """
+
+    def __init__(self, path, ttl=30 * 24 * 3600, max_bytes=1024 ** 3):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        return (entry for entry in os.scandir(self.path) if entry.name.endswith('.xml.gz'))
+
+    @staticmethod
+    def _name(pubmed_id, revision):
+        stamp = hashlib.sha1(str(revision).encode()).hexdigest()[:12]
+        return '{}-{}.xml.gz'.format(pubmed_id, stamp)
+
+    def _file(self, pubmed_id, revision):
+        return os.path.join(self.path, self._name(pubmed_id, revision))
+
+    def get(self, pubmed_id, revision=''):
+        """
+        :return: The cached raw XML of the article, or None if it isn't cached (or expired)
+        """
+        file = self._file(pubmed_id, revision)
+        try:
+            stored = os.stat(file).st_mtime
+            if time.time() - stored > self.ttl:
+                self._remove(file)
+                raise FileNotFoundError(file)
+            with gzip.open(file, 'rb') as f:
+                raw = f.read()
+            # Mark as recently used for the LRU eviction, keeping mtime as the time it was stored
+            os.utime(file, (time.time(), stored))
+        except (FileNotFoundError, OSError, EOFError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return raw
+
+    def put(self, pubmed_id, raw, revision=''):
+        file = self._file(pubmed_id, revision)
+        # Write to a temporary file of its own first, so a crash never leaves a half written entry and concurrent
+        # writers of the same entry (threads or processes) don't share one
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out, gzip.GzipFile(fileobj=out, mode='wb') as f:
+                f.write(raw)
+            size = os.path.getsize(tmp)
+            if os.path.exists(file):
+                size -= os.path.getsize(file)
+            os.replace(tmp, file)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with self.lock:
+            self.size += size
+            over = self.size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _remove(self, file):
+        try:
+            size = os.path.getsize(file)
+            os.remove(file)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.size -= size
+
+    def evict(self):
+        """
+        Removes the expired entries, then the least recently used ones until the cache is under 90% of max_bytes.
+        """
+        now = time.time()
+        entries = sorted(((e.stat().st_atime, e.stat().st_mtime, e.path) for e in self._entries()))
+        for atime, mtime, file in entries:
+            if now - mtime > self.ttl or self.size > self.max_bytes * 0.9:
+                self._remove(file)
+
+    def pubmed_ids(self, revision=''):
+        """
+        :param revision: Only list the entries stored under this revision stamp, the one get() will be called with
+        :return: The PubMed IDs with an entry in the cache, for offline runs
+        """
+        suffix = self._name('', revision)
+        return sorted(int(entry.name[:-len(suffix)]) for entry in self._entries() if entry.name.endswith(suffix))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size}
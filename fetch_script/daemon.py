@@ -0,0 +1,213 @@
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from fetch_script.metrics import echo, metrics
+
+# Longest wait, in seconds, between two attempts at the first configure()
+CONFIGURE_BACKOFF_MAX = 300
+
+
+class Daemon:
+    """
+    Runs the fetchScript forever in one process, instead of one process per cron run: sessions, the ICAM token and
+    the index of known articles stay warm between runs.
+
+    Every source has its own interval. The sources that are due are run together by run_sources, then the scheduler
+    sleeps until the next one is due.
+    - SIGHUP: configure() is called again (between runs), so config.ini changes apply without a restart
+    - SIGTERM / SIGINT: the run in progress is finished, then the daemon exits
+    Until configure() first succeeds (ex: the gateway is down when the pod starts), it is retried with backoff.
+    A small HTTP server answers /healthz (503 until configured and while draining) and /metrics (Prometheus text
+    format).
+    """
+
+    def __init__(self, configure, run_sources, health_host='0.0.0.0', health_port=9100):
+        """
+        :param configure: Called on start and on every SIGHUP, returns a dict with the interval in seconds of every
+                          source, by name
+        :param run_sources: Called with the names of the sources due, returns a dict with the number of articles
+                            posted for every source, or the exception it failed with
+        :param health_port: Port of the health/metrics server, 0 to disable it
+        """
+        self.configure = configure
+        self.run_sources = run_sources
+        self.health_host = health_host
+        self.health_port = health_port
+
+        self.intervals = {}
+        self.next_run = {}
+        self.stats = {}
+        self.running = []
+        self.started = time.time()
+        self.configured = False
+        self.configure_failures = 0
+        self.retry_at = None
+
+        self.wake = threading.Event()
+        self.reload_requested = False
+        self.stopping = False
+        self.lock = threading.Lock()
+
+    # Signals
+    # ------------------------------------------------------------------------------------------------------------------
+    def _on_hup(self, signum, frame):
+        echo('daemon: SIGHUP, reloading config after the current run')
+        self.reload_requested = True
+        self.wake.set()
+
+    def _on_term(self, signum, frame):
+        if self.stopping:
+            echo('daemon: already draining')
+            return
+        echo('daemon: {}, draining'.format(signal.Signals(signum).name))
+        self.stopping = True
+        self.wake.set()
+
+    # Scheduler
+    # ------------------------------------------------------------------------------------------------------------------
+    def reload(self):
+        try:
+            intervals = self.configure()
+        except Exception as e:
+            if self.configured:
+                # Keep running with the old config rather than dying on a typo in config.ini
+                echo(f'daemon: reload failed, keeping the current config: {e!r}')
+                return
+            # Nothing to run yet: try again, backing off up to CONFIGURE_BACKOFF_MAX
+            delay = min(CONFIGURE_BACKOFF_MAX, 2 ** self.configure_failures)
+            self.configure_failures += 1
+            self.retry_at = time.time() + delay
+            echo(f'daemon: configure failed, retrying in {delay}s: {e!r}')
+            return
+        now = time.time()
+        self.configured = True
+        self.retry_at = None
+        with self.lock:
+            self.intervals = intervals
+            # New sources run right away, the others keep their schedule
+            self.next_run = {name: self.next_run.get(name, now) for name in intervals}
+            for name in intervals:
+                self.stats.setdefault(name, {'runs': 0, 'failures': 0, 'posted': 0, 'last_success': 0,
+                                             'last_duration': 0})
+        echo('daemon: sources', ', '.join('{} every {:g}min'.format(name, interval / 60)
+                                          for name, interval in intervals.items()))
+
+    def run_due(self):
+        now = time.time()
+        with self.lock:
+            due = [name for name, when in self.next_run.items() if when <= now]
+        if not due:
+            return
+        self.running = due
+        try:
+            results = self.run_sources(due)
+        except Exception as e:
+            results = {name: e for name in due}
+        finally:
+            self.running = []
+
+        done = time.time()
+        with self.lock:
+            for name in due:
+                result = results.get(name)
+                stats = self.stats[name]
+                stats['runs'] += 1
+                stats['last_duration'] = done - now
+                if isinstance(result, Exception) or result is None:
+                    stats['failures'] += 1
+                else:
+                    stats['posted'] += result
+                    stats['last_success'] = done
+                if name in self.intervals:
+                    self.next_run[name] = now + self.intervals[name]
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_hup)
+        signal.signal(signal.SIGTERM, self._on_term)
+        signal.signal(signal.SIGINT, self._on_term)
+
+        self.reload()
+        server = self.start_health_server() if self.health_port else None
+
+        while not self.stopping:
+            if self.reload_requested or (self.retry_at is not None and self.retry_at <= time.time()):
+                self.reload_requested = False
+                self.reload()
+            self.run_due()
+            with self.lock:
+                sleep = min(self.next_run.values(), default=self.retry_at or time.time() + 60) - time.time()
+            if sleep > 0 and not self.stopping and not self.reload_requested:
+                self.wake.wait(sleep)
+            self.wake.clear()
+
+        if server is not None:
+            server.shutdown()
+        echo('daemon: stopped')
+
+    # Health and metrics
+    # ------------------------------------------------------------------------------------------------------------------
+    def health(self):
+        with self.lock:
+            return {
+                'status': 'draining' if self.stopping else 'ok' if self.configured else 'unconfigured',
+                'uptime': time.time() - self.started,
+                'running': list(self.running),
+                'sources': {name: dict(stats, next_run=self.next_run.get(name)) for name, stats in self.stats.items()}
+            }
+
+    def metrics(self):
+        lines = [
+            '# TYPE fetch_script_up gauge',
+            'fetch_script_up {}'.format(1 if self.configured and not self.stopping else 0),
+        ]
+        # The articles posted are in the registry already, as fetch_script_articles_posted_total
+        series = [('runs', 'runs_total', 'counter'), ('failures', 'failures_total', 'counter'),
+                  ('last_success', 'last_success_timestamp_seconds', 'gauge'),
+                  ('last_duration', 'last_run_duration_seconds', 'gauge')]
+        with self.lock:
+            for key, metric, kind in series:
+                lines.append(f'# TYPE fetch_script_{metric} {kind}')
+                for name, stats in self.stats.items():
+                    lines.append(f'fetch_script_{metric}{{source="{name}"}} {stats[key]}')
+        # Then the per-stage timings, request counts and bytes recorded by every module
+        return '\n'.join(lines) + '\n' + metrics.prometheus()
+
+    def start_health_server(self):
+        server = _HealthServer((self.health_host, self.health_port), _HealthHandler)
+        server.fetch_daemon = self
+        threading.Thread(target=server.serve_forever, name='health', daemon=True).start()
+        echo(f'daemon: health and metrics on http://{self.health_host}:{self.health_port}/')
+        return server
+
+
+class _HealthServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        daemon = self.server.fetch_daemon
+        if self.path.startswith('/healthz'):
+            health = daemon.health()
+            self._reply(200 if health['status'] == 'ok' else 503, 'application/json', json.dumps(health))
+        elif self.path.startswith('/metrics'):
+            self._reply(200, 'text/plain; version=0.0.4', daemon.metrics())
+        else:
+            self._reply(404, 'text/plain', 'not found\n')
+
+    def _reply(self, status, content_type, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Probes hit this every few seconds, keep them out of the logs
+        pass
@@ -1,10 +1,157 @@
-import requests
+import base64
+import hashlib
 import json
+import os
+import random
+import tempfile
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: processes don't coordinate their token refreshes
+    fcntl = None
+
+import requests
+
+from fetch_script import taxonomy
+from fetch_script.idindex import IdEncoder, IdIndex, find_repeated
+from fetch_script.metrics import echo, metrics
+from fetch_script.sessions import make_session
+
+# Seconds to connect to the gateway and to wait for each read of the reply, so a stalled request is retried
+REQUEST_TIMEOUT = (10, 120)
+
+# The errorKey of the 400 jHipster replies (BadRequestAlertException) for an article that is already on ICAM
+DUPLICATE_ERROR_KEYS = frozenset({'articleexists'})
+
+
+def token_expiry(token):
+    """
+    Reads the expiry date of a JWT, without verifying it (that's the gateway's job).
+
+    :param token: The JWT
+    :return: The exp claim as a unix timestamp, or None if the token doesn't have one
+    """
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def article_srepo_id(article):
+    """
+    :return: the id of the sourceRepo of an article dict from icam, or None when it isn't set
+    """
+    return (article.get('srepo') or {}).get('id')
+
+
+# The fields of an article filled in from its source: the only ones an update may change, the rest (reviewState,
+# categories...) belongs to ICAM's curators
+CONTENT_FIELDS = ('repoDate', 'articleTitle', 'articleAbstract', 'articleJournal', 'articleDate', 'articleDoi',
+                  'citation')
+
+
+def content_hash(article):
+    """
+    :return: A hash of the CONTENT_FIELDS of an article dict, to tell whether its content changed
+    """
+    content = json.dumps([article.get(field) for field in CONTENT_FIELDS], ensure_ascii=False)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def is_transient(status_code):
+    """
+    :param status_code: The status code of a reply, None for a connection error
+    :return: Whether the request may work when tried again
+    """
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def _filled_fields(article):
+    return sum(1 for value in article.values() if value not in (None, '', [], {}))
+
+
+# How to pick the article to keep among duplicates, see Icam.find_duplicates(): each article gets a rank and the
+# lowest one is kept. Ranks are single ints so the ranks of millions of articles fit in an array
+SURVIVOR_POLICIES = {
+    'oldest': lambda article: article['id'],
+    # Most fields filled in first, then the oldest
+    'complete': lambda article: -_filled_fields(article) * 2 ** 40 + article['id']
+}
+
+
+class BulkReport:
+    """
+    Per-article results of Icam.post_articles_bulk(), keyed by repoArticleId:
+    - created: the id ICAM gave to each article posted with a 201
+    - duplicates: the articles ICAM refused because they already exist (a 409, or a 400 with one of the
+      DUPLICATE_ERROR_KEYS)
+    - errors: the status code and reply of every other failure (after retries)
+    """
+
+    def __init__(self):
+        self.created = {}
+        self.duplicates = []
+        self.errors = {}
+        # content_hash() of the created articles
+        self.hashes = {}
+
+    def add(self, repo_article_id, status_code, body, article=None):
+        if status_code == 201:
+            self.created[repo_article_id] = body.get('id') if isinstance(body, dict) else None
+            if article is not None:
+                self.hashes[repo_article_id] = content_hash(article)
+        elif status_code == 409 or (status_code == 400 and isinstance(body, dict)
+                                    and body.get('errorKey') in DUPLICATE_ERROR_KEYS):
+            self.duplicates.append(repo_article_id)
+        else:
+            self.errors[repo_article_id] = (status_code, body)
+
+    def merge(self, other):
+        self.created.update(other.created)
+        self.duplicates.extend(other.duplicates)
+        self.errors.update(other.errors)
+        self.hashes.update(other.hashes)
+
+    def summary(self):
+        return '{} created, {} duplicates, {} errors'.format(len(self.created), len(self.duplicates),
+                                                             len(self.errors))
+
+
+class UpdateReport:
+    """
+    Per-article results of Icam.update_articles_bulk(), keyed by repoArticleId:
+    - updated / unchanged: the new content hash of the articles updated, or found already up to date on ICAM
+    - errors: the status code and reply of every failure (after retries)
+    """
+
+    def __init__(self):
+        self.updated = {}
+        self.unchanged = {}
+        self.errors = {}
+
+    def summary(self):
+        return '{} updated, {} unchanged, {} errors'.format(len(self.updated), len(self.unchanged),
+                                                            len(self.errors))
 
 
 class Icam:
 
-    def __init__(self, gateway, user, password):
+    def __init__(self, gateway, user, password, session=None, max_in_flight=8, post_retries=3, page_size=100,
+                 page_workers=4, token_cache=None, token_leeway=300):
+
+        # All calls to the gateway share one pooled keep-alive session
+        self.session = session if session is not None else make_session()
 
         self.auth_endpoint = gateway + 'api/authenticate'
 
@@ -16,9 +163,27 @@ class Icam:
         self.user = user
         self.password = password
 
-        self.token = self.authenticate()
-
-        self.headers = {
+        # Defaults for post_articles_bulk()
+        self.max_in_flight = max_in_flight
+        self.post_retries = post_retries
+
+        # Defaults for iter_articles()
+        self.page_size = page_size
+        self.page_workers = page_workers
+
+        # JWT lifecycle: reused from token_cache between runs, refreshed token_leeway seconds before it expires
+        self.gateway = gateway
+        self.token_cache = os.path.expanduser(token_cache) if token_cache else None
+        self.token_leeway = token_leeway
+        self.token_lock = threading.Lock()
+        self.token = None
+        self.token_exp = None
+        self.ensure_token()
+
+    @property
+    def headers(self):
+        self.ensure_token()
+        return {
             'Content-Type': 'application/json',
             'Authorization': 'Bearer ' + self.token
         }
@@ -28,23 +193,153 @@ class Icam:
             'username': self.user,
             'password': self.password
         })
-        res = requests.post(self.auth_endpoint, data=data, headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        res = self.session.post(self.auth_endpoint, data=data, headers={'Content-Type': 'application/json'},
+                                timeout=REQUEST_TIMEOUT)
+        metrics.request('icam', 'icam_auth', 'POST', res.status_code, time.perf_counter() - start, len(data),
+                        len(res.content))
         return res.json()['id_token']
 
+    def _token_is_fresh(self):
+        return self.token is not None and (self.token_exp is None or time.time() < self.token_exp - self.token_leeway)
+
+    def ensure_token(self):
+        """
+        Makes sure there is a token that won't expire in the next token_leeway seconds: first from the token cache,
+        else by authenticating. Threads sharing this Icam wait for a single refresh instead of all authenticating.
+        """
+        if self._token_is_fresh():
+            return
+        with self.token_lock:
+            if self._token_is_fresh():
+                return
+            self._refresh_token()
+
+    def reauthenticate(self, stale_token):
+        """
+        Gets a new token after the gateway rejected stale_token, unless another thread already did.
+        """
+        with self.token_lock:
+            if self.token == stale_token:
+                self._refresh_token(stale_token)
+
+    def _refresh_token(self, stale_token=None):
+        # Processes sharing the token cache take turns: the first one authenticates and saves the token, the others
+        # find it in the cache once they get the lock, so a token expiring doesn't make every worker authenticate
+        with self._token_cache_lock():
+            token = self._load_cached_token()
+            exp = token_expiry(token) if token else None
+            if token and token != stale_token and (exp is None or time.time() < exp - self.token_leeway):
+                self.token, self.token_exp = token, exp
+                return
+            self._set_token(self.authenticate())
+
+    def _set_token(self, token):
+        self.token = token
+        self.token_exp = token_expiry(token)
+        self._save_cached_token()
+
+    @contextmanager
+    def _token_cache_lock(self):
+        """
+        Holds an exclusive lock on the token cache, across processes. Without a cache (or where locking isn't
+        possible) each process is on its own.
+        """
+        fd = None
+        if self.token_cache and fcntl is not None:
+            try:
+                os.makedirs(os.path.dirname(self.token_cache) or '.', mode=0o700, exist_ok=True)
+                fd = os.open(self.token_cache + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except OSError as e:
+                echo(f'icam: can\'t lock the token cache, authenticating on my own: {e!r}')
+                if fd is not None:
+                    os.close(fd)
+                fd = None
+        try:
+            yield
+        finally:
+            if fd is not None:
+                # Closing the file releases the lock
+                os.close(fd)
+
+    def _load_cached_token(self):
+        """
+        :return: The token in the token cache, if it was saved for this gateway and user
+        """
+        if not self.token_cache:
+            return None
+        try:
+            with open(self.token_cache) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('gateway') == self.gateway and cached.get('user') == self.user:
+            return cached.get('token')
+        return None
+
+    def _save_cached_token(self):
+        """
+        Saves the token for the next runs and the other processes. The cache is only an optimization: a token that
+        can't be saved (read-only or missing home...) is still used.
+        """
+        if not self.token_cache:
+            return
+        tmp = None
+        try:
+            directory = os.path.dirname(self.token_cache) or '.'
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            # Only readable by the owner (mkstemp's mode), and written to a temporary file of this process first so
+            # readers never see half a token
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.token-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'gateway': self.gateway, 'user': self.user, 'token': self.token}, f)
+            os.replace(tmp, self.token_cache)
+        except OSError as e:
+            echo(f'icam: can\'t save the token cache: {e!r}')
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _request(self, method, url, **kwargs):
+        """
+        Sends a request to the gateway with a valid token. If the token is rejected anyway (401), authenticates
+        again and retries once.
+        """
+        headers = self.headers
+        res = self._timed_request(method, url, headers, kwargs)
+        if res.status_code == 401:
+            self.reauthenticate(headers['Authorization'][len('Bearer '):])
+            res = self._timed_request(method, url, self.headers, kwargs)
+        return res
+
+    def _timed_request(self, method, url, headers, kwargs):
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        start = time.perf_counter()
+        res = self.session.request(method, url, headers=headers, **kwargs)
+        data = kwargs.get('data') or ''
+        metrics.request('icam', self._stage(method, url), method, res.status_code, time.perf_counter() - start,
+                        len(data), len(res.content))
+        return res
+
+    def _stage(self, method, url):
+        # Names the requests in the metrics: icam_list, icam_post... for articles, else after the entity
+        if url.startswith(self.articles_endpoint):
+            return 'icam_' + {'GET': 'list'}.get(method, method.lower())
+        return 'icam_' + url.split('/api/', 1)[-1].split('/', 1)[0].replace('-', '_')
+
     # Source Repos
     # ------------------------------------------------------------------------------------------------------------------
     def get_srepo_id(self, item_name):
-        res = requests.get(self.repos_endpoint, headers=self.headers)
+        res = self._request('GET', self.repos_endpoint)
         repos = res.json()
         for elem in repos:
             if elem['itemName'] == item_name:
                 return elem['id']
 
-        print('No sourceRepo for {}! Creating...'.format(item_name))
-        res = requests.post(self.repos_endpoint, data=json.dumps({'active': True, 'itemName': item_name}),
-                            headers=self.headers)
+        echo('No sourceRepo for {}! Creating...'.format(item_name))
+        res = self._request('POST', self.repos_endpoint, data=json.dumps({'active': True, 'itemName': item_name}))
         source_repo = res.json()
-        print('Created sourceRepo ', source_repo)
+        echo('Created sourceRepo ', source_repo)
         return source_repo['id']
 
     # Articles
@@ -52,67 +347,115 @@ class Icam:
     def get_articles(self):
         """
         This function returns a list where every article on icam is represented as a dict.
-        ICAM API request all articles replies based on pages, with links to the next, previous, first and last page.
-
-        So we must get the links from the http header, add all articles on the current page to the final list, and
-        move on to the next page. This is done until current_url matches the url for the last page.
+        See iter_articles() for how the pages are fetched.
 
         :return: a list with dicts representing each article on icam's DB
         """
-        # Sets the current_url to the api endpoint
-        current_url = self.articles_endpoint
-
-        # Gets first page of articles and respective links
-        res = requests.get(url=current_url, headers=self.headers)
-        articles = res.json()
-
-        # Only try this if there is a links header to avoid exceptions!
-        if res.links:
+        return list(self.iter_articles())
 
-            # Set our loop control variable
-            is_last_page = False
-            # Keep getting articles until we reach the last page
-            while not is_last_page:
-                # If there is a page after this one
-                if 'next' in res.links.keys():
+    def iter_articles(self, size=None, max_workers=None):
+        """
+        Generator over every article on icam, so callers don't need the whole list in memory.
+        ICAM API request all articles replies based on pages, with links to the next, previous, first and last page.
 
-                    # Set current_url to the next page
-                    current_url = res.links['next']['url']
+        So we get the first page, read the link to the last page from the http header, work out the urls of every
+        page in between and fetch them concurrently, max_workers at a time. Pages are yielded in order, and only
+        max_workers pages are fetched ahead of the one being consumed.
 
-                    # Update res and get articles from the new current_url
-                    res = requests.get(url=current_url, headers=self.headers)
-                    page_articles = res.json()
+        :param size: articles per page, defaults to self.page_size
+        :param max_workers: pages fetched at the same time, defaults to self.page_workers
+        :return: a generator of dicts representing each article on icam's DB
+        """
+        return self.iter_entities(self.articles_endpoint, size, max_workers)
 
-                    # Append the new articles to our global article list
-                    articles += page_articles
+    def iter_entities(self, endpoint, size=None, max_workers=None):
+        """
+        Generator over every entity of an endpoint, paged like the articles, see iter_articles().
+        A page that can't be fetched raises (see _page()) instead of ending the listing early: callers replace their
+        state with what is listed, a short listing would make them post or create everything again.
+        """
+        size = size or self.page_size
+        max_workers = max_workers or self.page_workers
+
+        # Gets first page of entities and respective links
+        res = self._request('GET', url=endpoint, params={'page': 0, 'size': size})
+        yield from self._page(res)
+
+        if 'last' not in res.links:
+            # No way to know how many pages there are, follow the next links one at a time
+            while 'next' in res.links:
+                res = self._request('GET', url=res.links['next']['url'])
+                yield from self._page(res)
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = deque()
+            for url in self._page_urls(res.links['last']['url']):
+                pending.append(pool.submit(self._get_page, url))
+                if len(pending) >= max_workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    @staticmethod
+    def _page_urls(last_url):
+        """
+        :param last_url: The url of the last page, from the Link header
+        :return: The urls of every page after the first one, up to last_url
+        """
+        url = urlsplit(last_url)
+        query = parse_qs(url.query)
+        last_page = int(query.get('page', ['0'])[0])
+        for page in range(1, last_page + 1):
+            query['page'] = [str(page)]
+            yield urlunsplit(url._replace(query=urlencode(query, doseq=True)))
+
+    def _get_page(self, url):
+        return self._page(self._request('GET', url=url))
+
+    @staticmethod
+    def _page(res):
+        """
+        :return: The entities of a page reply
+        :raises requests.HTTPError: If the gateway replied with an error status
+        :raises ValueError: If the reply is not a list of entities
+        """
+        res.raise_for_status()
+        entities = res.json()
+        if not isinstance(entities, list):
+            raise ValueError('expected a page of entities from {}, got: {}'.format(res.url, res.text[:200]))
+        return entities
 
-                # If there is no next page, set control variable to exit loop
-                else:
-                    is_last_page = True
-        return articles
+    # The id listings below only keep the ids of each page, in an IdIndex: a few MB for a million articles
 
     def get_articles_ids(self):
-        articles = self.get_articles()
-        id_list = [elem['id'] for elem in articles]
-        return id_list
+        """
+        :return: an IdIndex of the ids of every article on icam
+        """
+        return IdIndex(elem['id'] for elem in self.iter_articles())
 
     def get_articles_pubmed_ids(self):
-        articles = self.get_articles()
-        if isinstance(articles, list):
-            id_list = [elem['repoArticleId'] for elem in articles]
-            return id_list
-        return []
+        return IdIndex(elem['repoArticleId'] for elem in self.iter_articles())
+
+    def get_articles_repo_ids(self, srepo_id):
+        """
+        :param srepo_id: the id of a sourceRepo
+        :return: an IdIndex of the repoArticleIds of the articles from that sourceRepo. Articles listed without their
+                 sourceRepo are included, so they are never imported twice.
+        """
+        return IdIndex(elem['repoArticleId'] for elem in self.iter_articles()
+                       if article_srepo_id(elem) in (srepo_id, None))
 
     def get_latest_pubmed_id(self):
         # This function is for a future optimization attempt where to find if there are new articles
         # on PubMed we look at just the last imported article's PubMed ID. WIP!
 
         # Send a first GET to obtain the links
-        res = requests.get(url=self.articles_endpoint, headers=self.headers)
+        res = self._request('GET', url=self.articles_endpoint)
 
         if res.links:
             # Get the last page
-            last_page = requests.get(url=res.links['last']['url'], headers=self.headers)
+            last_page = self._request('GET', url=res.links['last']['url'])
             # The last article to be imported is the last article of the last page!
             last = last_page.json().pop()
             return last['repoArticleId']
@@ -120,191 +463,291 @@ class Icam:
 
     def post_new_articles(self, article, srepo_id):
         article['srepo'] = {'id': srepo_id}
-        return requests.post(url=self.articles_endpoint, data=json.dumps(article), headers=self.headers)
+        return self._request('POST', url=self.articles_endpoint, data=json.dumps(article))
+
+    def post_articles_bulk(self, articles, srepo_id, chunk_size=100, max_in_flight=None, retries=None):
+        """
+        Posts many articles concurrently, up to max_in_flight requests at a time.
+        The articles are consumed chunk_size at a time, so a generator (ex: pubmed.get_articles_batch) is never
+        fully loaded in memory.
+
+        Transient failures (connection errors, timeouts, 429 and 5xx) are retried with exponential backoff.
+
+        :param articles: An iterable with article dicts
+        :param srepo_id: The id of the articles' sourceRepo
+        :param chunk_size: How many articles to take from the iterable at a time
+        :param max_in_flight: How many POSTs to run at the same time
+        :param retries: How many times to retry a transient failure
+        :return: A BulkReport with the result of every article
+        """
+        max_in_flight = max_in_flight or self.max_in_flight
+        retries = self.post_retries if retries is None else retries
+        report = BulkReport()
+        articles = iter(articles)
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            while True:
+                chunk = list(islice(articles, chunk_size))
+                if not chunk:
+                    break
+                results = pool.map(lambda a: self._post_with_retries(a, srepo_id, retries), chunk)
+                for article, (status_code, body) in zip(chunk, results):
+                    report.add(article['repoArticleId'], status_code, body, article)
+        return report
+
+    def _post_with_retries(self, article, srepo_id, retries):
+        return self._send_with_retries(lambda: self.post_new_articles(article, srepo_id), retries)
+
+    @staticmethod
+    def _send_with_retries(send, retries):
+        """
+        Calls send() until it gets a reply that is not a transient failure (connection error, timeout, 429 or 5xx).
+
+        :return: The status code (None when no reply came) and the json (or text) of the last reply
+        """
+        for attempt in range(retries + 1):
+            try:
+                res = send()
+            except requests.RequestException as e:
+                status_code, body = None, str(e)
+            else:
+                status_code = res.status_code
+                try:
+                    body = res.json()
+                except ValueError:
+                    body = res.text
+                if not is_transient(status_code):
+                    return status_code, body
+            if attempt < retries:
+                time.sleep(min(30.0, 2 ** attempt) + random.uniform(0, 1))
+        return status_code, body
+
+    def get_article(self, article_id):
+        return self._request('GET', url=self.articles_endpoint + '/{}'.format(article_id))
+
+    def update_article(self, article):
+        # jHipster's update: PUT the whole entity, with its id, to the collection
+        return self._request('PUT', url=self.articles_endpoint, data=json.dumps(article))
+
+    def update_articles_bulk(self, changes, max_in_flight=None, retries=None):
+        """
+        Updates the content of articles already on ICAM, concurrently: each article is read back from ICAM, gets the
+        CONTENT_FIELDS of the new version and is PUT only if that changed its content. The other fields (review
+        state, categories...) are left as they are on ICAM.
+
+        :param changes: An iterable of (ICAM id, new article dict) tuples
+        :param max_in_flight: How many articles to update at the same time
+        :param retries: How many times to retry a transient failure
+        :return: An UpdateReport with the result of every article
+        """
+        max_in_flight = max_in_flight or self.max_in_flight
+        retries = self.post_retries if retries is None else retries
+        report = UpdateReport()
+        changes = iter(changes)
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            while True:
+                chunk = list(islice(changes, max_in_flight * 10))
+                if not chunk:
+                    break
+                results = pool.map(lambda change: self._update_with_retries(*change, retries), chunk)
+                for (_, article), (status_code, body) in zip(chunk, results):
+                    entry = article['repoArticleId']
+                    if status_code == 200:
+                        report.updated[entry] = content_hash(article)
+                    elif status_code == 304:
+                        report.unchanged[entry] = content_hash(article)
+                    else:
+                        report.errors[entry] = (status_code, body)
+        return report
+
+    def _update_with_retries(self, article_id, article, retries):
+        status_code, current = self._send_with_retries(lambda: self.get_article(article_id), retries)
+        if status_code != 200:
+            return status_code, current
+        if content_hash(current) == content_hash(article):
+            # Not modified: ICAM already has this content
+            return 304, current
+        updated = dict(current, **{field: article.get(field) for field in CONTENT_FIELDS})
+        return self._send_with_retries(lambda: self.update_article(updated), retries)
 
     def delete_article(self, article_id):
         url = self.articles_endpoint + '/{}'.format(article_id)
-        return requests.delete(url=url, headers=self.headers)
+        return self._request('DELETE', url=url)
 
     def delete_all_articles(self):
-        print('deleting all articles!')
-        id_list = self.get_articles_ids()
-        for elem in id_list:
-            r = self.delete_article(elem)
-            if r.status_code != 204:
-                print('deleting {}: abnormal status {}'.format(elem, r.status_code))
-
-    def find_duplicate_pubmed_ids(self):
-        articles = self.get_articles()
-        a = self.get_articles_pubmed_ids()
-        dupes = []
-        for elem in articles:
-            if a.count(elem['repoArticleId']) > 1:
-                dupes.append(elem['id'])
-                articles.pop(articles.index(elem))
-        return dupes
+        echo('deleting all articles!')
+        self.delete_many(self.articles_endpoint, self.get_articles_ids())
+
+    # Duplicates
+    # ------------------------------------------------------------------------------------------------------------------
+    def find_duplicates(self, policy='oldest'):
+        """
+        Finds every (srepo, repoArticleId) with more than one article on icam, and picks which one to keep.
+        Different sources can use the same repoArticleId.
+
+        One pass over the article listing only keeps, per sourceRepo, three int64 columns: the repoArticleIds (see
+        IdEncoder), the ids and the survivor ranks. The repeated repoArticleIds are then found with a sort.
+
+        :param policy: how to pick the article to keep, one of SURVIVOR_POLICIES:
+                       'oldest' keeps the lowest id, 'complete' keeps the one with most fields filled in
+        :return: a dict (srepo id, repoArticleId) -> (id of the article to keep, list of ids to delete)
+        """
+        rank = SURVIVOR_POLICIES[policy]
+        encoder = IdEncoder()
+        columns = {}
+        for article in self.iter_articles():
+            srepo_id = article_srepo_id(article)
+            if srepo_id not in columns:
+                columns[srepo_id] = (array('q'), array('q'), array('q'))
+            repo_ids, ids, ranks = columns[srepo_id]
+            repo_ids.append(encoder.encode(article['repoArticleId']))
+            ids.append(article['id'])
+            ranks.append(rank(article))
+
+        duplicates = {}
+        for srepo_id, (repo_ids, ids, ranks) in columns.items():
+            repeated = find_repeated(repo_ids)
+            groups = {}
+            for repo_id, article_id, article_rank in zip(repo_ids, ids, ranks):
+                if repo_id in repeated:
+                    groups.setdefault(repo_id, []).append((article_rank, article_id))
+            for repo_id, articles in groups.items():
+                articles.sort()
+                duplicates[(srepo_id, encoder.decode(repo_id))] = (articles[0][1], [a for _, a in articles[1:]])
+        return duplicates
+
+    def find_duplicate_pubmed_ids(self, policy='oldest'):
+        """
+        :return: the ids of the duplicate articles to delete, one article of each (srepo, repoArticleId) is kept
+        """
+        return [article_id for _, delete in self.find_duplicates(policy).values() for article_id in delete]
+
+    def dedup_articles(self, policy='oldest', dry_run=True, plan=None):
+        """
+        Deletes the duplicate articles on icam, keeping one article per repoArticleId.
+
+        :param policy: see find_duplicates()
+        :param dry_run: only report what would be deleted
+        :param plan: optional path of an id index file (see IdIndex.save()): a dry run saves there the ids it would
+                     delete, and the next run that isn't a dry run only deletes those, so nothing is deleted that
+                     wasn't in the reviewed dry run. The file is removed once applied.
+        :return: a dict with the duplicates found (see find_duplicates()) and, when not a dry run,
+                 the ids whose delete failed with their status code and the ids left out because the plan didn't have
+                 them
+        """
+        duplicates = self.find_duplicates(policy)
+        ids = [article_id for _, delete in duplicates.values() for article_id in delete]
+        report = {'duplicates': duplicates, 'failed': {}, 'skipped': []}
+        if dry_run:
+            if plan is not None:
+                IdIndex(ids).save(plan)
+            return report
+        planned = IdIndex.load(plan) if plan is not None and os.path.exists(plan) else None
+        if planned is not None:
+            report['skipped'] = planned.missing(ids)
+            ids = planned.intersection(ids)
+            del planned
+        report['failed'] = self.delete_many(self.articles_endpoint, ids)
+        if plan is not None and os.path.exists(plan):
+            os.remove(plan)
+        return report
+
+    def delete_many(self, endpoint, ids, max_workers=None):
+        """
+        Deletes many entities of an endpoint concurrently, max_workers at a time.
+
+        :param endpoint: one of the *_endpoint urls
+        :param ids: the ids of the entities to delete
+        :param max_workers: how many DELETEs to run at the same time, defaults to self.max_in_flight
+        :return: a dict id -> status code, for every delete that didn't reply 204
+        """
+        def delete(entity_id):
+            return entity_id, self._request('DELETE', url=endpoint + '/{}'.format(entity_id))
+
+        failed = {}
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_in_flight) as pool:
+            for elem, r in pool.map(delete, ids):
+                if r.status_code != 204:
+                    echo('deleting {}: abnormal status {}'.format(elem, r.status_code))
+                    failed[elem] = r.status_code
+        return failed
+
+    # Taxonomy: article types and category trees, see taxonomy.py
+    # ------------------------------------------------------------------------------------------------------------------
+    def list_entities(self, endpoint):
+        """
+        :return: every entity of a small endpoint (article types, category trees...), usually in a single request
+        """
+        return list(self.iter_entities(endpoint, size=1000))
+
+    def create_entity(self, endpoint, entity):
+        return self._request('POST', url=endpoint, data=json.dumps(entity))
+
+    def provision_taxonomy(self, path=taxonomy.TAXONOMY_FILE, prune=False):
+        """
+        Creates the article types and category trees of the taxonomy file that are missing from icam.
+
+        :param prune: also delete the ones that are not in the file
+        """
+        return taxonomy.provision(self, taxonomy.load_taxonomy(path), prune=prune)
 
     # Article Types
     # ------------------------------------------------------------------------------------------------------------------
     def get_atypes(self):
-        res = requests.get(url=self.atypes_endpoint, headers=self.headers)
+        res = self._request('GET', url=self.atypes_endpoint)
         atypes = res.json()
-        print(atypes)
+        echo(atypes)
         return atypes
 
     def get_atypes_ids(self):
         atypes = self.get_atypes()
         id_list = [elem['id'] for elem in atypes]
-        print(id_list)
+        echo(id_list)
         return id_list
 
     def create_atypes(self):
-        atypes = ['Meta-Análise', 'Revisão Sistemática', 'RCT', 'Estudo de Coorte', 'Estudo Caso-controlo',
-                  'Estudo de Prevalência', 'Série de casos', 'Estudo de Caso',
-                  'Estudo Experimental/Modelos Matemáticos', 'Revisão não sistemática', 'Editorial/Opinião/Comunicação']
-
-        current_atypes = self.get_atypes()
-        print(current_atypes)
-        for title in atypes:
-            if not any(d['itemName'] == title for d in current_atypes):
-                print(f'atype: {title} does not exist, creating...')
-                atype_dict = {
-                    'active': True,
-                    'itemName': title
-                }
-                res = requests.post(url=self.atypes_endpoint, data=json.dumps(atype_dict), headers=self.headers)
-                print(f'response: {res.status_code}')
-            else:
-                print(f'atype: {title} already exists, skipping...')
+        taxonomy.provision(self, {'article_types': taxonomy.load_taxonomy()['article_types']})
 
     def delete_atype(self, atype_id):
         url = self.atypes_endpoint + '/{}'.format(atype_id)
-        return requests.delete(url=url, headers=self.headers)
+        return self._request('DELETE', url=url)
 
     def delete_all_atypes(self):
-        print('deleting all atypes!')
-        id_list = self.get_atypes_ids()
-        for elem in id_list:
-            r = self.delete_atype(elem)
-            if r.status_code != 204:
-                print('deleting {}: abnormal status {}'.format(elem, r.status_code))
+        echo('deleting all atypes!')
+        taxonomy.provision(self, {'article_types': []}, prune=True)
 
     def reset_atypes(self):
-        self.delete_all_atypes()
-        self.create_atypes()
+        taxonomy.provision(self, {'article_types': taxonomy.load_taxonomy()['article_types']}, reset=True)
 
     # Category Trees
     # ------------------------------------------------------------------------------------------------------------------
     def get_ctrees(self):
-        res = requests.get(url=self.ctrees_endpoint, headers=self.headers)
+        res = self._request('GET', url=self.ctrees_endpoint)
         ctrees = res.json()
-        print(f'get_ctrees: {ctrees}')
+        echo(f'get_ctrees: {ctrees}')
         return ctrees
 
     def get_ctrees_ids(self):
         ctrees = self.get_ctrees()
         id_list = [elem['id'] for elem in ctrees]
-        print(f'get_ctrees_ids: {id_list}')
+        echo(f'get_ctrees_ids: {id_list}')
         return id_list
 
     def create_ctrees(self):
-        ctrees = {
-            'Epidemiologia': [
-                'Indicadores',
-                'Previsões e Modelos Matemáticos',
-                'Vias de Transmissão',
-                'Características Infecciosas',
-                'Sobrevivência do Vírus no Ambiente'
-            ],
-            'Etiologia e Fisiopatologia': [
-                'Diferenças entre os Coronavírus',
-                'Estrutura e Sequência Genética',
-                'Mecanismos de Infeção',
-                'Estadios da Doença'
-            ],
-            'Fatores de Risco': [
-                'Género e Grupos Etários',
-                'Comorbilidades',
-                'Outros'
-            ],
-            'Clínica e Diagnóstico': [
-                'Apresentação Clínica, Evolução e Doenças Associadas',
-                'Testes Laboratoriais de Diagnóstico',
-                'Imagiologia',
-                'Outros Marcadores Laboratoriais'
-            ],
-            'Tratamento': [
-                'Terapêutica de Suporte',
-                'Oxigenoterapia, Suporte Ventilatório, Proning, ECMO',
-                'Terapêuticas Experimentais e Ensaios Clínicos'
-            ],
-            'Prevenção': [
-                'Meio Hospitalar e Cuidados de Saúde Primários',
-                'Comunidade',
-                'Vacinas'
-            ],
-            'Prognóstico': [
-                'Marcadores Clínicos, Laboratoriais e Imagiológicos',
-                'Imunidade',
-                'Outros'
-            ],
-            'Populações Especiais': [
-                'Imunossupressão',
-                'Gravidez',
-                'Pediatria'
-            ],
-            'destaques': []
-        }
-
-        current_ctrees = self.get_ctrees()
-        print(f'current ctrees: {current_ctrees}')
-        for area in ctrees.keys():
-
-            if not any(d['itemName'] == area for d in current_ctrees):
-                print(f'ctree area: {area} does not exist, creating...')
-                atype_dict = {
-                    'active': True,
-                    'itemName': area,
-                }
-                res = requests.post(url=self.ctrees_endpoint, data=json.dumps(atype_dict), headers=self.headers)
-                current_area_id = res.json()['id']
-                print(f'response {res.status_code}: {res.content}')
-
-                if ctrees[area]:
-                    print('generating children')
-                    for child in ctrees[area]:
-                        if not any(d['itemName'] == child for d in current_ctrees):
-                            print(f'ctree child: {child} does not exist, creating...')
-                            child_dict = {
-                                'active': True,
-                                'itemName': child,
-                                'parent': {"id": current_area_id}
-                            }
-                            res = requests.post(url=self.ctrees_endpoint, data=json.dumps(child_dict), headers=self.headers)
-                            print(f'response {res.status_code}' if res.status_code == 201 else f'response {res.status_code}: {res.content}')
-                        else:
-                            print(f'atype: {child} already exists, skipping...')
-            else:
-                print(f'atype: {area} already exists, skipping...')
+        taxonomy.provision(self, {'category_trees': taxonomy.load_taxonomy()['category_trees']})
 
     def delete_ctree(self, ctree_id):
         url = self.ctrees_endpoint + '/{}'.format(ctree_id)
-        return requests.delete(url=url, headers=self.headers)
+        return self._request('DELETE', url=url)
 
     def delete_all_ctrees(self):
-        # todo: cant delete parent before child! this is broken
-        print('deleting all ctrees!')
-        id_list = self.get_ctrees_ids()
-        for elem in id_list:
-            r = self.delete_ctree(elem)
-            if r.status_code != 204:
-                print('deleting {}: abnormal status {}'.format(elem, r.status_code))
+        # Children are deleted before their parents, see taxonomy.apply()
+        echo('deleting all ctrees!')
+        taxonomy.provision(self, {'category_trees': {}}, prune=True)
 
     def reset_ctrees(self):
-        self.delete_all_ctrees()
-        self.create_ctrees()
+        taxonomy.provision(self, {'category_trees': taxonomy.load_taxonomy()['category_trees']}, reset=True)
 
     def ctrees_testhook(self):
-        self.create_atypes()
-        self.create_ctrees()
-        pass
+        self.provision_taxonomy()
@@ -0,0 +1,162 @@
+import os
+from array import array
+from bisect import bisect_left
+from itertools import chain, compress, groupby, islice
+from operator import eq, itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class IdIndex:
+    """
+    Sorted set of article ids, compact enough for millions of ids: integer ids (PubMed IDs, ICAM ids) are kept in an
+    array('q'), 8 bytes per id, where a set of ints takes ~60. Lookups are a bisect, done for a whole list of ids at
+    once with numpy when it is installed.
+    Other ids (bioRxiv DOIs) can't go in an array, an index with any of them is a plain frozenset.
+
+    An integer index can be saved to a .npy file and memory-mapped back by the next run, see save() and load().
+    """
+
+    def __init__(self, ids=()):
+        """
+        :param ids: An iterable of ids, in any order, repeated or not
+        """
+        ids = iter(ids)
+        values = array('q')
+        for chunk in iter(lambda: list(islice(ids, 10000)), []):
+            try:
+                values.extend(chunk)
+            except TypeError:
+                self.ids = frozenset(chain(values, chunk, ids))
+                return
+        if numpy is not None:
+            self.ids = array('q', numpy.unique(numpy.frombuffer(values, dtype=numpy.int64)).tobytes())
+        else:
+            # Sorting goes through a list of ints, only for the time of the sort
+            self.ids = array('q', map(itemgetter(0), groupby(sorted(values))))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, i):
+        if isinstance(self.ids, frozenset):
+            return i in self.ids
+        if not isinstance(i, int):
+            return False
+        position = bisect_left(self.ids, i)
+        return position < len(self.ids) and self.ids[position] == i
+
+    def missing(self, ids):
+        """
+        :return: A list with the ids that are not in the index, in the given order
+        """
+        ids = list(ids)
+        return list(compress(ids, (not found for found in self.contains_each(ids))))
+
+    def intersection(self, ids):
+        """
+        :return: A list with the ids that are in the index, in the given order
+        """
+        ids = list(ids)
+        return list(compress(ids, self.contains_each(ids)))
+
+    def contains_each(self, ids):
+        """
+        :param ids: A list of ids
+        :return: A list of booleans, whether each id is in the index
+        """
+        if isinstance(self.ids, frozenset):
+            return [i in self.ids for i in ids]
+        if not self.ids or not ids:
+            return [False] * len(ids)
+        if numpy is None or not all(type(i) is int for i in ids):
+            return [i in self for i in ids]
+        try:
+            needles = numpy.array(ids, dtype=numpy.int64)
+        except OverflowError:
+            return [i in self for i in ids]
+        values = numpy.frombuffer(self.ids, dtype=numpy.int64)
+        # Searching the ids in sorted order walks the index from start to end, instead of jumping all over it
+        order = numpy.argsort(needles, kind='stable')
+        needles = needles[order]
+        # The last id <= each needle, an id below the whole index compares with the largest id, never equal
+        found = numpy.empty(len(ids), dtype=bool)
+        found[order] = values[numpy.searchsorted(values, needles, side='right') - 1] == needles
+        return found.tolist()
+
+    def save(self, path):
+        """
+        Writes the ids to a .npy file, that load() maps back without reading it. Only integer indexes can be saved.
+        """
+        if isinstance(self.ids, frozenset):
+            raise TypeError('only an index of integer ids can be saved')
+        if numpy is None:
+            raise RuntimeError('saving an id index needs numpy')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            numpy.save(f, numpy.frombuffer(self.ids, dtype=numpy.int64))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps an index saved by save(): the ids are paged in by the OS as they are looked up, not read in.
+        """
+        if numpy is None:
+            raise RuntimeError('loading an id index needs numpy')
+        index = cls()
+        values = numpy.load(path, mmap_mode='r')
+        if len(values):
+            # Read only view of the mapped ids, with the same interface as the array('q')
+            index.ids = memoryview(values).cast('B').cast('q')
+        return index
+
+    def nbytes(self):
+        """
+        :return: The memory taken by the ids, None for a frozenset
+        """
+        return None if isinstance(self.ids, frozenset) else self.ids.itemsize * len(self.ids)
+
+
+def find_repeated(ids):
+    """
+    :param ids: An iterable of integer ids, like an array('q')
+    :return: An IdIndex of the ids that appear more than once
+    """
+    if numpy is not None:
+        if isinstance(ids, array) and ids.typecode == 'q':
+            values = numpy.sort(numpy.frombuffer(ids, dtype=numpy.int64))
+        else:
+            values = numpy.sort(numpy.fromiter(ids, dtype=numpy.int64))
+        return IdIndex(values[1:][values[1:] == values[:-1]].tolist())
+    values = sorted(ids)
+    return IdIndex(compress(islice(values, 1, None), map(eq, islice(values, 1, None), values)))
+
+
+class IdEncoder:
+    """
+    Maps repoArticleIds to int64 so they fit in an array('q'): integer ids stay as they are, the others (DOIs) get
+    negative codes.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.names = []
+
+    def encode(self, repo_article_id):
+        if isinstance(repo_article_id, int):
+            return repo_article_id
+        code = self.codes.get(repo_article_id)
+        if code is None:
+            self.names.append(repo_article_id)
+            code = self.codes[repo_article_id] = -len(self.names)
+        return code
+
+    def decode(self, code):
+        return code if code >= 0 else self.names[-code - 1]
@@ -0,0 +1,212 @@
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets, from a single article parse to a slow EFetch
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """
+    Prometheus style histogram: a count per bucket plus the total count and sum, so observing is a bisect and
+    three additions.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        :return: The upper bound of the bucket holding the q quantile (an estimate, like Prometheus' histogram_quantile)
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Counters and latency histograms, labelled like Prometheus metrics, shared by every module of the fetchScript.
+    Everything is kept in memory under one lock, cheap enough to always be on.
+
+    - counters: inc('articles_posted_total', 10, source='pubmed')
+    - histograms: observe('stage_seconds', 0.12, stage='efetch'), or the timer() context manager
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Times the block into the stage_seconds histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def request(self, service, stage, method, status, seconds, sent=0, received=0):
+        """
+        Records an HTTP request: its count by status, its latency as a stage, and the bytes sent and received.
+
+        :param stage: What the request is for, ex: 'efetch' or 'icam_post'
+        """
+        self.inc('http_requests_total', service=service, stage=stage, method=method, status=status)
+        self.observe('stage_seconds', seconds, stage=stage)
+        if sent:
+            self.inc('http_sent_bytes_total', sent, service=service)
+        if received:
+            self.inc('http_received_bytes_total', received, service=service)
+
+    # Output
+    # ------------------------------------------------------------------------------------------------------------------
+    def snapshot(self):
+        """
+        :return: A json-able summary: counters, then the count, total, mean and p50/p95 of every histogram
+        """
+        def label(name, labels):
+            return name + ('{' + ','.join(f'{k}={v}' for k, v in labels) + '}' if labels else '')
+
+        with self.lock:
+            counters = {label(name, labels): value for (name, labels), value in sorted(self.counters.items())}
+            histograms = {
+                label(name, labels): {'count': h.count, 'sum': round(h.sum, 6),
+                                      'mean': round(h.sum / h.count, 6) if h.count else 0.0,
+                                      'p50': h.quantile(0.5), 'p95': h.quantile(0.95)}
+                for (name, labels), h in sorted(self.histograms.items())
+            }
+        return {'elapsed': round(time.time() - self.started, 3), 'counters': counters, 'histograms': histograms}
+
+    def prometheus(self, prefix='fetch_script_'):
+        """
+        :return: Every metric in the Prometheus text exposition format
+        """
+        def label(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}' if pairs else ''
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {prefix}{name} counter')
+                lines.append(f'{prefix}{name}{label(labels)} {value}')
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {prefix}{name} histogram')
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float('inf'),), h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{prefix}{name}_bucket{label(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{prefix}{name}_sum{label(labels)} {h.sum}')
+                lines.append(f'{prefix}{name}_count{label(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+
+# The registry every module records into
+metrics = Metrics()
+
+# Whether log() prints json lines, see configure_logs()
+json_logs = False
+
+
+def configure_logs(json_lines):
+    """
+    :param json_lines: Whether log() prints json lines. Then only they go to stdout, for log collectors: the plain
+                       output of echo() (progress, reports, --profile) goes to stderr.
+    """
+    global json_logs
+    json_logs = json_lines
+
+
+def plain_out():
+    """
+    :return: The stream for plain text output: stderr when json logs are on, so stdout only has json lines
+    """
+    return sys.stderr if json_logs else sys.stdout
+
+
+def echo(*values, **kwargs):
+    """
+    print() for the plain text output of the fetchScript, see plain_out()
+    """
+    print(*values, file=plain_out(), **kwargs)
+
+
+def log(event, message=None, **fields):
+    """
+    Logs an event: a json line when json logs are on (for log collectors), else a plain message like the rest of
+    the fetchScript output.
+
+    :param event: Short event name, ex: 'run_finished'
+    :param message: Human readable message, defaults to the fields
+    """
+    if json_logs:
+        print(json.dumps({'time': round(time.time(), 3), 'event': event, **fields}, default=str), flush=True)
+    else:
+        echo(message if message is not None else '{}: {}'.format(event, ', '.join(f'{k}={v}'
+                                                                                    for k, v in fields.items())))
+
+
+class CountingReader:
+    """
+    Wraps a file-like object to count the bytes read from it, for streamed replies.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes += len(data)
+        return data
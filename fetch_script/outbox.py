@@ -0,0 +1,76 @@
+"""
+Write-ahead outbox of the articles to post to ICAM, kept in the StateStore's SQLite file.
+
+Fetched articles are stored in the outbox before being posted, and removed once ICAM has them (201, or already
+there). Whatever couldn't be posted stays in the outbox and is retried by the next flushes, so a crash or an ICAM
+outage never costs a new download from the source. Transient failures (connection errors, 429, 5xx) are retried
+retry_minutes later, twice as long after each attempt; articles ICAM rejects, or still failing after max_attempts,
+become dead letters, kept until requeued with StateStore.requeue_dead().
+"""
+import time
+
+from fetch_script.icam import is_transient
+from fetch_script.metrics import echo, metrics
+
+enabled = False
+batch_size = 100
+max_attempts = 10
+retry_minutes = 5.0
+# Longest wait between two attempts
+MAX_RETRY_MINUTES = 6 * 60
+
+
+def configure(enable, batch=100, attempts=10, retry=5.0):
+    global enabled, batch_size, max_attempts, retry_minutes
+    enabled = enable
+    batch_size = batch
+    max_attempts = attempts
+    retry_minutes = retry
+
+
+def retry_delay(attempts):
+    """
+    :param attempts: How many attempts already failed
+    :return: Seconds to wait before the next attempt
+    """
+    return min(MAX_RETRY_MINUTES, retry_minutes * 2 ** (attempts - 1)) * 60
+
+
+def flush(icam, state, srepo, srepo_id, report):
+    """
+    Posts the articles of a source repo waiting in the outbox, batch_size at a time, until none is due.
+    The articles ICAM now has are added to the known ids (and their hashes) and removed from the outbox.
+
+    :param report: A BulkReport the results are added to
+    :return: False if ICAM failed a whole batch, to stop flushing until the next run instead of piling up retries
+    """
+    while True:
+        rows = state.due_articles(srepo, batch_size)
+        if not rows:
+            return True
+        attempts = {article['repoArticleId']: count for article, count in rows}
+        batch = icam.post_articles_bulk((article for article, _ in rows), srepo_id)
+        report.merge(batch)
+
+        done = list(batch.created) + batch.duplicates
+        state.add_ids(srepo, done)
+        state.set_hashes(srepo, ((entry, icam_id, batch.hashes.get(entry)) for entry, icam_id in batch.created.items()))
+        state.outbox_done(srepo, done)
+
+        retry, dead = [], []
+        for entry, (status_code, body) in batch.errors.items():
+            error = '{} | {}'.format(status_code, body)[:1000]
+            if is_transient(status_code) and attempts[entry] + 1 < max_attempts:
+                retry.append((entry, time.time() + retry_delay(attempts[entry] + 1), error))
+            else:
+                dead.append((entry, error))
+        state.outbox_retry(srepo, retry)
+        state.outbox_dead(srepo, dead)
+        metrics.inc('outbox_retries_total', len(retry), source=srepo)
+        metrics.inc('outbox_dead_letters_total', len(dead), source=srepo)
+        if dead:
+            echo(f'outbox: {len(dead)} {srepo} articles moved to the dead letters')
+
+        if batch.errors and not done:
+            echo(f'outbox: icam failed a whole batch, {srepo} articles will be retried on the next run')
+            return False
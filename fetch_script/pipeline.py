@@ -0,0 +1,229 @@
+import asyncio
+import io
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import aiohttp
+
+from fetch_script import pubmed
+from fetch_script.icam import is_transient
+from fetch_script.metrics import echo, metrics
+
+# Marks the end of the work on a queue, one per consumer
+_DONE = object()
+
+
+def parse_raw(raw):
+    """
+    Parses a raw EFetch reply, runs inside the parse stage executor (so it must stay a picklable module function).
+
+    :param raw: The bytes of a PubmedArticleSet
+    :return: A list with the dicts of every article in the reply
+    """
+    return list(pubmed.iter_articles(io.BytesIO(raw)))
+
+
+def _backoff(attempt, limit=60.0):
+    # Exponential backoff with jitter, like pubmed.retry_delay()
+    return min(limit, 2 ** attempt) + random.uniform(0, 1)
+
+
+class Pipeline:
+    """
+    Asyncio version of fetch_articles_pubmed: PubMed fetches, XML parsing and ICAM POSTs run at the same time,
+    each stage with its own concurrency, connected by bounded queues so a slow stage holds back the ones before it
+    instead of piling up work in memory.
+
+    fetch (aiohttp, EFetch batches) -> raw_q -> parse (thread/process pool) -> article_q -> post (aiohttp, ICAM)
+
+    With post_batch, the post stage hands the articles to it in batches instead (ex: to go through the outbox, see
+    __main__.post_articles()), one batch at a time in a thread.
+    """
+
+    def __init__(self, icam, srepo_id, fetch_concurrency=3, parse_workers=2, post_concurrency=8,
+                 queue_size=100, batch_size=200, parse_executor='thread', post_batch=None):
+        """
+        :param post_batch: Optional function posting a list of articles, returning the repoArticleIds now on ICAM
+        """
+        self.icam = icam
+        self.srepo_id = srepo_id
+        self.fetch_concurrency = fetch_concurrency
+        self.parse_workers = parse_workers
+        self.post_concurrency = post_concurrency
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.parse_executor = parse_executor
+        self.post_batch = post_batch
+
+        self.posted = 0
+        self.posted_ids = []
+        self.failed = []
+
+    def run(self, ids):
+        """
+        Fetches, parses and posts all the given PubMed IDs.
+
+        :param ids: A list with the PubMed IDs to import
+        :return: The number of articles posted with a 201
+        """
+        asyncio.run(self._run(list(ids)))
+        return self.posted
+
+    async def _run(self, ids):
+        batch_q = asyncio.Queue()
+        raw_q = asyncio.Queue(self.queue_size)
+        article_q = asyncio.Queue(self.queue_size)
+
+        for start in range(0, len(ids), self.batch_size):
+            batch_q.put_nowait(ids[start:start + self.batch_size])
+        for _ in range(self.fetch_concurrency):
+            batch_q.put_nowait(_DONE)
+
+        executor_class = ProcessPoolExecutor if self.parse_executor == 'process' else ThreadPoolExecutor
+        connector = aiohttp.TCPConnector(limit=self.fetch_concurrency + self.post_concurrency)
+
+        with executor_class(max_workers=self.parse_workers) as executor:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                fetchers = [asyncio.ensure_future(self._fetch(session, batch_q, raw_q))
+                            for _ in range(self.fetch_concurrency)]
+                parsers = [asyncio.ensure_future(self._parse(executor, raw_q, article_q))
+                           for _ in range(self.parse_workers)]
+                if self.post_batch is not None:
+                    # A single poster: two batches going through the outbox at once could post the same articles
+                    posters = [asyncio.ensure_future(self._post_batches(article_q))]
+                else:
+                    posters = [asyncio.ensure_future(self._post(session, article_q))
+                               for _ in range(self.post_concurrency)]
+                tasks = fetchers + parsers + posters + [
+                    asyncio.ensure_future(self._stop_stages(fetchers, parsers, posters, raw_q, article_q))]
+
+                # A stage that dies would leave the others blocked on its queue forever: the first error cancels
+                # every task and is raised
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                errors = [task.exception() for task in done if not task.cancelled() and task.exception()]
+                if errors:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise errors[0]
+
+    @staticmethod
+    async def _stop_stages(fetchers, parsers, posters, raw_q, article_q):
+        # Each stage ends when the one before it is done, then tells its own consumers to stop
+        await asyncio.gather(*fetchers)
+        for _ in parsers:
+            await raw_q.put(_DONE)
+        await asyncio.gather(*parsers)
+        for _ in posters:
+            await article_q.put(_DONE)
+        await asyncio.gather(*posters)
+
+    async def _fetch(self, session, batch_q, raw_q):
+        while True:
+            batch = await batch_q.get()
+            if batch is _DONE:
+                return
+            data = {'db': 'pubmed', 'id': ','.join(str(i) for i in batch), 'rettype': 'abstract',
+                    **pubmed.eutils_params}
+            raw = await self._efetch(session, data)
+            if raw is None:
+                self.failed.extend(batch)
+                continue
+            await raw_q.put(raw)
+
+    async def _efetch(self, session, data):
+        # Same rate limiting and retry policy as pubmed.eutils_request(), without blocking the event loop
+        attempt = 0
+        while True:
+            await asyncio.sleep(pubmed.limiter.reserve())
+            start = time.perf_counter()
+            try:
+                async with session.post(pubmed.EFETCH_URL, data=data) as res:
+                    raw = await res.read()
+                    metrics.request('pubmed', 'efetch', 'POST', res.status, time.perf_counter() - start,
+                                    len(urlencode(data)), len(raw))
+                    if res.status == 200:
+                        return raw
+                    status, delay = res.status, pubmed.retry_delay(res.status, res.headers, attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, delay = repr(e), _backoff(attempt)
+            if delay is None or attempt >= pubmed.max_retries:
+                echo('problem fetching articles from pubmed: {}'.format(status))
+                return None
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _parse(self, executor, raw_q, article_q):
+        loop = asyncio.get_running_loop()
+        while True:
+            raw = await raw_q.get()
+            if raw is _DONE:
+                return
+            start = time.perf_counter()
+            articles = await loop.run_in_executor(executor, parse_raw, raw)
+            metrics.observe('stage_seconds', time.perf_counter() - start, stage='parse_batch')
+            if self.parse_executor == 'process':
+                # Articles parsed in another process are counted in that process' metrics, which are lost
+                metrics.inc('articles_parsed_total', len(articles))
+            for article in articles:
+                await article_q.put(article)
+
+    async def _post(self, session, article_q):
+        while True:
+            article = await article_q.get()
+            if article is _DONE:
+                return
+            entry = article['repoArticleId']
+            article['srepo'] = {'id': self.srepo_id}
+            status, body = await self._post_article(session, json.dumps(article))
+            if status == 201:
+                self.posted += 1
+                self.posted_ids.append(entry)
+            else:
+                echo('problem posting {}: {} | {}'.format(entry, status, body))
+                self.failed.append(entry)
+
+    async def _post_batches(self, article_q):
+        loop = asyncio.get_running_loop()
+        batch = []
+        while True:
+            article = await article_q.get()
+            if article is not _DONE:
+                batch.append(article)
+            if batch and (article is _DONE or len(batch) >= self.batch_size):
+                posted = await loop.run_in_executor(None, self.post_batch, batch)
+                self.posted += len(posted)
+                self.posted_ids.extend(posted)
+                posted = set(posted)
+                self.failed.extend(a['repoArticleId'] for a in batch if a['repoArticleId'] not in posted)
+                batch = []
+            if article is _DONE:
+                return
+
+    async def _post_article(self, session, data):
+        # Same retry policy as Icam._send_with_retries(): connection errors, 429s and 5xx are tried again. A 401
+        # gets a new token, like Icam._request()
+        attempt = 0
+        reauthenticated = False
+        while True:
+            start = time.perf_counter()
+            headers = self.icam.headers
+            try:
+                async with session.post(self.icam.articles_endpoint, data=data, headers=headers) as res:
+                    status, body = res.status, await res.text()
+                    metrics.request('icam', 'icam_post', 'POST', status, time.perf_counter() - start, len(data),
+                                    res.content_length or 0)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, body = None, repr(e)
+            if status == 401 and not reauthenticated:
+                reauthenticated = True
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.icam.reauthenticate, headers['Authorization'][len('Bearer '):])
+                continue
+            if not is_transient(status) or attempt >= self.icam.post_retries:
+                return status, body
+            await asyncio.sleep(_backoff(attempt, 30.0))
+            attempt += 1
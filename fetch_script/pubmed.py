@@ -1,13 +1,119 @@
-import requests
-from lxml import html
+from lxml import etree, html
 import calendar
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain
 import datetime
+import io
+import random
+import re
+import threading
+import time
+
+import requests
+
+from fetch_script.metrics import CountingReader, echo, metrics
+from fetch_script.sessions import make_session
 
 # Constants
 # -------------------------------------------
 MONTH_TO_NUM = {name: num for num, name in enumerate(calendar.month_abbr) if num}
 
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+ESEARCH_URL = EUTILS_URL + 'esearch.fcgi'
+EFETCH_URL = EUTILS_URL + 'efetch.fcgi'
+
+# Compiled once and evaluated relative to each article node (tags are lowercase, as parsed by lxml's html parser)
+XPATH_MEDLINE_DATE = etree.XPath('.//pubmeddata//history//pubmedpubdate[@pubstatus="medline"]')
+XPATH_PUBMED_DATE = etree.XPath('.//pubmeddata//history//pubmedpubdate')
+XPATH_AUTHORS = etree.XPath('.//authorlist/author')
+XPATH_TITLE = etree.XPath('.//articletitle')
+XPATH_ABSTRACT = etree.XPath('.//abstract/abstracttext')
+XPATH_JOURNAL = etree.XPath('.//article//title')
+XPATH_OFFICIAL_DATE = etree.XPath('.//pubdate')
+XPATH_DOI = etree.XPath('.//articleidlist//articleid[@idtype="doi"]')
+
+# Splits a raw EFetch reply into its articles without parsing it (EFetch always writes these tags the same way)
+RAW_ARTICLE = re.compile(rb'<PubmedArticle>.*?</PubmedArticle>', re.DOTALL)
+RAW_PMID = re.compile(rb'<PMID[^>]*>(\d+)</PMID>')
+
+
+# NCBI allows 3 requests/s per IP, or 10/s when sending an api_key
+# ref: https://www.ncbi.nlm.nih.gov/books/NBK25497/#chapter2.Usage_Guidelines_and_Requiremen
+RATE_NO_KEY = 3
+RATE_WITH_KEY = 10
+
+# Seconds to connect to E-utilities and to wait for each read of the reply, so a stalled connection is retried
+REQUEST_TIMEOUT = (10, 120)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every E-utilities call, so all threads together stay right at NCBI's allowed rate.
+
+    Tokens can go negative: each caller reserves its slot and then sleeps until it comes up, which spaces
+    concurrent requests evenly instead of letting them burst and get a 429.
+    Also counts the requests made and the time spent waiting for a slot.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.started = self.updated
+        self.requests = 0
+        self.throttle_wait = 0.0
+
+    def reserve(self):
+        """
+        Takes a token from the bucket.
+
+        :return: How many seconds the caller must wait before sending its request
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.requests += 1
+            self.throttle_wait += wait
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    def stats(self):
+        """
+        :return: A dict with the number of requests, the achieved rate (requests/s) and the total throttle wait
+        """
+        elapsed = time.monotonic() - self.started
+        return {
+            'requests': self.requests,
+            'rate': self.requests / elapsed if elapsed else 0.0,
+            'throttle_wait': self.throttle_wait
+        }
+
+
+# Every E-utilities call goes through this session and limiter, see configure_session() and configure_eutils()
+session = make_session()
+limiter = RateLimiter(RATE_NO_KEY)
+# Sent with every request: api_key, tool and email, when set
+eutils_params = {}
+max_retries = 5
+
+# Optional cache.ResponseCache of the raw article XML, and whether to only read from it, see configure_cache()
+cache = None
+offline = False
+
+# Optional ParsePool parsing batches on other cores, see configure_parsing()
+parse_pool = None
+
 
 # Helper functions
 # --------------------------
@@ -53,19 +159,169 @@ def stringify_children(node):
     return ''.join(filter(None, parts))
 
 
+def truncate_title(title):
+    """
+    :param title: An article title
+    :return: The title fitting ICAM's articleTitle (255 chars): if it exceeds 255, cut it and add '[...]' at the end
+    """
+    return title[0:250] + '[...]' if len(title) > 255 else title
+
+
+def configure_session(pool_size):
+    """
+    Replaces the module session by a new one with the given connection pool size.
+
+    :param pool_size: How many connections to keep open to NCBI
+    """
+    global session
+    session = make_session(pool_size)
+
+
+def configure_eutils(api_key=None, tool=None, email=None, retries=5, rate_share=1):
+    """
+    Sets the identification NCBI asks E-utilities users to send, and picks the request rate from it.
+
+    :param api_key: NCBI API key, raises the allowed rate from 3 to 10 requests/s
+    :param tool: Name of the application making the calls
+    :param email: Contact email of the developer
+    :param retries: How many times to retry a request that failed to connect, timed out or got a 429 or a 5xx
+    :param rate_share: How many processes share the key's rate, ex: the shard workers (see shards.py)
+    """
+    global limiter, eutils_params, max_retries
+    eutils_params = {k: v for k, v in (('api_key', api_key), ('tool', tool), ('email', email)) if v}
+    limiter = RateLimiter((RATE_WITH_KEY if api_key else RATE_NO_KEY) / rate_share)
+    max_retries = retries
+
+
+def configure_cache(response_cache, offline_only=False):
+    """
+    :param response_cache: A cache.ResponseCache for the raw article XML, or None to disable caching
+    :param offline_only: Never request NCBI, articles not in the cache are skipped
+    """
+    global cache, offline
+    cache = response_cache
+    offline = offline_only
+
+
+def configure_parsing(workers, chunk_size=50):
+    """
+    :param workers: Processes parsing the fetched articles, 1 to parse them in this process as they download
+    :param chunk_size: Articles sent to a worker at a time
+    """
+    global parse_pool
+    if parse_pool is not None:
+        if (parse_pool.workers, parse_pool.chunk_size) == (workers, chunk_size):
+            return
+        parse_pool.close()
+    parse_pool = ParsePool(workers, chunk_size) if workers > 1 else None
+
+
+def cache_stats():
+    return cache.stats() if cache is not None else {'hits': 0, 'misses': 0, 'size': 0}
+
+
+def _article_xml(article):
+    # Serialized with the html method so empty elements keep their closing tag and parse back the same way
+    return etree.tostring(article, method='html', with_tail=False)
+
+
+def _article_set(raws):
+    # Without the declaration the html parser reads the bytes as Latin-1
+    return b'<?xml version="1.0" encoding="UTF-8"?><pubmedarticleset>' + b''.join(raws) + b'</pubmedarticleset>'
+
+
+def request_size(request):
+    """
+    :return: The bytes sent for a requests.PreparedRequest: url and body (headers are left out)
+    """
+    body = request.body or b''
+    return len(request.url) + len(body.encode() if isinstance(body, str) else body)
+
+
+def retry_delay(status_code, headers, attempt):
+    """
+    Tells whether a reply should be retried and after how long.
+    Honors Retry-After, else backs off exponentially with jitter.
+
+    :param status_code: HTTP status of the reply, None for a connection error or a timeout
+    :param headers: HTTP headers of the reply
+    :param attempt: How many times the request was already retried
+    :return: Seconds to wait before retrying, or None if the reply should not be retried
+    """
+    if status_code is not None and status_code != 429 and status_code < 500:
+        return None
+    retry_after = headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return min(60.0, 2 ** attempt) + random.uniform(0, 1)
+
+
+def eutils_request(method, url, params=None, data=None, **kwargs):
+    """
+    Sends a request to E-utilities through the rate limiter, retrying connection errors, timeouts, 429s and 5xx.
+
+    :param method: 'GET' or 'POST'
+    :param url: E-utility url (may already hold a query string)
+    :param params: Extra query string parameters
+    :param data: Form data, for POSTs
+    :return: The requests.Response of the last attempt
+    :raises requests.RequestException: If the last attempt still failed (requests.HTTPError for an error status), so
+                                       an error page is never taken for a reply without articles
+    """
+    params = dict(params or {})
+    if data is not None:
+        data = {**data, **eutils_params}
+    else:
+        params.update(eutils_params)
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+
+    # esearch or efetch
+    stage = url.rsplit('/', 1)[-1].split('.', 1)[0]
+    attempt = 0
+    while True:
+        limiter.acquire()
+        start = time.perf_counter()
+        try:
+            res = session.request(method, url, params=params, data=data, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            delay = retry_delay(None, {}, attempt)
+            echo('pubmed request to {} failed: {!r}, retrying in {:.1f}s'.format(url, e, delay))
+        else:
+            # Streamed replies are counted by whoever reads them, see _stream_articles()
+            received = 0 if kwargs.get('stream') else len(res.content)
+            metrics.request('pubmed', stage, method, res.status_code, time.perf_counter() - start,
+                            request_size(res.request), received)
+            delay = retry_delay(res.status_code, res.headers, attempt)
+            if delay is None or attempt >= max_retries:
+                if not res.ok:
+                    res.close()
+                    res.raise_for_status()
+                return res
+            res.close()
+            echo('pubmed replied {} to {}, retrying in {:.1f}s'.format(res.status_code, url, delay))
+        time.sleep(delay)
+        attempt += 1
+
+
 # Get PubMed stuff
 # ---------------------------------------------------------------------------------------------------
-def get_ids_list(max_articles: int, search_term: str):
+def get_ids_list(max_articles: int, search_term: str, mindate=None, datetype='edat'):
     """
     Gets a list of PubMed IDs for the latest articles matching the search term.
 
     :param max_articles: number of articles to retrieve.
     :param search_term: keyword to search in PubMed database.
+    :param mindate: only get articles from this date on (yyyy/mm/dd), to search incrementally since the last run.
+    :param datetype: which date mindate refers to, 'edat' (Entrez date, when added to PubMed) or 'mdat' (modified).
     :return A list with the retrieved IDs
     """
-    search_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&term={}&retmax={}' \
-        .format(search_term, max_articles)
-    reply = requests.get(search_url)
+    search_url = ESEARCH_URL + '?db=pubmed&term={}&retmax={}'.format(search_term, max_articles)
+    if mindate:
+        # ESearch needs both ends of the range
+        search_url += '&datetype={}&mindate={}&maxdate=3000'.format(datetype, mindate)
+    reply = eutils_request('GET', search_url)
     tree = html.fromstring(reply.content)
     id_list = tree.xpath('//idlist')
     if id_list is not None:
@@ -74,9 +330,274 @@ def get_ids_list(max_articles: int, search_term: str):
         return []
 
 
+def search_history(search_term: str, maxdate=None, mindate=None, datetype='edat'):
+    """
+    Runs an ESearch on NCBI's history server (usehistory=y), so the whole result set can then be fetched in chunks
+    with get_history_batch() or get_history_ids() instead of being limited to the IDs a single ESearch returns.
+
+    :param search_term: keyword to search in PubMed database.
+    :param maxdate: Only the articles added to PubMed (edat) up to that date, 'YYYY/MM/DD': new articles don't
+                    shift the results, so the same search run again later gives the same offsets
+    :param mindate: Only the articles from that date on, 'YYYY/MM/DD'
+    :param datetype: Which date mindate and maxdate refer to, 'edat' (added to PubMed) or 'mdat' (modified)
+    :return The number of results, the WebEnv and the query_key pointing to them
+    """
+    search_url = ESEARCH_URL + '?db=pubmed&term={}&usehistory=y&retmax=0'.format(search_term)
+    if mindate or maxdate:
+        # ESearch needs both ends of the range
+        search_url += '&datetype={}&mindate={}&maxdate={}'.format(datetype, mindate or 1800, maxdate or 3000)
+    reply = eutils_request('GET', search_url)
+    tree = html.fromstring(reply.content)
+    count = int(tree.xpath('//esearchresult/count')[0].text)
+    webenv = tree.xpath('//esearchresult/webenv')[0].text
+    query_key = tree.xpath('//esearchresult/querykey')[0].text
+    return count, webenv, query_key
+
+
+def get_history_batch(webenv, query_key, retstart, retmax):
+    """
+    Fetches and parses a chunk of the results stored on the history server by search_history().
+
+    :param webenv: The WebEnv returned by search_history()
+    :param query_key: The query_key returned by search_history()
+    :param retstart: Index of the first result to fetch
+    :param retmax: How many results to fetch (up to 10000)
+    :return A generator of dicts like the ones built by get_single_article()
+    :raises requests.RequestException: If EFetch still fails after the retries: callers going through the results by
+                                       offset must not take a failed chunk for an empty one
+    """
+    data = {'db': 'pubmed', 'WebEnv': webenv, 'query_key': query_key, 'retstart': retstart, 'retmax': retmax,
+            'rettype': 'abstract'}
+    page = eutils_request('POST', EFETCH_URL, data=data, stream=parse_pool is None)
+    if parse_pool is not None:
+        yield from parse_pool.parse([_split_raw_articles(page.content)])
+        return
+    yield from _stream_articles(page, cache)
+
+
+def get_history_ids(webenv, query_key, retstart, retmax):
+    """
+    Gets a chunk of the PubMed IDs stored on the history server by search_history(), without their articles.
+
+    :param retstart: Index of the first result
+    :param retmax: How many IDs to get (up to 10000)
+    :return A list with the IDs
+    :raises requests.RequestException: If EFetch still fails after the retries
+    """
+    data = {'db': 'pubmed', 'WebEnv': webenv, 'query_key': query_key, 'retstart': retstart, 'retmax': retmax,
+            'rettype': 'uilist', 'retmode': 'text'}
+    page = eutils_request('POST', EFETCH_URL, data=data)
+    # An error (ex: expired WebEnv) comes back as an XML message, without IDs
+    return [int(line) for line in page.text.split() if line.isdigit()]
+
+
 def get_single_article(pubmed_id):
     """
-    Parses a XML file representing a PubMed article to retrieve:
+    Fetches a single PubMed article, or reads it from the cache, and parses it with parse_article().
+
+    :param pubmed_id: The PubMed ID of the article you want
+    :return A dict with all the data collected from the article
+    """
+    if cache is not None:
+        raw = cache.get(pubmed_id)
+        if raw is not None:
+            return _timed_parse(html.fromstring(_article_set([raw])), pubmed_id)
+
+    fetch_url = EFETCH_URL + '?db=pubmed&id={}&rettype=abstract'.format(pubmed_id)
+    page = eutils_request('GET', fetch_url)
+    tree = html.fromstring(page.content)
+    if cache is not None:
+        for article in tree.xpath('//pubmedarticle'):
+            cache.put(pubmed_id, _article_xml(article))
+    return _timed_parse(tree, pubmed_id)
+
+
+def get_articles_batch(ids, batch_size=200, revisions=None):
+    """
+    Fetches many PubMed articles with one EFetch request per batch of IDs, instead of one request per article.
+    The IDs are POSTed comma-joined (GET urls get too long for big batches) and the returned PubmedArticleSet
+    is split into one record per <PubmedArticle>.
+
+    Articles in the cache are read from it and only the rest is requested; when running offline, only the
+    cached articles are returned.
+    IDs that PubMed doesn't return (deleted, not yet indexed...) are simply not yielded.
+
+    :param ids: An iterable with the PubMed IDs of the articles you want
+    :param batch_size: How many IDs to send on each EFetch request
+    :param revisions: An optional dict PubMed ID -> revision stamp (ex: modification date) for the cache
+    :return A generator of dicts like the ones built by get_single_article()
+    :raises requests.RequestException: If EFetch still fails after the retries, instead of leaving the batch out
+    """
+    ids = list(ids)
+    revisions = revisions or {}
+    if parse_pool is not None:
+        yield from parse_pool.parse(_raw_batches(ids, batch_size, revisions))
+        return
+
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+
+        if cache is not None:
+            cached, missing = [], []
+            for pubmed_id in batch:
+                raw = cache.get(pubmed_id, revisions.get(pubmed_id, ''))
+                if raw is not None:
+                    cached.append(raw)
+                else:
+                    missing.append(pubmed_id)
+            if cached:
+                yield from iter_articles(io.BytesIO(_article_set(cached)))
+            batch = missing
+
+        if not batch:
+            continue
+        if offline:
+            echo('{} articles are not in the cache, skipping them (offline)'.format(len(batch)))
+            continue
+
+        page = eutils_request('POST', EFETCH_URL, data={'db': 'pubmed', 'id': ','.join(str(i) for i in batch),
+                                                        'rettype': 'abstract'}, stream=True)
+        yield from _stream_articles(page, cache, revisions)
+
+
+def _raw_batches(ids, batch_size, revisions):
+    """
+    Same as get_articles_batch(), but without parsing: yields a list with the raw XML of the articles of each batch.
+    """
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        raws = []
+        if cache is not None:
+            missing = []
+            for pubmed_id in batch:
+                raw = cache.get(pubmed_id, revisions.get(pubmed_id, ''))
+                if raw is not None:
+                    raws.append(raw)
+                else:
+                    missing.append(pubmed_id)
+            batch = missing
+        if batch and offline:
+            echo('{} articles are not in the cache, skipping them (offline)'.format(len(batch)))
+        elif batch:
+            raws.extend(_fetch_raw_articles({'db': 'pubmed', 'id': ','.join(str(i) for i in batch),
+                                             'rettype': 'abstract'}, revisions))
+        yield raws
+
+
+def _fetch_raw_articles(data, revisions=None):
+    """
+    Downloads an EFetch reply and splits it into the raw XML of each article, storing them in the cache.
+    """
+    return _split_raw_articles(eutils_request('POST', EFETCH_URL, data=data).content, revisions)
+
+
+def _split_raw_articles(content, revisions=None):
+    raws = RAW_ARTICLE.findall(content)
+    if cache is not None:
+        for raw in raws:
+            pubmed_id = int(RAW_PMID.search(raw).group(1))
+            cache.put(pubmed_id, raw, (revisions or {}).get(pubmed_id, ''))
+    return raws
+
+
+def parse_chunk(raws):
+    """
+    Parses the raw XML of some articles, runs in the ParsePool workers (so it must stay a picklable module function).
+
+    :return: The list of article dicts, in order, and the seconds it took
+    """
+    start = time.perf_counter()
+    articles = [parse_article(article, int(article.find('medlinecitation/pmid').text))
+                for _, article in etree.iterparse(io.BytesIO(_article_set(raws)), events=('end',),
+                                                  tag='pubmedarticle', html=True)]
+    return articles, time.perf_counter() - start
+
+
+class ParsePool:
+    """
+    Parses articles on a pool of processes, so big backfills use every core instead of one under the GIL.
+
+    Downloads stay in the calling thread: each batch of raw articles is cut into chunks of chunk_size articles
+    (few, big messages keep the pickling overhead low) and the chunks are parsed while the next batch downloads.
+    Articles come out in the same order as with a single process. Only 2 chunks per worker are in flight, so
+    memory stays bounded however many articles there are.
+    """
+
+    def __init__(self, workers, chunk_size=50):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def parse(self, raw_batches):
+        """
+        :param raw_batches: An iterable of lists with the raw XML of articles
+        :return: A generator of article dicts, in order
+        """
+        pending = deque()
+        for raws in raw_batches:
+            for start in range(0, len(raws), self.chunk_size):
+                pending.append(self.executor.submit(parse_chunk, raws[start:start + self.chunk_size]))
+                while len(pending) > self.workers * 2:
+                    yield from self._result(pending.popleft())
+        while pending:
+            yield from self._result(pending.popleft())
+
+    @staticmethod
+    def _result(future):
+        articles, seconds = future.result()
+        metrics.observe('stage_seconds', seconds, stage='parse_chunk')
+        metrics.inc('articles_parsed_total', len(articles))
+        return articles
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def _stream_articles(page, response_cache=None, revisions=None):
+    # Parses a streamed EFetch reply as it downloads, counting its bytes
+    page.raw.decode_content = True
+    reader = CountingReader(page.raw)
+    try:
+        yield from iter_articles(reader, response_cache, revisions)
+    finally:
+        metrics.inc('http_received_bytes_total', reader.bytes, service='pubmed')
+
+
+def iter_articles(source, response_cache=None, revisions=None):
+    """
+    Streams a PubmedArticleSet with lxml's iterparse, parsing each <PubmedArticle> as soon as it is complete.
+    Finished articles are cleared from the tree, so memory stays flat no matter how big the EFetch reply is.
+
+    The html parser is used (as in get_single_article) so the parsed nodes, and therefore the dicts, are the same.
+
+    :param source: A filename or a file-like object with the EFetch XML
+    :param response_cache: An optional cache.ResponseCache where to store the raw XML of each article
+    :param revisions: An optional dict PubMed ID -> revision stamp for the cache
+    :return A generator of dicts like the ones built by get_single_article()
+    """
+    for _, article in etree.iterparse(source, events=('end',), tag='pubmedarticle', html=True):
+        pubmed_id = int(article.find('medlinecitation/pmid').text)
+        if response_cache is not None:
+            response_cache.put(pubmed_id, _article_xml(article), (revisions or {}).get(pubmed_id, ''))
+        yield _timed_parse(article, pubmed_id)
+
+        # Free the finished article and everything parsed before it
+        article.clear()
+        while article.getprevious() is not None:
+            del article.getparent()[0]
+
+
+def _timed_parse(tree, pubmed_id):
+    start = time.perf_counter()
+    article = parse_article(tree, pubmed_id)
+    metrics.observe('stage_seconds', time.perf_counter() - start, stage='parse')
+    metrics.inc('articles_parsed_total')
+    return article
+
+
+def parse_article(tree, pubmed_id):
+    """
+    Parses a XML node representing a PubMed article to retrieve:
     - title
     - abstract
     - journal
@@ -87,15 +608,14 @@ def get_single_article(pubmed_id):
 
     And returns a dict that can be converted to json for a POST via json.dumps()
 
-    :param pubmed_id: The PubMed ID of the article you want
+    All lookups are relative to the given node, so it works both on a whole EFetch reply holding a single
+    article and on a single <pubmedarticle> node of a batch reply.
+
+    :param tree: The xml node (parsed by lxml.html) holding the article
+    :param pubmed_id: The PubMed ID of the article
     :return A dict with all the data collected from the article
     """
 
-    fetch_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id={}&rettype=abstract' \
-        .format(pubmed_id)
-    page = requests.get(fetch_url)
-    tree = html.fromstring(page.content)
-
     dict_out = {
         'repoArticleId': pubmed_id,  # Set PubMed ID
         'reviewState': 'Hold'  # Set the review state to Hold
@@ -105,12 +625,12 @@ def get_single_article(pubmed_id):
 
     # Get repoDate (PubMed publication date)
     # Prefer the MEDLINE entry date, else use whatever is available
-    pubmed_pubdate = tree.xpath('//pubmeddata//history//pubmedpubdate[@pubstatus="medline"]')
+    pubmed_pubdate = XPATH_MEDLINE_DATE(tree)
     if pubmed_pubdate:
         y, m, d = get_date(pubmed_pubdate)
         dict_out['repoDate'] = '{}-{}-{}'.format(y, '0' + m if len(m) == 1 else m, '0' + d if len(d) == 1 else d)
     else:
-        pubmed_pubdate = tree.xpath('//pubmeddata//history//pubmedpubdate')
+        pubmed_pubdate = XPATH_PUBMED_DATE(tree)
         y, m, d = get_date(pubmed_pubdate)
         dict_out['repoDate'] = '{}-{}-{}'.format(y, m, d)
 
@@ -123,7 +643,7 @@ def get_single_article(pubmed_id):
     citation = ''
 
     # Get article authors for the citation
-    authors_tree = tree.xpath("//authorlist/author")
+    authors_tree = XPATH_AUTHORS(tree)
     authors = []
     if authors_tree:
         # Only need 2 author names tops! [0:3] to check if 2+ for "et al" case
@@ -144,31 +664,29 @@ def get_single_article(pubmed_id):
         citation += '{}.'.format(authors_text)
 
     # Get articleTitle
-    if tree.xpath('//articletitle'):
+    title_tree = XPATH_TITLE(tree)
+    if title_tree:
         try:
-            title = ' '.join([title.text for title in tree.xpath('//articletitle')])
-            # If the title length exceeds 255, cut it and add '[...]' at the end
-            if len(title) > 255:
-                title = title[0:250] + '[...]'
-            dict_out['articleTitle'] = title
+            dict_out['articleTitle'] = truncate_title(' '.join([title.text for title in title_tree]))
         except Exception as e:
             # todo: logging!
-            print('error processing title of {}: {}'.format(pubmed_id, e))
+            echo('error processing title of {}: {}'.format(pubmed_id, e))
 
     # Get articleAbstract
-    abstract_tree = tree.xpath('//abstract/abstracttext')
+    abstract_tree = XPATH_ABSTRACT(tree)
     if abstract_tree:
         dict_out['articleAbstract'] = ' '.join([stringify_children(a).strip() for a in abstract_tree])
 
     # Get articleJournal
-    if tree.xpath('//article//title'):
-        journal = ';'.join([t.text.strip() for t in tree.xpath('//article//title')])
+    journal_tree = XPATH_JOURNAL(tree)
+    if journal_tree:
+        journal = ';'.join([t.text.strip() for t in journal_tree])
         dict_out['articleJournal'] = journal
         citation += ' {}.'.format(journal)
 
     # Get articleDate (Official publication date - citation and reference purpose only)
     # todo: standardize d-Mon-yyyy
-    official_date = tree.xpath('//pubdate')
+    official_date = XPATH_OFFICIAL_DATE(tree)
     if official_date:
         y, m, d = get_date(official_date)
         date = '{}{}{}'.format(d + '-' if d else '', m + '-' if m else '', y)
@@ -176,7 +694,7 @@ def get_single_article(pubmed_id):
         citation += ' {}'.format(date)
 
     # Get articleDoi
-    doi = tree.xpath('//articleidlist//articleid[@idtype="doi"]')
+    doi = XPATH_DOI(tree)
     if doi:
         dict_out['articleDoi'] = doi[0].text
 
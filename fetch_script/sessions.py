@@ -0,0 +1,22 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def make_session(pool_size=10):
+    """
+    Builds a requests.Session that keeps its connections alive and reuses them, instead of opening a new TCP
+    (and TLS) connection on every call like the module-level requests.get/post do.
+
+    :param pool_size: How many connections to keep open per host, should be at least the number of threads
+                      sharing the session
+    :return: A requests.Session with a tuned connection pool
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    return session
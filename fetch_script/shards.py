@@ -0,0 +1,408 @@
+"""
+Sharded backfill: the results of a PubMed search, kept on NCBI's history server, are split into shards (ranges of
+offsets in the result set) that any number of worker processes or pods lease from a shared LeaseStore. Workers on
+one machine can share its SQLite file; workers on other machines or pods lease from the coordinator, which serves
+the store over HTTP (LeaseServer, RemoteLeaseStore) so the file is never on a network filesystem.
+
+- The search is pinned to the day the job was created (maxdate), so every worker searching again gets the same
+  offsets, see pubmed.search_history().
+- A worker holds a lease for lease_seconds, renewed in the background while it works on the shard. A worker that
+  dies stops renewing, and its shard is leased again once the lease expires.
+- Inside a shard, the offset of the last chunk posted is checkpointed in the store, so a shard leased again goes on
+  from there instead of posting its articles a second time.
+- Articles ICAM rejects, or that EFetch has no <PubmedArticle> for, are recorded in the store and skipped; a shard
+  that fails for a transient reason (ICAM or NCBI down) is given back to be tried again later.
+"""
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+from fetch_script.icam import is_transient
+from fetch_script.metrics import echo
+from fetch_script.sessions import make_session
+
+# Longest wait, in seconds, of a worker before leasing again after a shard failed
+MAX_RETRY_SECONDS = 300
+
+
+class LeaseStore:
+    """
+    Jobs and shard leases in a SQLite file, shared by the workers of one machine (or of pods mounting a volume with
+    working file locks). Every change is a short write transaction, so workers never see a shard leased twice.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE, see _transaction()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        with self._transaction():
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                              'job TEXT PRIMARY KEY, search_term TEXT NOT NULL, maxdate TEXT NOT NULL, '
+                              'count INTEGER NOT NULL, shard_size INTEGER NOT NULL, created REAL NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS shards ('
+                              'job TEXT NOT NULL, shard INTEGER NOT NULL, retstart INTEGER NOT NULL, '
+                              'retend INTEGER NOT NULL, done_until INTEGER NOT NULL, state TEXT NOT NULL, '
+                              'owner TEXT, expires REAL, leases INTEGER NOT NULL DEFAULT 0, '
+                              'PRIMARY KEY (job, shard))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS rejected ('
+                              'job TEXT NOT NULL, entry TEXT NOT NULL, shard INTEGER NOT NULL, error TEXT, '
+                              'PRIMARY KEY (job, entry))')
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so two processes can't both read a shard as free and lease it
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    # Jobs
+    # ------------------------------------------------------------------------------------------------------------------
+    def create_job(self, job, search_term, maxdate, count, shard_size):
+        """
+        Creates a job and its shards, unless it already exists: every worker can try, the first one wins.
+
+        :return: The job, see get_job()
+        """
+        with self._transaction():
+            created = self.conn.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                                        (job, search_term, maxdate, count, shard_size, time.time())).rowcount
+            if created:
+                self.conn.executemany(
+                    "INSERT INTO shards (job, shard, retstart, retend, done_until, state) "
+                    "VALUES (?, ?, ?, ?, ?, 'pending')",
+                    ((job, shard, start, min(start + shard_size, count), start)
+                     for shard, start in enumerate(range(0, count, shard_size))))
+        return self.get_job(job)
+
+    def get_job(self, job):
+        """
+        :return: A dict with the job's search_term, maxdate, count and shard_size, or None if it doesn't exist
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT search_term, maxdate, count, shard_size FROM jobs WHERE job = ?',
+                                    (job,)).fetchone()
+        return dict(zip(('search_term', 'maxdate', 'count', 'shard_size'), row)) if row else None
+
+    def progress(self, job):
+        """
+        :return: A dict with the number of shards 'pending', 'leased' (and not expired), 'expired' and 'done', the
+                 number of articles (offsets) done and the number of articles 'rejected'
+        """
+        counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0}
+        with self.lock:
+            rows = self.conn.execute("SELECT CASE WHEN state = 'leased' AND expires < ? THEN 'expired' "
+                                     "ELSE state END, COUNT(*) FROM shards WHERE job = ? GROUP BY 1",
+                                     (time.time(), job)).fetchall()
+            articles = self.conn.execute('SELECT SUM(done_until - retstart) FROM shards WHERE job = ?',
+                                         (job,)).fetchone()[0]
+            rejected = self.conn.execute('SELECT COUNT(*) FROM rejected WHERE job = ?', (job,)).fetchone()[0]
+        counts.update(rows)
+        counts['articles'] = articles or 0
+        counts['rejected'] = rejected
+        return counts
+
+    def reject(self, job, shard, errors):
+        """
+        Records the articles ICAM rejected for good (or that EFetch has no article for), so the shard can be completed
+        without them.
+
+        :param errors: A dict repoArticleId -> error message
+        """
+        with self._transaction():
+            self.conn.executemany('INSERT OR REPLACE INTO rejected VALUES (?, ?, ?, ?)',
+                                  ((job, str(entry), shard, error) for entry, error in errors.items()))
+
+    def rejected(self, job):
+        """
+        :return: A list of (repoArticleId, shard, error) of the rejected articles
+        """
+        with self.lock:
+            return [list(row) for row in self.conn.execute('SELECT entry, shard, error FROM rejected WHERE job = ? '
+                                                           'ORDER BY shard, entry', (job,))]
+
+    # Leases
+    # ------------------------------------------------------------------------------------------------------------------
+    def lease(self, job, owner, seconds):
+        """
+        Leases the first shard that is pending, or whose lease expired.
+
+        :return: A dict with the shard number, its offsets (retstart, retend), where it is done until and the owner
+                 it was taken from (if it expired), or None when every shard is done or leased
+        """
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute("SELECT shard, retstart, retend, done_until, owner FROM shards "
+                                    "WHERE job = ? AND (state = 'pending' OR (state = 'leased' AND expires < ?)) "
+                                    "ORDER BY shard LIMIT 1", (job, now)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE shards SET state = 'leased', owner = ?, expires = ?, leases = leases + 1 "
+                              "WHERE job = ? AND shard = ?", (owner, now + seconds, job, row[0]))
+        return dict(zip(('shard', 'retstart', 'retend', 'done_until', 'previous_owner'), row))
+
+    def renew(self, job, shard, owner, seconds):
+        """
+        :return: False if the lease was lost (expired and taken by another worker)
+        """
+        with self._transaction():
+            return self.conn.execute("UPDATE shards SET expires = ? WHERE job = ? AND shard = ? AND owner = ? "
+                                     "AND state = 'leased'", (time.time() + seconds, job, shard, owner)).rowcount == 1
+
+    def checkpoint(self, job, shard, owner, done_until):
+        """
+        Records that the shard is done up to the offset done_until.
+
+        :return: False if the lease was lost
+        """
+        with self._transaction():
+            return self.conn.execute("UPDATE shards SET done_until = ? WHERE job = ? AND shard = ? AND owner = ? "
+                                     "AND state = 'leased'", (done_until, job, shard, owner)).rowcount == 1
+
+    def complete(self, job, shard, owner):
+        with self._transaction():
+            return self.conn.execute("UPDATE shards SET state = 'done', done_until = retend, owner = NULL, "
+                                     "expires = NULL WHERE job = ? AND shard = ? AND owner = ? AND state = 'leased'",
+                                     (job, shard, owner)).rowcount == 1
+
+    def release(self, job, shard, owner):
+        """
+        Gives a shard back before its lease expires, ex: when the worker stops.
+        """
+        with self._transaction():
+            self.conn.execute("UPDATE shards SET state = 'pending', owner = NULL, expires = NULL "
+                              "WHERE job = ? AND shard = ? AND owner = ? AND state = 'leased'", (job, shard, owner))
+
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class ShardFailed(Exception):
+    """
+    Raised by work_shard() when the shard can't be finished for now (ex: ICAM or NCBI down): it is given back and
+    the worker waits before leasing again.
+    """
+
+
+class ShardWorker:
+    """
+    Leases shards of a job one at a time and runs work_shard() on them until none is left.
+    """
+
+    def __init__(self, store, job, lease_seconds=300, owner=None):
+        self.store = store
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.owner = owner or worker_name()
+        self.stopping = threading.Event()
+
+    def stop(self):
+        """
+        Stops after the current chunk, giving the shard back (ex: on SIGTERM).
+        """
+        self.stopping.set()
+
+    def run(self, work_shard):
+        """
+        :param work_shard: Called with the leased shard (see LeaseStore.lease()) and a checkpoint(done_until) function
+                           to call after every chunk posted, which raises LeaseLost once the shard was lost.
+                           Raises ShardFailed to give the shard back for now.
+        :return: How many shards this worker completed
+        """
+        completed = 0
+        failures = 0
+        while not self.stopping.is_set():
+            shard = self.store.lease(self.job, self.owner, self.lease_seconds)
+            if shard is None:
+                break
+            if shard['previous_owner']:
+                echo('shard {shard}: lease of {previous_owner} expired, going on from #{done_until}'.format(**shard))
+            try:
+                if self._work(shard, work_shard):
+                    completed += 1
+                failures = 0
+            except ShardFailed as e:
+                delay = min(MAX_RETRY_SECONDS, 10 * 2 ** failures) + random.uniform(0, 1)
+                failures += 1
+                echo(f'shard {shard["shard"]}: {e}, given back, leasing again in {delay:.0f}s')
+                self.stopping.wait(delay)
+        return completed
+
+    def _work(self, shard, work_shard):
+        number = shard['shard']
+        lost = threading.Event()
+        renewing = threading.Event()
+
+        def renew():
+            # Renews the lease three times per lease period, until the shard is done
+            while not renewing.wait(self.lease_seconds / 3):
+                try:
+                    renewed = self.store.renew(self.job, number, self.owner, self.lease_seconds)
+                except Exception as e:
+                    # The store may be back before the lease expires
+                    echo(f'shard {number}: renewing the lease failed: {e!r}')
+                    continue
+                if not renewed:
+                    lost.set()
+                    return
+
+        def checkpoint(done_until):
+            if lost.is_set() or not self.store.checkpoint(self.job, number, self.owner, done_until):
+                raise LeaseLost()
+            if self.stopping.is_set() and done_until < shard['retend']:
+                raise InterruptedError()
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            work_shard(shard, checkpoint)
+        except LeaseLost:
+            echo(f'shard {number}: lease lost, leaving it to its new owner')
+            return False
+        except InterruptedError:
+            echo(f'shard {number}: stopping, giving it back')
+            self.store.release(self.job, number, self.owner)
+            return False
+        except BaseException:
+            self.store.release(self.job, number, self.owner)
+            raise
+        finally:
+            renewing.set()
+            renewer.join()
+        return self.store.complete(self.job, number, self.owner)
+
+
+# The LeaseStore methods a RemoteLeaseStore can call
+REMOTE_METHODS = ('create_job', 'get_job', 'progress', 'lease', 'renew', 'checkpoint', 'complete', 'release', 'reject',
+                  'rejected')
+
+
+class LeaseServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a LeaseStore to RemoteLeaseStores: every call is a POST to /<method> with its arguments as a json object,
+    answered with {"result": ...}. Run by the coordinator, which is the only process opening the SQLite file.
+    """
+    daemon_threads = True
+
+    def __init__(self, store, host='0.0.0.0', port=9200):
+        super().__init__((host, port), _LeaseHandler)
+        self.store = store
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='leases', daemon=True).start()
+        return self
+
+
+class _LeaseHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        method = self.path.strip('/')
+        if method not in REMOTE_METHODS:
+            self._reply(404, {'error': f'no method {method}'})
+            return
+        try:
+            kwargs = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            result = getattr(self.server.store, method)(**kwargs)
+        except (TypeError, ValueError) as e:
+            self._reply(400, {'error': repr(e)})
+        except sqlite3.Error as e:
+            self._reply(503, {'error': repr(e)})
+        else:
+            self._reply(200, {'result': result})
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every worker renews its lease every few minutes, keep them out of the logs
+        pass
+
+
+class RemoteLeaseStore:
+    """
+    A LeaseStore served by a LeaseServer, for workers on other machines or pods. Same methods as LeaseStore.
+    Connection errors and 5xx are retried with backoff, so workers ride out a restart of the coordinator.
+    """
+
+    def __init__(self, url, session=None, retries=6, timeout=30):
+        self.url = url if url.endswith('/') else url + '/'
+        self.session = session if session is not None else make_session(2)
+        self.retries = retries
+        self.timeout = timeout
+
+    def close(self):
+        self.session.close()
+
+    def _call(self, method, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                res = self.session.post(self.url + method, data=json.dumps(kwargs), timeout=self.timeout,
+                                        headers={'Content-Type': 'application/json'})
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if not is_transient(res.status_code):
+                    res.raise_for_status()
+                    return res.json()['result']
+                error = requests.HTTPError(f'{res.status_code} from the lease server: {res.text}', response=res)
+            if attempt < self.retries:
+                time.sleep(min(30.0, 2 ** attempt) + random.uniform(0, 1))
+        raise error
+
+    def create_job(self, job, search_term, maxdate, count, shard_size):
+        return self._call('create_job', job=job, search_term=search_term, maxdate=maxdate, count=count,
+                          shard_size=shard_size)
+
+    def get_job(self, job):
+        return self._call('get_job', job=job)
+
+    def progress(self, job):
+        return self._call('progress', job=job)
+
+    def lease(self, job, owner, seconds):
+        return self._call('lease', job=job, owner=owner, seconds=seconds)
+
+    def renew(self, job, shard, owner, seconds):
+        return self._call('renew', job=job, shard=shard, owner=owner, seconds=seconds)
+
+    def checkpoint(self, job, shard, owner, done_until):
+        return self._call('checkpoint', job=job, shard=shard, owner=owner, done_until=done_until)
+
+    def complete(self, job, shard, owner):
+        return self._call('complete', job=job, shard=shard, owner=owner)
+
+    def release(self, job, shard, owner):
+        return self._call('release', job=job, shard=shard, owner=owner)
+
+    def reject(self, job, shard, errors):
+        return self._call('reject', job=job, shard=shard, errors=errors)
+
+    def rejected(self, job):
+        return self._call('rejected', job=job)
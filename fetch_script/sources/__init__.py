@@ -0,0 +1,15 @@
+from fetch_script.sources.base import Source
+from fetch_script.sources.biorxiv import BioRxivSource, MedRxivSource
+from fetch_script.sources.pubmed import PubMedSource
+
+# Every source the fetchScript knows, by the name used in the [FETCH] sources option
+SOURCES = {source.name: source for source in (PubMedSource, BioRxivSource, MedRxivSource)}
+
+
+def load_sources(config):
+    """
+    :param config: The fetchScript ConfigParser
+    :return: A list with the sources listed in [FETCH] sources (default: pubmed), set up from their sections
+    """
+    names = config.get('FETCH', 'sources', fallback='pubmed')
+    return [SOURCES[name.strip()].from_config(config) for name in names.split(',') if name.strip()]
@@ -0,0 +1,69 @@
+from abc import ABC, abstractmethod
+
+from fetch_script.metrics import echo
+
+
+class Source(ABC):
+    """
+    Interface of the article sources the fetchScript imports from.
+
+    A run asks the source for the ids of its recent articles (list_new_ids), keeps the ones not on ICAM yet, fetches
+    those in batches (fetch_batch), converts each record to an ICAM article dict (to_icam_article) and posts them.
+    Then finish() moves the source's high-water mark, so the next run only looks at what came after.
+
+    name is both the itemName of the source's sourceRepo on ICAM and the key of its local state.
+    """
+    name = None
+    # Key of the high-water mark in the state store, as '<name>.<date_key>'
+    date_key = 'last_date'
+
+    def __init__(self):
+        # The date to store as the new high-water mark, set by list_new_ids()
+        self.search_date = None
+
+    @classmethod
+    @abstractmethod
+    def from_config(cls, config):
+        """
+        :param config: The fetchScript ConfigParser, each source reads its own section
+        :return: A source set up from the config
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_new_ids(self, state=None):
+        """
+        :param state: The StateStore, to only look at articles since the last run (None to use the source's default)
+        :return: A list with the repoArticleIds of the source's recent articles
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def fetch_batch(self, ids):
+        """
+        :param ids: repoArticleIds returned by list_new_ids()
+        :return: An iterable of source records, in the source's own format
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def to_icam_article(self, record):
+        """
+        :param record: A record returned by fetch_batch()
+        :return: An article dict ready for Icam.post_new_articles()
+        """
+        raise NotImplementedError
+
+    def finish(self, state, failed):
+        """
+        Stores the high-water mark of the run, only when nothing failed, so failed articles are searched again.
+
+        :param state: The StateStore, or None
+        :param failed: How many articles couldn't be imported
+        """
+        if state is None or self.search_date is None:
+            return
+        if failed:
+            echo(f'{self.name}: {failed} articles failed, next run will search again from the same date')
+        else:
+            state.set(f'{self.name}.{self.date_key}', self.search_date)
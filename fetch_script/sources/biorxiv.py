@@ -0,0 +1,109 @@
+import datetime
+
+from fetch_script.metrics import echo
+from fetch_script.pubmed import truncate_title
+from fetch_script.sessions import make_session
+from fetch_script.sources.base import Source
+
+# ref: https://api.biorxiv.org/
+API_URL = 'https://api.biorxiv.org/details/'
+
+
+class BioRxivSource(Source):
+    """
+    Preprints from bioRxiv, through its public details API. The API has no search, so the preprints posted since the
+    last run are listed (100 per page) and filtered by keywords in their title or abstract.
+
+    The listing already holds the whole records, so they are kept in memory for fetch_batch(). The DOI is used as
+    repoArticleId, and later versions of a preprint replace earlier ones.
+    """
+    name = 'biorxiv'
+    server = 'biorxiv'
+    journal = 'bioRxiv'
+
+    def __init__(self, keywords, days=7, session=None):
+        super().__init__()
+        self.keywords = [k.lower() for k in keywords]
+        self.days = days
+        self.session = session if session is not None else make_session()
+        self.records = {}
+
+    @classmethod
+    def from_config(cls, config):
+        section = cls.name.upper()
+        keywords = config.get(section, 'keywords', fallback='covid,sars-cov-2,coronavirus')
+        return cls([k.strip() for k in keywords.split(',') if k.strip()],
+                   days=config.getint(section, 'days', fallback=7))
+
+    def _matches(self, record):
+        text = '{} {}'.format(record.get('title', ''), record.get('abstract', '')).lower()
+        return any(k in text for k in self.keywords)
+
+    def list_new_ids(self, state=None):
+        """
+        Lists the preprints posted since the last complete run, or in the last `days` days.
+        """
+        today = datetime.date.today()
+        self.search_date = today.isoformat()
+        since = state.get(f'{self.name}.{self.date_key}') if state is not None else None
+        start = since or (today - datetime.timedelta(days=self.days)).isoformat()
+        echo(f'searching {self.name} since {start}')
+
+        self.records = {}
+        cursor = 0
+        while True:
+            reply = self.session.get('{}{}/{}/{}/{}'.format(API_URL, self.server, start, today, cursor)).json()
+            collection = reply.get('collection', [])
+            for record in collection:
+                if self._matches(record):
+                    self.records[record['doi']] = record
+            cursor += len(collection)
+            messages = reply.get('messages') or [{}]
+            if not collection or cursor >= int(messages[0].get('total', 0)):
+                break
+        return list(self.records)
+
+    def fetch_batch(self, ids):
+        for doi in ids:
+            record = self.records.get(doi)
+            if record is None:
+                collection = self.session.get('{}{}/{}'.format(API_URL, self.server, doi)).json().get('collection')
+                record = collection[-1] if collection else None
+            if record is not None:
+                yield record
+
+    def to_icam_article(self, record):
+        date = datetime.datetime.strptime(record['date'], '%Y-%m-%d')
+        article = {
+            'repoArticleId': record['doi'],
+            'reviewState': 'Hold',
+            'repoDate': record['date'],
+            'articleTitle': truncate_title(record['title'].strip()),
+            'articleJournal': self.journal,
+            'articleDate': date.strftime('%d-%b-%Y'),
+            'articleDoi': record['doi'],
+            'fetchDate': str(datetime.date.today())
+        }
+        if record.get('abstract'):
+            article['articleAbstract'] = record['abstract'].strip()
+
+        # Same citation format as PubMed articles: "Author(s). Journal. Date"
+        authors = [a.split(',')[0].strip() for a in record.get('authors', '').split(';') if a.strip()]
+        citation = ''
+        if len(authors) == 1:
+            citation = '{}.'.format(authors[0])
+        elif len(authors) == 2:
+            citation = '{} and {}.'.format(authors[0], authors[1])
+        elif authors:
+            citation = '{}, et al.'.format(authors[0])
+        article['citation'] = citation + ' {}. {}'.format(self.journal, article['articleDate'])
+        return article
+
+
+class MedRxivSource(BioRxivSource):
+    """
+    Preprints from medRxiv, same API as bioRxiv.
+    """
+    name = 'medrxiv'
+    server = 'medrxiv'
+    journal = 'medRxiv'
@@ -0,0 +1,46 @@
+import datetime
+
+from fetch_script import pubmed
+from fetch_script.metrics import echo
+from fetch_script.sources.base import Source
+
+# ESearch won't return more than this without the history server
+MAX_INCREMENTAL_ARTICLES = 10000
+
+
+class PubMedSource(Source):
+    """
+    Articles from PubMed, through the fetch_script.pubmed E-utilities client.
+    """
+    name = 'pubmed'
+    # Also used by --backlog
+    date_key = 'last_edat'
+
+    def __init__(self, num_articles, search_term, batch_size=200):
+        super().__init__()
+        self.num_articles = num_articles
+        self.search_term = search_term
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.getint('PUBMED', 'num_articles'), config['PUBMED']['search_term'])
+
+    def list_new_ids(self, state=None):
+        """
+        Without a state store, looks at the latest num_articles on PubMed.
+        With one, looks at everything PubMed added (edat) since the day of the last complete run.
+        """
+        self.search_date = datetime.date.today().strftime('%Y/%m/%d')
+        mindate = state.get('pubmed.last_edat') if state is not None else None
+        if mindate:
+            echo(f'searching pubmed since {mindate}')
+            return pubmed.get_ids_list(MAX_INCREMENTAL_ARTICLES, self.search_term, mindate=mindate)
+        return pubmed.get_ids_list(self.num_articles, self.search_term)
+
+    def fetch_batch(self, ids):
+        return pubmed.get_articles_batch(ids, self.batch_size)
+
+    def to_icam_article(self, record):
+        # pubmed already parses the EFetch XML into ICAM article dicts
+        return record
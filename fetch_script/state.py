@@ -0,0 +1,218 @@
+import json
+import sqlite3
+import threading
+import time
+from itertools import islice
+
+
+class StateStore:
+    """
+    Local SQLite file remembering what is already in ICAM between runs, so a routine run doesn't need to list every
+    article on the gateway:
+    - known_articles: the repoArticleIds already imported, per source repo
+    - article_hashes: the ICAM id and a hash of the content of the imported articles, to tell which ones changed
+    - outbox: the articles fetched but not on ICAM yet, see outbox.py
+    - meta: small key/value pairs, like the last date searched on each source
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            # repo_article_id has no declared type so ints (PubMed IDs) and strings (DOIs) keep their python type
+            self.conn.execute('CREATE TABLE IF NOT EXISTS known_articles ('
+                              'srepo TEXT NOT NULL, repo_article_id NOT NULL, '
+                              'PRIMARY KEY (srepo, repo_article_id)) WITHOUT ROWID')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS article_hashes ('
+                              'srepo TEXT NOT NULL, repo_article_id NOT NULL, icam_id INTEGER, hash TEXT, '
+                              'PRIMARY KEY (srepo, repo_article_id)) WITHOUT ROWID')
+            # Rowid table: the article json is too big a row for WITHOUT ROWID
+            self.conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                              'srepo TEXT NOT NULL, repo_article_id NOT NULL, article TEXT NOT NULL, '
+                              'attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL DEFAULT 0, '
+                              'last_error TEXT, dead INTEGER NOT NULL DEFAULT 0, '
+                              'UNIQUE (srepo, repo_article_id))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        self.conn.close()
+
+    # Known articles
+    # ------------------------------------------------------------------------------------------------------------------
+    def filter_new(self, srepo, ids):
+        """
+        :param srepo: Source repo name, ex: 'pubmed'
+        :param ids: repoArticleIds to check
+        :return: A list with the ids that are not known yet, in the given order
+        """
+        ids = list(ids)
+        known = set()
+        with self.lock:
+            # Stay under SQLite's limit of bound parameters per statement
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self.conn.execute('SELECT repo_article_id FROM known_articles WHERE srepo = ? '
+                                         'AND repo_article_id IN ({})'.format(','.join('?' * len(chunk))),
+                                         [srepo] + chunk)
+                known.update(row[0] for row in rows)
+        return [i for i in ids if i not in known]
+
+    def add_ids(self, srepo, ids):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO known_articles VALUES (?, ?)', ((srepo, i) for i in ids))
+
+    def count_ids(self, srepo):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM known_articles WHERE srepo = ?', (srepo,)).fetchone()[0]
+
+    # Article hashes
+    # ------------------------------------------------------------------------------------------------------------------
+    def set_hashes(self, srepo, rows):
+        """
+        :param rows: (repoArticleId, ICAM id, content hash) tuples
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO article_hashes VALUES (?, ?, ?, ?)',
+                                  ((srepo, i, icam_id, h) for i, icam_id, h in rows))
+
+    def replace_articles(self, srepos, rows):
+        """
+        Replaces every known id and hash of the source repos, used when reconciling with the articles actually on ICAM.
+        The rows are staged in chunks as they come, so the listing is never held in memory and the store isn't locked
+        while it downloads, then swapped in with a single transaction: if rows raises, nothing is replaced. One
+        reconcile at a time.
+
+        :param srepos: Source repo names
+        :param rows: (srepo, repoArticleId, ICAM id, content hash) tuples, ICAM id and hash None to only record the id
+        """
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS staged_articles ('
+                              'srepo TEXT NOT NULL, repo_article_id NOT NULL, icam_id INTEGER, hash TEXT)')
+            self.conn.execute('DELETE FROM staged_articles')
+        rows = iter(rows)
+        for chunk in iter(lambda: list(islice(rows, 10000)), []):
+            with self.lock, self.conn:
+                self.conn.executemany('INSERT INTO staged_articles VALUES (?, ?, ?, ?)', chunk)
+        srepos = list(srepos)
+        marks = ','.join('?' * len(srepos))
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM known_articles WHERE srepo IN ({})'.format(marks), srepos)
+            self.conn.execute('DELETE FROM article_hashes WHERE srepo IN ({})'.format(marks), srepos)
+            self.conn.execute('INSERT OR IGNORE INTO known_articles SELECT srepo, repo_article_id FROM staged_articles')
+            self.conn.execute('INSERT OR REPLACE INTO article_hashes SELECT * FROM staged_articles '
+                              'WHERE hash IS NOT NULL')
+            self.conn.execute('DELETE FROM staged_articles')
+
+    def get_hashes(self, srepo, ids):
+        """
+        :return: A dict repoArticleId -> (ICAM id, content hash), for the given ids that have one
+        """
+        ids = list(ids)
+        hashes = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self.conn.execute('SELECT repo_article_id, icam_id, hash FROM article_hashes WHERE srepo = ? '
+                                         'AND repo_article_id IN ({})'.format(','.join('?' * len(chunk))),
+                                         [srepo] + chunk)
+                hashes.update((row[0], (row[1], row[2])) for row in rows)
+        return hashes
+
+    # Outbox
+    # ------------------------------------------------------------------------------------------------------------------
+    def queue_articles(self, srepo, articles):
+        """
+        Stores articles to post. Articles already in the outbox (waiting or dead) are left as they are.
+
+        :param articles: Article dicts, as posted to ICAM
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO outbox (srepo, repo_article_id, article) VALUES (?, ?, ?)',
+                                  ((srepo, a['repoArticleId'], json.dumps(a)) for a in articles))
+
+    def due_articles(self, srepo, limit):
+        """
+        :return: Up to `limit` (article dict, attempts so far) tuples waiting to be posted, oldest first, without the
+                 dead ones and the ones waiting for their next attempt
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT article, attempts FROM outbox WHERE srepo = ? AND NOT dead '
+                                     'AND next_attempt <= ? ORDER BY rowid LIMIT ?', (srepo, time.time(), limit))
+            return [(json.loads(article), attempts) for article, attempts in rows]
+
+    def queued_ids(self, srepo, ids):
+        """
+        :return: A set with the ids that are in the outbox, dead or not
+        """
+        ids = list(ids)
+        queued = set()
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self.conn.execute('SELECT repo_article_id FROM outbox WHERE srepo = ? '
+                                         'AND repo_article_id IN ({})'.format(','.join('?' * len(chunk))),
+                                         [srepo] + chunk)
+                queued.update(row[0] for row in rows)
+        return queued
+
+    def outbox_done(self, srepo, ids):
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM outbox WHERE srepo = ? AND repo_article_id = ?',
+                                  ((srepo, i) for i in ids))
+
+    def outbox_retry(self, srepo, rows):
+        """
+        :param rows: (repoArticleId, time of the next attempt, error) tuples
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, last_error = ? '
+                                  'WHERE srepo = ? AND repo_article_id = ?',
+                                  ((next_attempt, error, srepo, i) for i, next_attempt, error in rows))
+
+    def outbox_dead(self, srepo, rows):
+        """
+        :param rows: (repoArticleId, error) tuples
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE outbox SET attempts = attempts + 1, dead = 1, last_error = ? '
+                                  'WHERE srepo = ? AND repo_article_id = ?', ((error, srepo, i) for i, error in rows))
+
+    def dead_letters(self, srepo=None):
+        """
+        :return: (srepo, repoArticleId, attempts, last error) tuples of the dead articles
+        """
+        with self.lock:
+            return self.conn.execute('SELECT srepo, repo_article_id, attempts, last_error FROM outbox WHERE dead '
+                                     'AND srepo = coalesce(?, srepo) ORDER BY rowid', (srepo,)).fetchall()
+
+    def requeue_dead(self, srepo=None):
+        """
+        Gives the dead articles a new set of attempts.
+
+        :return: How many articles were requeued
+        """
+        with self.lock, self.conn:
+            return self.conn.execute('UPDATE outbox SET dead = 0, attempts = 0, next_attempt = 0 WHERE dead '
+                                     'AND srepo = coalesce(?, srepo)', (srepo,)).rowcount
+
+    def count_outbox(self):
+        """
+        :return: A dict srepo -> (articles waiting, dead articles)
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT srepo, SUM(NOT dead), SUM(dead) FROM outbox GROUP BY srepo')
+            return {srepo: (waiting, dead) for srepo, waiting, dead in rows}
+
+    # Meta
+    # ------------------------------------------------------------------------------------------------------------------
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
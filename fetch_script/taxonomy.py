@@ -0,0 +1,195 @@
+"""
+Provisioning of ICAM's article types and category trees from a data file (taxonomy.json).
+
+The file is diffed against one listing of each entity on ICAM, and only the difference is applied, so provisioning
+is idempotent and a second run does nothing. Category trees are matched by their path from the root, the same name
+can be used under different parents. Creates go level by level (a child needs the id of its parent) and deletes
+in reverse, children before their parents; the requests of a level run concurrently.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fetch_script.metrics import echo
+
+TAXONOMY_FILE = os.path.join(os.path.dirname(__file__), 'taxonomy.json')
+
+
+def load_taxonomy(path=TAXONOMY_FILE):
+    """
+    :return: A dict with the 'article_types' (a list of names) and the 'category_trees': a dict name -> children,
+             the children being a list of names or another such dict
+    """
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def tree_paths(tree, parent=()):
+    """
+    :param tree: Category trees, see load_taxonomy()
+    :return: The path of every category, a tuple of names from its root, parents before their children
+    """
+    for name, children in tree.items():
+        path = parent + (name,)
+        yield path
+        if isinstance(children, dict):
+            yield from tree_paths(children, path)
+        else:
+            for child in children:
+                yield path + (child,)
+
+
+def parent_id(ctree):
+    return (ctree.get('parent') or {}).get('id')
+
+
+def ctree_paths(ctrees):
+    """
+    :param ctrees: The category-trees listed from ICAM
+    :return: A dict id -> path. The path of a category whose parent isn't listed (or in a loop) starts with None,
+             so it never matches the file.
+    """
+    by_id = {ctree['id']: ctree for ctree in ctrees}
+    paths = {}
+
+    def path(ctree_id, seen):
+        if ctree_id not in paths:
+            ctree = by_id[ctree_id]
+            parent = parent_id(ctree)
+            if parent is None:
+                paths[ctree_id] = (ctree['itemName'],)
+            elif parent not in by_id or parent in seen:
+                paths[ctree_id] = (None, ctree['itemName'])
+            else:
+                paths[ctree_id] = path(parent, seen | {ctree_id}) + (ctree['itemName'],)
+        return paths[ctree_id]
+
+    for ctree_id in by_id:
+        path(ctree_id, {ctree_id})
+    return paths
+
+
+class Plan:
+    """
+    What provisioning changes on ICAM, see plan():
+    - atypes_create: names of the article types to create
+    - atypes_delete: ids of the article types to delete
+    - ctrees_create: level -> paths of the categories to create, level 1 being the roots
+    - ctrees_delete: level -> ids of the categories to delete
+    - ctree_ids: path -> id of the categories on ICAM, filled in with the new ones as they are created
+    """
+
+    def __init__(self):
+        self.atypes_create = []
+        self.atypes_delete = []
+        self.ctrees_create = {}
+        self.ctrees_delete = {}
+        self.ctree_ids = {}
+
+    def summary(self):
+        return 'article types: {} to create, {} to delete; category trees: {} to create, {} to delete'.format(
+            len(self.atypes_create), len(self.atypes_delete), sum(map(len, self.ctrees_create.values())),
+            sum(map(len, self.ctrees_delete.values())))
+
+
+def plan(icam, taxonomy, prune=False, reset=False):
+    """
+    Diffs the taxonomy against ICAM. A part missing from the taxonomy dict is left as it is.
+
+    :param taxonomy: See load_taxonomy()
+    :param prune: Also delete what is on ICAM but not in the taxonomy
+    :param reset: Delete everything and create the taxonomy again
+    :return: A Plan
+    """
+    result = Plan()
+    if 'article_types' in taxonomy:
+        atypes = icam.list_entities(icam.atypes_endpoint)
+        wanted = set(taxonomy['article_types'])
+        names = set()
+        for atype in sorted(atypes, key=lambda a: a['id']):
+            # The oldest of the same name is kept, the others are duplicates
+            if reset or (prune and (atype['itemName'] not in wanted or atype['itemName'] in names)):
+                result.atypes_delete.append(atype['id'])
+            else:
+                names.add(atype['itemName'])
+        result.atypes_create = [name for name in taxonomy['article_types'] if name not in names]
+
+    if 'category_trees' in taxonomy:
+        wanted = list(tree_paths(taxonomy['category_trees']))
+        wanted_set = set(wanted)
+        ctrees = {ctree['id']: ctree for ctree in icam.list_entities(icam.ctrees_endpoint)}
+        paths = ctree_paths(ctrees.values())
+        deleted = set()
+        # Parents first, so the children of a deleted category are deleted too
+        for ctree_id in sorted(paths, key=lambda i: (len(paths[i]), i)):
+            path = paths[ctree_id]
+            if reset or (prune and (path not in wanted_set or path in result.ctree_ids
+                                    or parent_id(ctrees[ctree_id]) in deleted)):
+                deleted.add(ctree_id)
+                result.ctrees_delete.setdefault(len(path), []).append(ctree_id)
+            else:
+                result.ctree_ids.setdefault(path, ctree_id)
+        for path in wanted:
+            if path not in result.ctree_ids:
+                result.ctrees_create.setdefault(len(path), []).append(path)
+    return result
+
+
+def apply(icam, changes, max_workers=None):
+    """
+    Applies a Plan: deletes first, deepest categories first, then creates, roots first.
+    A category whose parent couldn't be created is not created either.
+
+    :return: A dict with what failed (article type name or id, category path or id) -> status code
+    """
+    failed = {}
+
+    def create(endpoint, entity):
+        res = icam.create_entity(endpoint, entity)
+        return res.status_code, res.json() if res.status_code == 201 else None
+
+    with ThreadPoolExecutor(max_workers=max_workers or icam.max_in_flight) as pool:
+        failed.update(icam.delete_many(icam.atypes_endpoint, changes.atypes_delete, max_workers))
+        for level in sorted(changes.ctrees_delete, reverse=True):
+            failed.update(icam.delete_many(icam.ctrees_endpoint, changes.ctrees_delete[level], max_workers))
+
+        atypes = [{'active': True, 'itemName': name} for name in changes.atypes_create]
+        for name, (status_code, _) in zip(changes.atypes_create,
+                                          pool.map(lambda a: create(icam.atypes_endpoint, a), atypes)):
+            if status_code != 201:
+                failed[name] = status_code
+
+        for level in sorted(changes.ctrees_create):
+            paths, ctrees = [], []
+            for path in changes.ctrees_create[level]:
+                parent = changes.ctree_ids.get(path[:-1]) if len(path) > 1 else None
+                if len(path) > 1 and parent is None:
+                    failed[path] = None
+                    continue
+                ctree = {'active': True, 'itemName': path[-1]}
+                if parent is not None:
+                    ctree['parent'] = {'id': parent}
+                paths.append(path)
+                ctrees.append(ctree)
+            for path, (status_code, body) in zip(paths,
+                                                 pool.map(lambda c: create(icam.ctrees_endpoint, c), ctrees)):
+                if status_code == 201:
+                    changes.ctree_ids[path] = body['id']
+                else:
+                    failed[path] = status_code
+    return failed
+
+
+def provision(icam, taxonomy, prune=False, reset=False):
+    """
+    Brings ICAM's article types and category trees in line with the taxonomy, see plan() and apply().
+
+    :return: The Plan applied and what failed, see apply()
+    """
+    changes = plan(icam, taxonomy, prune, reset)
+    echo('taxonomy:', changes.summary())
+    failed = apply(icam, changes)
+    for entity, status_code in failed.items():
+        echo('taxonomy: {} failed: {}'.format(' > '.join(entity) if isinstance(entity, tuple) else entity,
+                                              status_code if status_code is not None else 'parent missing'))
+    return changes, failed